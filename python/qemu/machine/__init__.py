@@ -7,6 +7,7 @@
  | QEMUQtestProtocol: send/receive qtest messages.
  | QEMUMachine: Configure and Boot a QEMU VM
  | +-- QEMUQtestMachine: VM class, with a qtest socket.
+ | launch_many: Boot several VMs concurrently
 
 """
 
@@ -25,7 +26,7 @@
 # pylint: disable=import-error
 # see: https://github.com/PyCQA/pylint/issues/3624
 # see: https://github.com/PyCQA/pylint/issues/3651
-from .machine import QEMUMachine
+from .machine import QEMUMachine, launch_many
 from .qtest import QEMUQtestMachine, QEMUQtestProtocol
 
 
@@ -33,4 +34,5 @@
     'QEMUMachine',
     'QEMUQtestProtocol',
     'QEMUQtestMachine',
+    'launch_many',
 )
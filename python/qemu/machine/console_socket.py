@@ -13,11 +13,19 @@
 # the COPYING file in the top-level directory.
 #
 
-from collections import deque
+import re
+import selectors
 import socket
 import threading
 import time
-from typing import Deque, Optional
+from typing import (
+    BinaryIO,
+    Match,
+    Optional,
+    Pattern,
+    Tuple,
+    Union,
+)
 
 
 class ConsoleSocket(socket.socket):
@@ -29,20 +37,36 @@ class ConsoleSocket(socket.socket):
 
     Optionally a file path can be passed in and we will also
     dump the characters to this file for debugging purposes.
+
+    expect() waits for a pattern to appear in the console output.
     """
+    # pylint: disable=too-many-instance-attributes
+
+    #: Size of the reads from the socket
+    chunk_size = 65536
+
+    #: Delay after which buffered log writes are flushed, in seconds
+    flush_interval = 0.5
+
     def __init__(self, address: str, file: Optional[str] = None,
                  drain: bool = False):
         self._recv_timeout_sec = 300.0
-        self._sleep_time = 0.5
-        self._buffer: Deque[int] = deque()
+        # Output received but not consumed yet is _buffer[_head:]
+        self._buffer = bytearray()
+        self._head = 0
+        # Number of bytes removed from the front of _buffer
+        self._discarded = 0
+        self._eof = False
+        self._cond = threading.Condition()
         socket.socket.__init__(self, socket.AF_UNIX, socket.SOCK_STREAM)
         self.connect(address)
-        self._logfile = None
+        self._logfile: Optional[BinaryIO] = None
         if file:
             # pylint: disable=consider-using-with
             self._logfile = open(file, "bw")
         self._open = True
         self._drain_thread = None
+        self._wakeup: Optional[Tuple[socket.socket, socket.socket]] = None
         if drain:
             self._drain_thread = self._thread_start()
 
@@ -55,22 +79,30 @@ def __repr__(self) -> str:
 
     def _drain_fn(self) -> None:
         """Drains the socket and runs while the socket is open."""
-        while self._open:
-            try:
-                self._drain_socket()
-            except socket.timeout:
-                # The socket is expected to timeout since we set a
-                # short timeout to allow the thread to exit when
-                # self._open is set to False.
-                time.sleep(self._sleep_time)
+        assert self._wakeup is not None
+        dirty = False
+        with selectors.DefaultSelector() as selector:
+            selector.register(self, selectors.EVENT_READ)
+            selector.register(self._wakeup[0], selectors.EVENT_READ)
+            while self._open and not self._eof:
+                ready = selector.select(self.flush_interval if dirty
+                                        else None)
+                if not ready and self._logfile:
+                    # Idle: make the log file current
+                    self._logfile.flush()
+                    dirty = False
+                for key, _ in ready:
+                    if key.fileobj is self:
+                        dirty = self._drain_socket() or dirty
+        if self._logfile:
+            self._logfile.flush()
 
     def _thread_start(self) -> threading.Thread:
         """Kick off a thread to drain the socket."""
-        # Configure socket to not block and timeout.
-        # This allows our drain thread to not block
-        # on recieve and exit smoothly.
+        # The drain thread waits for the socket to be readable, and is
+        # woken up by close() through the socket pair.
         socket.socket.setblocking(self, False)
-        socket.socket.settimeout(self, 1)
+        self._wakeup = socket.socketpair()
         drain_thread = threading.Thread(target=self._drain_fn)
         drain_thread.daemon = True
         drain_thread.start()
@@ -81,36 +113,155 @@ def close(self) -> None:
         if self._open:
             self._open = False
             if self._drain_thread is not None:
+                assert self._wakeup is not None
+                self._wakeup[1].send(b'\0')
                 thread, self._drain_thread = self._drain_thread, None
                 thread.join()
+                for sock in self._wakeup:
+                    sock.close()
+                self._wakeup = None
             socket.socket.close(self)
             if self._logfile:
                 self._logfile.close()
                 self._logfile = None
 
-    def _drain_socket(self) -> None:
-        """process arriving characters into in memory _buffer"""
-        data = socket.socket.recv(self, 1)
+    def _drain_socket(self) -> bool:
+        """
+        Append the data available on the socket to the in memory buffer.
+
+        @return True if data was appended.
+        """
+        try:
+            data = socket.socket.recv(self, self.chunk_size)
+        except (BlockingIOError, InterruptedError):
+            return False
+        except OSError:
+            data = b''
         if self._logfile:
             self._logfile.write(data)
-            self._logfile.flush()
-        self._buffer.extend(data)
+        with self._cond:
+            if data:
+                self._buffer += data
+            else:
+                self._eof = True
+            self._cond.notify_all()
+        return bool(data)
+
+    def _wait_data(self, timeout: Optional[float]) -> None:
+        """
+        Wait for more data, or for the end of the stream, with self._cond
+        held.  Without a drain thread, read it from the socket.
+        """
+        if self._drain_thread is not None:
+            self._cond.wait(timeout)
+            return
+        with selectors.DefaultSelector() as selector:
+            selector.register(self, selectors.EVENT_READ)
+            if selector.select(timeout):
+                self._drain_socket()
+                if self._logfile:
+                    self._logfile.flush()
+
+    def _consume(self, size: int) -> bytes:
+        """Remove size bytes from the in memory buffer and return them."""
+        data = bytes(self._buffer[self._head:self._head + size])
+        self._head += len(data)
+        # Compact the buffer once the consumed part dominates it
+        if self._head > self.chunk_size and self._head * 2 > len(self._buffer):
+            del self._buffer[:self._head]
+            self._discarded += self._head
+            self._head = 0
+        return data
+
+    def _recv_buffered(self, bufsize: int, timeout: Optional[float]) -> bytes:
+        deadline = None if timeout is None else time.monotonic() + timeout
+        with self._cond:
+            while len(self._buffer) == self._head and not self._eof:
+                remaining = None
+                if deadline is not None:
+                    remaining = deadline - time.monotonic()
+                    if remaining <= 0:
+                        raise socket.timeout
+                self._wait_data(remaining)
+            return self._consume(bufsize)
 
     def recv(self, bufsize: int = 1, flags: int = 0) -> bytes:
         """Return chars from in memory buffer.
-           Maintains the same API as socket.socket.recv.
+           Maintains the same API as socket.socket.recv: waits until some
+           data is available and returns up to bufsize bytes, or b'' at the
+           end of the stream.
         """
-        if self._drain_thread is None:
+        if self._drain_thread is None and self._head == len(self._buffer):
             # Not buffering the socket, pass thru to socket.
             return socket.socket.recv(self, bufsize, flags)
         assert not flags, "Cannot pass flags to recv() in drained mode"
-        start_time = time.time()
-        while len(self._buffer) < bufsize:
-            time.sleep(self._sleep_time)
-            elapsed_sec = time.time() - start_time
-            if elapsed_sec > self._recv_timeout_sec:
-                raise socket.timeout
-        return bytes((self._buffer.popleft() for i in range(bufsize)))
+        return self._recv_buffered(bufsize, self._recv_timeout_sec)
+
+    def recv_into(self, buffer: Union[bytearray, memoryview],  # type: ignore
+                  nbytes: int = 0, flags: int = 0) -> int:
+        """Like recv(), but store the data into buffer.
+           This keeps makefile() consistent with recv().
+        """
+        if self._drain_thread is None and self._head == len(self._buffer):
+            return socket.socket.recv_into(self, buffer, nbytes, flags)
+        assert not flags, "Cannot pass flags to recv_into() in drained mode"
+        data = self._recv_buffered(nbytes or len(buffer),
+                                   self._recv_timeout_sec)
+        buffer[:len(data)] = data
+        return len(data)
+
+    def expect(self, pattern: Union[str, bytes, 'Pattern[bytes]'],
+               timeout: Optional[float] = None) -> 'Match[bytes]':
+        """
+        Wait for the console output to match a pattern, and consume the
+        output up to the end of the match.
+
+        The output is scanned incrementally: each search only covers the
+        data received since the previous one, plus enough of the older
+        data for a string to match across reads.  Regular expressions are
+        searched again from the start of the last incomplete line.
+
+        @param pattern: a string or bytes to look for, or a regular
+                        expression on bytes
+        @param timeout: timeout in seconds, by default the one of recv()
+        @return The match object.  Its string is the scanned output,
+                which may not start at the beginning of the consumed
+                output.
+        @raise socket.timeout: if the timeout elapses
+        @raise EOFError: if the console is closed before a match
+        """
+        if isinstance(pattern, str):
+            pattern = pattern.encode('utf-8')
+        overlap: Optional[int] = None
+        if isinstance(pattern, bytes):
+            overlap = max(len(pattern) - 1, 0)
+            pattern = re.compile(re.escape(pattern))
+        if timeout is None:
+            timeout = self._recv_timeout_sec
+        deadline = time.monotonic() + timeout
+
+        with self._cond:
+            scanned = self._head
+            while True:
+                if overlap is None:
+                    start = self._buffer.rfind(b'\n', self._head, scanned) + 1
+                else:
+                    start = scanned - overlap
+                start = max(start, self._head)
+                match = pattern.search(bytes(self._buffer[start:]))
+                if match:
+                    self._consume(start + match.end() - self._head)
+                    return match
+                if self._eof:
+                    raise EOFError("console closed")
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    raise socket.timeout
+                # Other readers may consume and compact the buffer while
+                # waiting
+                scanned = len(self._buffer) + self._discarded
+                self._wait_data(remaining)
+                scanned = max(scanned - self._discarded, self._head)
 
     def setblocking(self, value: bool) -> None:
         """When not draining we pass thru to the socket,
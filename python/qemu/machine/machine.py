@@ -17,8 +17,9 @@
 # Based on qmp.py.
 #
 
+from concurrent.futures import ThreadPoolExecutor
 import errno
-from itertools import chain
+from itertools import chain, count
 import logging
 import os
 import shutil
@@ -26,6 +27,7 @@
 import socket
 import subprocess
 import tempfile
+import time
 from types import TracebackType
 from typing import (
     Any,
@@ -39,6 +41,7 @@
 )
 
 from qemu.qmp import (  # pylint: disable=import-error
+    EventBuffer,
     QEMUMonitorProtocol,
     QMPMessage,
     QMPReturnValue,
@@ -50,6 +53,9 @@
 
 LOG = logging.getLogger(__name__)
 
+# Numbers the machines created without a name by this process
+_default_name_ids = count()
+
 
 class QEMUMachineError(Exception):
     """
@@ -97,14 +103,16 @@ def __init__(self,
                  sock_dir: Optional[str] = None,
                  drain_console: bool = False,
                  console_log: Optional[str] = None,
-                 log_dir: Optional[str] = None):
+                 log_dir: Optional[str] = None,
+                 events_maxlen: Optional[int] = None):
         '''
         Initialize a QEMUMachine
 
         @param binary: path to the qemu binary
         @param args: list of extra arguments
         @param wrapper: list of arguments used as prefix to qemu binary
-        @param name: prefix for socket and log file names (default: qemu-PID)
+        @param name: prefix for socket and log file names (default: qemu-PID
+                     for the first machine of the process, then qemu-PID-N)
         @param base_temp_dir: default location where temp files are created
         @param monitor_address: address for QMP monitor
         @param socket_scm_helper: helper program, required for send_fd_scm()
@@ -112,6 +120,9 @@ def __init__(self,
         @param drain_console: (optional) True to drain console socket to buffer
         @param console_log: (optional) path to console log file
         @param log_dir: where to create and keep log files
+        @param events_maxlen: (optional) maximum number of QMP events kept
+                              until they are consumed, in each of the event
+                              buffers; the oldest ones are dropped first
         @note: Qemu process is not started until launch() is used.
         '''
         # pylint: disable=too-many-arguments
@@ -122,7 +133,14 @@ def __init__(self,
         self._args = list(args)
         self._wrapper = wrapper
 
-        self._name = name or "qemu-%d" % os.getpid()
+        if not name:
+            # Machines of the same process must not share socket and log
+            # file names
+            name = f"qemu-{os.getpid()}"
+            name_id = next(_default_name_ids)
+            if name_id:
+                name += f"-{name_id}"
+        self._name = name
         self._base_temp_dir = base_temp_dir
         self._sock_dir = sock_dir or self._base_temp_dir
         self._log_dir = log_dir
@@ -148,7 +166,10 @@ def __init__(self,
         self._qemu_log_path: Optional[str] = None
         self._qemu_log_file: Optional[BinaryIO] = None
         self._popen: Optional['subprocess.Popen[bytes]'] = None
-        self._events: List[QMPMessage] = []
+        self._events_maxlen = events_maxlen
+        self._events = EventBuffer(events_maxlen)
+        # Events received by events_wait() that did not match
+        self._events_unmatched = 0
         self._iolog: Optional[str] = None
         self._qmp_set = True   # Enable QMP monitor by default.
         self._qmp_connection: Optional[QEMUMonitorProtocol] = None
@@ -165,6 +186,8 @@ def __init__(self,
         self._console_socket: Optional[socket.socket] = None
         self._remove_files: List[str] = []
         self._user_killed = False
+        self._launch_start = 0.0
+        self._launch_timings: Dict[str, float] = {}
 
     def __enter__(self) -> 'QEMUMachine':
         return self
@@ -332,7 +355,8 @@ def _pre_launch(self) -> None:
             self._qmp_connection = QEMUMonitorProtocol(
                 self._monitor_address,
                 server=True,
-                nickname=self._name
+                nickname=self._name,
+                events_maxlen=self._events_maxlen
             )
 
         # NOTE: Make sure any opened resources are *definitely* freed in
@@ -344,6 +368,7 @@ def _pre_launch(self) -> None:
     def _post_launch(self) -> None:
         if self._qmp_connection:
             self._qmp.accept()
+            self._record_timing('qmp')
 
     def _post_shutdown(self) -> None:
         """
@@ -396,6 +421,8 @@ def launch(self) -> None:
 
         self._iolog = None
         self._qemu_full_args = ()
+        self._launch_start = time.time()
+        self._launch_timings = {}
         try:
             self._launch()
             self._launched = True
@@ -430,8 +457,41 @@ def _launch(self) -> None:
                                        stderr=subprocess.STDOUT,
                                        shell=False,
                                        close_fds=False)
+        self._record_timing('exec')
         self._post_launch()
 
+    def _record_timing(self, phase: str,
+                       when: Optional[float] = None) -> None:
+        if when is None:
+            when = time.time()
+        self._launch_timings[phase] = when - self._launch_start
+
+    def _record_event(self, event: Optional[QMPMessage]) -> None:
+        """Record the startup timing of the first QMP event."""
+        if event is None or 'first_event' in self._launch_timings:
+            return
+        try:
+            stamp = event['timestamp']
+            when = stamp['seconds'] + stamp['microseconds'] / 1000000
+        except (KeyError, TypeError):
+            when = None
+        self._record_timing('first_event', when)
+
+    @property
+    def launch_timings(self) -> Dict[str, float]:
+        """
+        Returns the startup timings of the last launch, in seconds since
+        launch() was called:
+
+         - 'exec': the QEMU process was started,
+         - 'qmp': the QMP connection was established,
+         - 'first_event': QEMU emitted the first QMP event seen by this
+           object, according to the timestamp of the event.
+
+        Phases that did not happen (yet) are missing.
+        """
+        return dict(self._launch_timings)
+
     def _early_cleanup(self) -> None:
         """
         Perform any cleanup that needs to happen before the VM exits.
@@ -593,24 +653,74 @@ def command(self, cmd: str,
         qmp_args = self._qmp_args(conv_keys, **args)
         return self._qmp.command(cmd, **qmp_args)
 
+    def qmp_batch(self, commands: Sequence[Tuple[str, Dict[str, Any]]],
+                  conv_keys: bool = True) -> List[QMPMessage]:
+        """
+        Invoke several QMP commands at once and return the response dicts.
+        See QEMUMonitorProtocol.cmd_batch.
+
+        @param commands: (name, arguments) pairs
+        @param conv_keys: convert underscores to dashes in argument names
+        """
+        qmp_cmds = []
+        for cmd, args in commands:
+            qmp_cmd: QMPMessage = {'execute': cmd}
+            if args:
+                qmp_cmd['arguments'] = self._qmp_args(conv_keys, **args)
+            qmp_cmds.append(qmp_cmd)
+        return self._qmp.cmd_batch(qmp_cmds)
+
+    def command_batch(self, commands: Sequence[Tuple[str, Dict[str, Any]]],
+                      conv_keys: bool = True) -> List[QMPReturnValue]:
+        """
+        Invoke several QMP commands at once.
+        On success return the list of return values.
+        On failure of any command raise QMPBatchError.
+        """
+        return self._qmp.command_batch([
+            (cmd, self._qmp_args(conv_keys, **args))
+            for cmd, args in commands
+        ])
+
     def get_qmp_event(self, wait: bool = False) -> Optional[QMPMessage]:
         """
         Poll for one queued QMP events and return it
         """
-        if self._events:
-            return self._events.pop(0)
-        return self._qmp.pull_event(wait=wait)
+        event = self._events.pop()
+        if event is not None:
+            return event
+        event = self._qmp.pull_event(wait=wait)
+        self._record_event(event)
+        return event
 
     def get_qmp_events(self, wait: bool = False) -> List[QMPMessage]:
         """
         Poll for queued QMP events and return a list of dicts
         """
-        events = self._qmp.get_events(wait=wait)
-        events.extend(self._events)
-        del self._events[:]
-        self._qmp.clear_events()
+        self._qmp.get_events(wait=wait)
+        events = self._qmp.events.drain()
+        if events:
+            self._record_event(events[0])
+        events.extend(self._events.drain())
         return events
 
+    def event_stats(self) -> Dict[str, int]:
+        """
+        Return counters of the QMP events of this machine: 'pending'
+        events not consumed yet, 'dropped' events discarded because an
+        event buffer was full, and 'unmatched' events that events_wait()
+        skipped because they did not match, and kept as pending.
+        """
+        stats = {
+            'pending': len(self._events),
+            'dropped': self._events.dropped,
+            'unmatched': self._events_unmatched,
+        }
+        if self._qmp_connection is not None:
+            stats['pending'] += len(self._qmp_connection.events)
+            stats['dropped'] += self._qmp_connection.events.dropped
+        return stats
+
     @staticmethod
     def event_match(event: Any, match: Optional[Any]) -> bool:
         """
@@ -675,19 +785,24 @@ def events_wait(self,
         :return: A QMP event matching the filter criteria.
                  If timeout was 0 and no event matched, None.
         """
+        # Index the criteria by event name, so that events are only
+        # matched against the criteria given for their name.
+        criteria: Dict[str, List[Any]] = {}
+        for name, match in events:
+            criteria.setdefault(name, []).append(match)
+
         def _match(event: QMPMessage) -> bool:
-            for name, match in events:
-                if event['event'] == name and self.event_match(event, match):
+            for match in criteria.get(event['event'], ()):
+                if self.event_match(event, match):
                     return True
             return False
 
         event: Optional[QMPMessage]
 
         # Search cached events
-        for event in self._events:
-            if _match(event):
-                self._events.remove(event)
-                return event
+        event = self._events.pop(criteria, _match)
+        if event is not None:
+            return event
 
         # Poll for new events
         while True:
@@ -696,8 +811,10 @@ def _match(event: QMPMessage) -> bool:
                 # NB: None is only returned when timeout is false-ish.
                 # Timeouts raise QMPTimeoutError instead!
                 break
+            self._record_event(event)
             if _match(event):
                 return event
+            self._events_unmatched += 1
             self._events.append(event)
 
         return None
@@ -786,3 +903,58 @@ def log_dir(self) -> str:
         if self._log_dir is None:
             return self.temp_dir
         return self._log_dir
+
+
+def launch_many(machines: Sequence[QEMUMachine],
+                wait_event: Optional[str] = None,
+                timeout: float = 60.0,
+                max_workers: Optional[int] = None) -> None:
+    """
+    Launch several VMs concurrently.
+
+    The QEMU processes are started and the QMP connections established in
+    parallel, so that the startup of the VMs overlaps.  If any launch
+    fails, the VMs already launched are shut down and the error of the
+    first failed VM is raised.
+
+    @param machines: the VMs to launch; the names given to them must be
+                     distinct; the default names (qemu-PID,
+                     qemu-PID-1, ...) are unique
+    @param wait_event: (optional) also wait for each VM to emit this QMP
+                       event.  The event stays queued, to be retrieved
+                       with the event methods of the VM.
+    @param timeout: timeout for wait_event, in seconds
+    @param max_workers: maximum number of VMs started at the same time,
+                        all of them by default
+    @raise QEMUMachineError: if two machines have the same name
+    @raise QMPTimeoutError: if a VM did not emit wait_event in time
+    """
+    # pylint: disable=protected-access
+    names = [vm._name for vm in machines]
+    if len(set(names)) != len(names):
+        # Their sockets and logs would be created at the same paths
+        raise QEMUMachineError('launch_many() needs distinct machine names')
+    if not machines:
+        return
+
+    def _launch(vm: QEMUMachine) -> None:
+        vm.launch()
+        if wait_event is not None:
+            event = vm.event_wait(wait_event, timeout)
+            assert event is not None
+            vm._events.append(event)
+
+    with ThreadPoolExecutor(max_workers or len(machines)) as executor:
+        futures = [executor.submit(_launch, vm) for vm in machines]
+    errors = [future.exception() for future in futures]
+    error = next((e for e in errors if e is not None), None)
+    if error is None:
+        return
+    for vm in machines:
+        if vm.is_running():
+            try:
+                vm.shutdown()
+            except Exception:  # pylint: disable=broad-except
+                LOG.warning('Error shutting down VM %s', vm._name,
+                            exc_info=True)
+    raise error
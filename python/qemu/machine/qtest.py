@@ -118,15 +118,13 @@ def __init__(self,
                  sock_dir: Optional[str] = None):
         # pylint: disable=too-many-arguments
 
-        if name is None:
-            name = "qemu-%d" % os.getpid()
         if sock_dir is None:
             sock_dir = base_temp_dir
         super().__init__(binary, args, name=name, base_temp_dir=base_temp_dir,
                          socket_scm_helper=socket_scm_helper,
                          sock_dir=sock_dir)
         self._qtest: Optional[QEMUQtestProtocol] = None
-        self._qtest_path = os.path.join(sock_dir, name + "-qtest.sock")
+        self._qtest_path = os.path.join(sock_dir, self._name + "-qtest.sock")
 
     @property
     def _base_args(self) -> List[str]:
@@ -17,6 +17,7 @@
 # This work is licensed under the terms of the GNU GPL, version 2.  See
 # the COPYING file in the top-level directory.
 
+from collections import OrderedDict
 import errno
 import json
 import logging
@@ -24,9 +25,13 @@
 from types import TracebackType
 from typing import (
     Any,
+    Callable,
     Dict,
+    Iterable,
+    Iterator,
     List,
     Optional,
+    Sequence,
     TextIO,
     Tuple,
     Type,
@@ -107,6 +112,166 @@ class QMPBadPortError(QMPError):
     """
 
 
+class QMPBatchError(QMPError):
+    """
+    Some commands of a batch failed.
+
+    @param replies: the replies to all the commands of the batch
+    """
+    def __init__(self, replies: List[QMPMessage]):
+        #: (index, QMPResponseError) pairs for the failed commands
+        self.errors = [(i, QMPResponseError(reply))
+                       for i, reply in enumerate(replies) if 'error' in reply]
+        super().__init__("; ".join(f"command {i}: {err}"
+                                   for i, err in self.errors))
+        self.replies = replies
+
+
+class QMPEventOverflowError(QMPError):
+    """
+    Events were received while the event buffer was full, and dropped.
+    """
+
+
+class EventBuffer:
+    """
+    A bounded FIFO of QMP events, indexed by event name.
+
+    Events can be removed in arrival order, either globally or among the
+    events of given names, without scanning the events of other names.
+
+    @param maxlen: maximum number of buffered events, or None for no limit
+    @param overflow: what to do with an event received while the buffer
+                     is full: 'drop-oldest' discards the oldest buffered
+                     event, 'drop-newest' discards the new event and
+                     'error' discards the new event and makes the next
+                     pop() or drain() raise QMPEventOverflowError.
+                     Discarded events are counted in `dropped`.
+    """
+    OVERFLOW_POLICIES = ('drop-oldest', 'drop-newest', 'error')
+
+    def __init__(self, maxlen: Optional[int] = None,
+                 overflow: str = 'drop-oldest'):
+        if overflow not in self.OVERFLOW_POLICIES:
+            raise ValueError(f"unknown overflow policy '{overflow}'")
+        self.maxlen = maxlen
+        self.overflow = overflow
+        #: Number of events appended to the buffer
+        self.received = 0
+        #: Number of events discarded because the buffer was full
+        self.dropped = 0
+        # Events dropped under the 'error' policy and not reported yet
+        self._unreported = 0
+        # Events are keyed by their arrival number, both in the global
+        # FIFO and in the per-name FIFOs.
+        self._events: 'OrderedDict[int, QMPMessage]' = OrderedDict()
+        self._by_name: Dict[str, 'OrderedDict[int, QMPMessage]'] = {}
+
+    def __len__(self) -> int:
+        return len(self._events)
+
+    def __bool__(self) -> bool:
+        return bool(self._events)
+
+    def __iter__(self) -> Iterator[QMPMessage]:
+        return iter(list(self._events.values()))
+
+    def _remove(self, seq: int) -> QMPMessage:
+        event = self._events.pop(seq)
+        same_name = self._by_name[event['event']]
+        del same_name[seq]
+        if not same_name:
+            del self._by_name[event['event']]
+        return event
+
+    def append(self, event: QMPMessage) -> None:
+        """
+        Add an event at the end of the buffer, applying the overflow
+        policy if the buffer is full.
+
+        This never raises, so that it can be called while reading the
+        replies of commands.
+
+        @param event: QMP event
+        """
+        if self.maxlen is not None and len(self._events) >= self.maxlen:
+            self.dropped += 1
+            if self.overflow == 'error':
+                self._unreported += 1
+                return
+            if self.overflow == 'drop-newest' or not self._events:
+                return
+            self._remove(next(iter(self._events)))
+        seq = self.received
+        self.received += 1
+        self._events[seq] = event
+        self._by_name.setdefault(event['event'], OrderedDict())[seq] = event
+
+    def check_overflow(self) -> None:
+        """
+        Report the events dropped under the 'error' policy, once.
+
+        @raise QMPEventOverflowError: if events were dropped since the
+                                      last report
+        """
+        if self._unreported:
+            count, self._unreported = self._unreported, 0
+            raise QMPEventOverflowError(
+                f"event buffer full, {count} event(s) dropped")
+
+    def pop(self, names: Optional[Iterable[str]] = None,
+            predicate: Optional[Callable[[QMPMessage], bool]] = None
+            ) -> Optional[QMPMessage]:
+        """
+        Remove and return the oldest event with one of the given names and
+        for which `predicate` returns True.
+
+        Only the events with the given names are examined; with no
+        predicate, this is O(1) per name.
+
+        @param names: event names, or None for any name
+        @param predicate: optional filter on the events
+        @return The event, or None if no event matches.
+        @raise QMPEventOverflowError: see check_overflow()
+        """
+        self.check_overflow()
+        if names is None:
+            candidates = [self._events]
+        else:
+            candidates = [self._by_name[name] for name in set(names)
+                          if name in self._by_name]
+        found = None
+        for events in candidates:
+            for seq, event in events.items():
+                if found is not None and seq > found:
+                    break
+                if predicate is None or predicate(event):
+                    found = seq
+                    break
+        if found is None:
+            return None
+        return self._remove(found)
+
+    def drain(self) -> List[QMPMessage]:
+        """
+        Remove and return all the events, in arrival order.
+
+        @raise QMPEventOverflowError: see check_overflow()
+        """
+        self.check_overflow()
+        events = list(self._events.values())
+        self.clear()
+        return events
+
+    def clear(self) -> None:
+        """
+        Discard all the events, and forget the ones dropped.
+        """
+        self._events.clear()
+        self._by_name.clear()
+        self._unreported = 0
+
+
 class QEMUMonitorProtocol:
     """
     Provide an API to connect to QEMU via QEMU Monitor Protocol (QMP) and then
@@ -118,7 +283,9 @@ class QEMUMonitorProtocol:
 
     def __init__(self, address: SocketAddrT,
                  server: bool = False,
-                 nickname: Optional[str] = None):
+                 nickname: Optional[str] = None,
+                 events_maxlen: Optional[int] = None,
+                 events_overflow: str = 'drop-oldest'):
         """
         Create a QEMUMonitorProtocol class.
 
@@ -126,14 +293,21 @@ def __init__(self, address: SocketAddrT,
                         or a tuple in the form ( address, port ) for a TCP
                         connection
         @param server: server mode listens on the socket (bool)
+        @param events_maxlen: maximum number of events cached until they are
+                              pulled, or None for no limit (the default)
+        @param events_overflow: overflow policy of the event cache, see
+                                EventBuffer
         @raise OSError on socket connection errors
         @note No connection is established, this is done by the connect() or
               accept() methods
         """
-        self.__events: List[QMPMessage] = []
+        # pylint: disable=too-many-arguments
+        self.__events = EventBuffer(events_maxlen, events_overflow)
         self.__address = address
         self.__sock = self.__get_sock()
         self.__sockfile: Optional[TextIO] = None
+        # Last id generated by cmd_batch()
+        self.__batch_seq = 0
         self._nickname = nickname
         if self._nickname:
             self.logger = logging.getLogger('QMP').getChild(self._nickname)
@@ -308,6 +482,87 @@ def cmd_obj(self, qmp_cmd: QMPMessage) -> QMPMessage:
         self.logger.debug("<<< %s", resp)
         return resp
 
+    def cmd_batch(self, qmp_cmds: Sequence[QMPMessage]) -> List[QMPMessage]:
+        """
+        Send several QMP commands to the QMP Monitor at once.
+
+        The commands are written with a single send and the replies are
+        matched to the commands by id; commands without an id are given
+        one, distinct from the ids of the other commands, which is
+        removed from their reply.  A failing command does not prevent the
+        next ones from being executed.
+
+        @param qmp_cmds: QMP commands to be sent as Python dicts
+        @return QMP responses as Python dicts, in the order of the commands
+        @raise ValueError if two commands have the same id
+        @raise QMPProtocolError if a reply does not match any command; the
+               connection is closed, since the replies still pending
+               cannot be told apart
+        """
+        ids: Dict[str, int] = {}
+        for i, qmp_cmd in enumerate(qmp_cmds):
+            if 'id' in qmp_cmd:
+                key = json.dumps(qmp_cmd['id'], sort_keys=True)
+                if key in ids:
+                    raise ValueError(f"duplicate command id {key}")
+                ids[key] = i
+        tagged = []
+        for i, qmp_cmd in enumerate(qmp_cmds):
+            if 'id' not in qmp_cmd:
+                while True:
+                    self.__batch_seq += 1
+                    cmd_id = f"__batch-{self.__batch_seq}"
+                    key = json.dumps(cmd_id)
+                    if key not in ids:
+                        break
+                qmp_cmd = dict(qmp_cmd, id=cmd_id)
+                ids[key] = i
+            tagged.append(qmp_cmd)
+            self.logger.debug(">>> %s", qmp_cmd)
+        self.__sock.sendall(''.join(json.dumps(qmp_cmd)
+                                    for qmp_cmd in tagged).encode('utf-8'))
+
+        replies: List[Optional[QMPMessage]] = [None] * len(tagged)
+        for _ in tagged:
+            resp = self.__json_read()
+            if resp is None:
+                raise QMPConnectError("Unexpected empty reply from server")
+            self.logger.debug("<<< %s", resp)
+            i = ids.pop(json.dumps(resp.get('id'), sort_keys=True), -1)
+            if i < 0:
+                self.close()
+                raise QMPProtocolError(f"unexpected reply '{resp}'")
+            if 'id' not in qmp_cmds[i]:
+                del resp['id']
+            replies[i] = resp
+        return cast(List[QMPMessage], replies)
+
+    def command_batch(self, commands: Sequence[Tuple[str, Dict[str, object]]]
+                      ) -> List[QMPReturnValue]:
+        """
+        Build and send several QMP commands at once, see cmd_batch().
+
+        @param commands: (name, arguments) pairs
+        @return The return values of the commands, in order
+        @raise QMPBatchError if any command failed; all the commands are
+               executed regardless
+        """
+        qmp_cmds: List[QMPMessage] = []
+        for name, args in commands:
+            qmp_cmd: QMPMessage = {'execute': name}
+            if args:
+                qmp_cmd['arguments'] = args
+            qmp_cmds.append(qmp_cmd)
+        replies = self.cmd_batch(qmp_cmds)
+        if any('error' in reply for reply in replies):
+            raise QMPBatchError(replies)
+        for reply in replies:
+            if 'return' not in reply:
+                raise QMPProtocolError(
+                    f"'return' key not found in QMP response '{reply}'"
+                )
+        return [reply['return'] for reply in replies]
+
     def cmd(self, name: str,
             args: Optional[Dict[str, object]] = None,
             cmd_id: Optional[object] = None) -> QMPMessage:
@@ -350,14 +605,15 @@ def pull_event(self,
                                 period elapses.
         @raise QMPConnectError: If wait is True but no events could be
                                 retrieved or if some other error occurred.
+        @raise QMPEventOverflowError: If events were dropped because the
+                                      cache was full, with the 'error'
+                                      overflow policy.
 
         @return The first available QMP event, or None.
         """
         self.__get_events(wait)
 
-        if self.__events:
-            return self.__events.pop(0)
-        return None
+        return self.__events.pop()
 
     def get_events(self, wait: bool = False) -> List[QMPMessage]:
         """
@@ -370,17 +626,28 @@ def get_events(self, wait: bool = False) -> List[QMPMessage]:
                                 period elapses.
         @raise QMPConnectError: If wait is True but no events could be
                                 retrieved or if some other error occurred.
+        @raise QMPEventOverflowError: If events were dropped because the
+                                      cache was full, with the 'error'
+                                      overflow policy.
 
         @return The list of available QMP events.
         """
         self.__get_events(wait)
-        return self.__events
+        self.__events.check_overflow()
+        return list(self.__events)
 
     def clear_events(self) -> None:
         """
         Clear current list of pending events.
         """
-        self.__events = []
+        self.__events.clear()
+
+    @property
+    def events(self) -> EventBuffer:
+        """
+        The cache of pending events, with its counters.
+        """
+        return self.__events
 
     def close(self) -> None:
         """
@@ -0,0 +1,547 @@
+"""
+Asynchronous QEMU Monitor Protocol (QMP) client.
+
+This module provides `AsyncQEMUMonitorProtocol`, an asyncio counterpart
+of `QEMUMonitorProtocol`.  Commands are tagged with a unique 'id' and
+written without waiting for the previous reply, so any number of them
+may be in flight on one monitor; replies are routed back to their
+callers by id.  Events are delivered to `EventListener` objects, which
+are async iterators with optional name and predicate filters.
+
+A single event loop can drive many monitors at once, e.g.::
+
+    async def query_all(addresses):
+        monitors = [AsyncQEMUMonitorProtocol(addr) for addr in addresses]
+        await asyncio.gather(*(mon.connect() for mon in monitors))
+        return await asyncio.gather(*(mon.execute('query-status')
+                                      for mon in monitors))
+
+No threads are used.
+"""
+
+# This work is licensed under the terms of the GNU GPL, version 2 or later.
+# See the COPYING file in the top-level directory.
+
+import asyncio
+from collections import deque
+import itertools
+import json
+import logging
+from typing import (
+    Any,
+    AsyncIterator,
+    Callable,
+    Deque,
+    Dict,
+    Iterable,
+    List,
+    Optional,
+    Set,
+    Tuple,
+    Type,
+    TypeVar,
+)
+
+from . import (
+    QMPCapabilitiesError,
+    QMPConnectError,
+    QMPMessage,
+    QMPProtocolError,
+    QMPResponseError,
+    QMPReturnValue,
+    QMPTimeoutError,
+    SocketAddrT,
+)
+
+
+#: EventFilter is a predicate applied to events before they are queued.
+EventFilter = Callable[[QMPMessage], bool]
+
+# Largest QMP message accepted; query-qmp-schema replies are big.
+_READ_LIMIT = 16 * 1024 * 1024
+
+
+class EventListener:
+    """
+    Queue of QMP events received by an `AsyncQEMUMonitorProtocol`.
+
+    A listener receives the events whose name is in `names` (or all
+    events, if `names` is None) and for which `event_filter` returns
+    True.  It is an async iterator, which ends when the monitor is
+    disconnected::
+
+        with qmp.listen_events('BLOCK_JOB_COMPLETED') as listener:
+            await qmp.execute('blockdev-backup', ...)
+            async for event in listener:
+                ...
+
+    @param names: event names to receive, or None for all events
+    @param event_filter: optional predicate further selecting events
+    @param maxsize: maximum number of queued events; 0 is unbounded.
+                    Events arriving while the queue is full are counted
+                    in `dropped` and discarded.
+    """
+    # pylint: disable=too-many-instance-attributes
+
+    def __init__(self, names: Optional[Iterable[str]] = None,
+                 event_filter: Optional[EventFilter] = None,
+                 maxsize: int = 0):
+        self.names: Optional[Set[str]] = None
+        if names is not None:
+            self.names = {names} if isinstance(names, str) else set(names)
+        self.event_filter = event_filter
+        self.maxsize = maxsize
+        self.dropped = 0
+        self._queue: Deque[Optional[QMPMessage]] = deque()
+        # Futures of the get() calls waiting for an event
+        self._waiters: List['asyncio.Future[None]'] = []
+        self._closed = False
+        self._unregister: Optional[Callable[[], None]] = None
+
+    def accept(self, event: QMPMessage) -> bool:
+        """
+        Check if an event passes the filters of this listener.
+
+        @param event: QMP event
+        @return True if the event should be queued
+        """
+        if self.names is not None and event['event'] not in self.names:
+            return False
+        return self.event_filter is None or self.event_filter(event)
+
+    def _wakeup(self) -> None:
+        # Every waiter checks the queue again; those that find it empty
+        # go back to sleep
+        for waiter in self._waiters:
+            if not waiter.done():
+                waiter.set_result(None)
+
+    def put(self, event: QMPMessage) -> None:
+        """
+        Queue an event, or drop it if the queue is full.
+
+        @param event: QMP event
+        """
+        if self._closed:
+            return
+        if self.maxsize and len(self._queue) >= self.maxsize:
+            self.dropped += 1
+            return
+        self._queue.append(event)
+        self._wakeup()
+
+    def end(self) -> None:
+        """
+        Mark the end of the event stream; iteration stops after the
+        already queued events.
+        """
+        if not self._closed:
+            self._closed = True
+            self._queue.append(None)
+            self._wakeup()
+
+    def empty(self) -> bool:
+        """
+        @return True if no event is queued.
+        """
+        return not self._queue or self._queue[0] is None
+
+    def get_nowait(self) -> Optional[QMPMessage]:
+        """
+        @return The oldest queued event, or None if there is none.
+        """
+        if self.empty():
+            return None
+        return self._queue.popleft()
+
+    async def get(self, timeout: Optional[float] = None) -> QMPMessage:
+        """
+        Wait for and return the next event.  Several tasks may wait at
+        the same time; each event goes to one of them.
+
+        @param timeout: timeout in seconds, or None to wait forever
+        @raise QMPTimeoutError: if the timeout elapses
+        @raise QMPConnectError: if the monitor was disconnected
+        """
+        loop = asyncio.get_event_loop()
+        deadline = None if timeout is None else loop.time() + timeout
+        while not self._queue:
+            remaining = None
+            if deadline is not None:
+                remaining = max(deadline - loop.time(), 0.0)
+            waiter = loop.create_future()
+            self._waiters.append(waiter)
+            try:
+                await asyncio.wait_for(waiter, remaining)
+            except asyncio.TimeoutError as err:
+                raise QMPTimeoutError("Timeout waiting for event") from err
+            finally:
+                self._waiters.remove(waiter)
+        if self._queue[0] is None:
+            raise QMPConnectError("Monitor disconnected")
+        event = self._queue.popleft()
+        assert event is not None
+        return event
+
+    def clear(self) -> None:
+        """
+        Discard all queued events.
+        """
+        ended = self._closed
+        self._queue.clear()
+        if ended:
+            self._queue.append(None)
+
+    def __aiter__(self) -> AsyncIterator[QMPMessage]:
+        return self
+
+    async def __anext__(self) -> QMPMessage:
+        try:
+            return await self.get()
+        except QMPConnectError:
+            raise StopAsyncIteration from None
+
+    T = TypeVar('T')
+
+    def __enter__(self: T) -> T:
+        return self
+
+    def __exit__(self, *exc: Any) -> None:
+        self.close()
+
+    def close(self) -> None:
+        """
+        Stop receiving events.
+        """
+        if self._unregister is not None:
+            self._unregister()
+            self._unregister = None
+        self.end()
+
+
+class AsyncQEMUMonitorProtocol:
+    """
+    Asyncio client for the QEMU Monitor Protocol, supporting concurrent
+    commands and event listeners on a single connection.
+
+    @param address: QEMU address, can be either a unix socket path (string)
+                    or a tuple in the form ( address, port ) for a TCP
+                    connection
+    @param nickname: optional name used in log messages
+    @note No connection is established, this is done by the connect() or
+          accept() coroutines.
+    """
+    # pylint: disable=too-many-instance-attributes
+
+    #: Logger object for debugging messages
+    logger = logging.getLogger('QMP')
+
+    def __init__(self, address: SocketAddrT,
+                 nickname: Optional[str] = None):
+        self._address = address
+        self._nickname = nickname
+        if self._nickname:
+            self.logger = logging.getLogger('QMP').getChild(self._nickname)
+        self._reader: Optional[asyncio.StreamReader] = None
+        self._writer: Optional[asyncio.StreamWriter] = None
+        self._server: Optional[asyncio.AbstractServer] = None
+        self._accepted: Optional['asyncio.Future[Tuple[Any, Any]]'] = None
+        self._reader_task: Optional['asyncio.Future[None]'] = None
+        self._drain_lock: Optional[asyncio.Lock] = None
+        self._pending: Dict[str, 'asyncio.Future[QMPMessage]'] = {}
+        self._listeners: List[EventListener] = []
+        self._ids = itertools.count()
+        self._error: Optional[BaseException] = None
+        self.greeting: Optional[QMPMessage] = None
+
+    @property
+    def connected(self) -> bool:
+        """True while the connection is established."""
+        return self._writer is not None and self._error is None
+
+    @property
+    def pending(self) -> int:
+        """Number of commands waiting for a reply."""
+        return len(self._pending)
+
+    async def connect(self, negotiate: bool = True) -> Optional[QMPMessage]:
+        """
+        Connect to the QMP Monitor and perform capabilities negotiation.
+
+        @return QMP greeting dict, or None if negotiate is false
+        @raise OSError on socket connection errors
+        @raise QMPConnectError if the greeting is not received
+        @raise QMPCapabilitiesError if fails to negotiate capabilities
+        """
+        if isinstance(self._address, tuple):
+            host, port = self._address
+            streams = await asyncio.open_connection(host, port,
+                                                    limit=_READ_LIMIT)
+        else:
+            streams = await asyncio.open_unix_connection(self._address,
+                                                         limit=_READ_LIMIT)
+        return await self._start(streams, negotiate)
+
+    async def listen(self) -> None:
+        """
+        Listen on the address for a connection from a QMP Monitor, to be
+        completed with accept().  QEMU must be started after this
+        coroutine returns and before accept() is awaited.
+
+        @raise OSError on socket errors
+        """
+        loop = asyncio.get_event_loop()
+        accepted: 'asyncio.Future[Tuple[Any, Any]]' = loop.create_future()
+
+        def client_connected(reader: asyncio.StreamReader,
+                             writer: asyncio.StreamWriter) -> None:
+            if accepted.done():
+                writer.close()
+            else:
+                accepted.set_result((reader, writer))
+
+        if isinstance(self._address, tuple):
+            host, port = self._address
+            self._server = await asyncio.start_server(
+                client_connected, host, port, limit=_READ_LIMIT)
+        else:
+            self._server = await asyncio.start_unix_server(
+                client_connected, self._address, limit=_READ_LIMIT)
+        self._accepted = accepted
+
+    async def accept(self, timeout: Optional[float] = 15.0) -> QMPMessage:
+        """
+        Await connection from QMP Monitor and perform capabilities
+        negotiation.  listen() must have been awaited before.
+
+        @param timeout: timeout in seconds, or None to wait forever
+        @return QMP greeting dict
+        @raise QMPTimeoutError if no connection arrives in time
+        @raise QMPConnectError if the greeting is not received
+        @raise QMPCapabilitiesError if fails to negotiate capabilities
+        """
+        assert self._server is not None and self._accepted is not None
+        try:
+            streams = await asyncio.wait_for(self._accepted, timeout)
+        except asyncio.TimeoutError as err:
+            raise QMPTimeoutError("Timeout waiting for connection") from err
+        finally:
+            self._server.close()
+            self._server = None
+            self._accepted = None
+        greeting = await self._start(streams, True)
+        assert greeting is not None
+        return greeting
+
+    async def _start(self, streams: Tuple[asyncio.StreamReader,
+                                          asyncio.StreamWriter],
+                     negotiate: bool) -> Optional[QMPMessage]:
+        self._reader, self._writer = streams
+        self._error = None
+        self._drain_lock = asyncio.Lock()
+        try:
+            greeting = await self._read_message()
+            if greeting is None or "QMP" not in greeting:
+                raise QMPConnectError
+            self.greeting = greeting
+            self._reader_task = asyncio.ensure_future(self._read_loop())
+            if not negotiate:
+                return None
+            resp = await self.execute_msg({'execute': 'qmp_capabilities'})
+            if "return" not in resp:
+                raise QMPCapabilitiesError
+        except BaseException:
+            await self.disconnect()
+            raise
+        return greeting
+
+    async def _read_message(self) -> Optional[QMPMessage]:
+        assert self._reader is not None
+        data = await self._reader.readline()
+        if not data:
+            return None
+        # By definition, any JSON received from QMP is a QMPMessage,
+        # and we are asserting only at static analysis time that it
+        # has a particular shape.
+        msg: QMPMessage = json.loads(data)
+        self.logger.debug("<<< %s", msg)
+        return msg
+
+    async def _read_loop(self) -> None:
+        error: BaseException
+        try:
+            while True:
+                msg = await self._read_message()
+                if msg is None:
+                    error = QMPConnectError("Connection closed by server")
+                    break
+                if 'event' in msg:
+                    self._dispatch_event(msg)
+                    continue
+                future = self._pending.pop(str(msg.get('id')), None)
+                if future is None:
+                    self.logger.warning("Reply to unknown command: %s", msg)
+                elif not future.done():
+                    future.set_result(msg)
+        except asyncio.CancelledError:
+            return
+        except (OSError, ValueError) as err:
+            error = QMPConnectError("Error while reading from socket")
+            error.__cause__ = err
+        self._fail(error)
+
+    def _dispatch_event(self, event: QMPMessage) -> None:
+        for listener in self._listeners:
+            if listener.accept(event):
+                listener.put(event)
+
+    def _fail(self, error: BaseException) -> None:
+        if self._error is None:
+            self._error = error
+        pending, self._pending = self._pending, {}
+        for future in pending.values():
+            if not future.done():
+                future.set_exception(error)
+        for listener in self._listeners:
+            listener.end()
+
+    def listen_events(self, names: Optional[Iterable[str]] = None,
+                      event_filter: Optional[EventFilter] = None,
+                      maxsize: int = 0) -> EventListener:
+        """
+        Register a new event listener.  Only events received after the
+        registration are delivered to it.
+
+        @param names: event name or names to receive, or None for all
+        @param event_filter: optional predicate further selecting events
+        @param maxsize: maximum number of queued events; 0 is unbounded
+        @return The registered `EventListener`; close it, or use it as a
+                context manager, to unregister it.
+        """
+        listener = EventListener(names, event_filter, maxsize)
+        self._listeners.append(listener)
+        listener._unregister = (  # pylint: disable=protected-access
+            lambda: self._listeners.remove(listener))
+        if self._error is not None:
+            listener.end()
+        return listener
+
+    async def wait_event(self, names: Optional[Iterable[str]] = None,
+                         event_filter: Optional[EventFilter] = None,
+                         timeout: Optional[float] = None) -> QMPMessage:
+        """
+        Wait for the next event matching the given filters.
+
+        @param names: event name or names to wait for, or None for any
+        @param event_filter: optional predicate further selecting events
+        @param timeout: timeout in seconds, or None to wait forever
+        @raise QMPTimeoutError: if the timeout elapses
+        @raise QMPConnectError: if the monitor was disconnected
+        """
+        with self.listen_events(names, event_filter, 1) as listener:
+            return await listener.get(timeout)
+
+    async def execute_msg(self, qmp_cmd: QMPMessage,
+                          timeout: Optional[float] = None) -> QMPMessage:
+        """
+        Send a QMP command and wait for its reply.  Other commands may be
+        sent, and their replies received, while this one is pending.
+
+        The command is tagged with a unique 'id'; an 'id' provided by the
+        caller is restored in the returned reply.
+
+        @param qmp_cmd: QMP command to be sent as a Python dict
+        @param timeout: timeout in seconds, or None to wait forever
+        @return QMP response as a Python dict
+        @raise QMPConnectError if the connection is lost or not established
+        @raise QMPTimeoutError if the timeout elapses
+        """
+        if self._writer is None or self._error is not None:
+            raise QMPConnectError("Not connected")
+        assert self._drain_lock is not None
+        tag = f"aqmp-{next(self._ids)}"
+        future: 'asyncio.Future[QMPMessage]'
+        future = asyncio.get_event_loop().create_future()
+        self._pending[tag] = future
+        msg = dict(qmp_cmd, id=tag)
+        self.logger.debug(">>> %s", msg)
+        try:
+            self._writer.write(json.dumps(msg).encode('utf-8'))
+            async with self._drain_lock:
+                await self._writer.drain()
+            resp = await asyncio.wait_for(asyncio.shield(future), timeout)
+        except asyncio.TimeoutError as err:
+            raise QMPTimeoutError("Timeout waiting for reply") from err
+        except OSError as err:
+            self._fail(QMPConnectError("Error while writing to socket"))
+            raise QMPConnectError("Error while writing to socket") from err
+        finally:
+            # A timed-out or cancelled command's reply is discarded.
+            self._pending.pop(tag, None)
+        if 'id' in qmp_cmd:
+            resp['id'] = qmp_cmd['id']
+        else:
+            del resp['id']
+        return resp
+
+    async def cmd(self, name: str,
+                  args: Optional[Dict[str, object]] = None,
+                  timeout: Optional[float] = None) -> QMPMessage:
+        """
+        Build a QMP command, send it and wait for its reply.
+
+        @param name: command name (string)
+        @param args: command arguments (dict)
+        @param timeout: timeout in seconds, or None to wait forever
+        @return QMP response as a Python dict
+        """
+        qmp_cmd: QMPMessage = {'execute': name}
+        if args:
+            qmp_cmd['arguments'] = args
+        return await self.execute_msg(qmp_cmd, timeout)
+
+    async def execute(self, cmd: str, **kwds: object) -> QMPReturnValue:
+        """
+        Build and send a QMP command to the monitor, report errors if any
+
+        @raise QMPResponseError if the command failed
+        """
+        # pylint: disable=duplicate-code
+        ret = await self.cmd(cmd, kwds)
+        if 'error' in ret:
+            raise QMPResponseError(ret)
+        if 'return' not in ret:
+            raise QMPProtocolError(
+                f"'return' key not found in QMP response '{ret}'"
+            )
+        return ret['return']
+
+    async def disconnect(self) -> None:
+        """
+        Close the connection.  Pending commands fail with QMPConnectError
+        and event listeners stop iterating.
+        """
+        if self._reader_task is not None:
+            task, self._reader_task = self._reader_task, None
+            task.cancel()
+            try:
+                await task
+            except asyncio.CancelledError:
+                pass
+        if self._writer is not None:
+            self._writer.close()
+            self._writer = None
+        self._reader = None
+        if self._server is not None:
+            self._server.close()
+            self._server = None
+        self._fail(QMPConnectError("Disconnected"))
+
+    T = TypeVar('T')
+
+    async def __aenter__(self: T) -> T:
+        return self
+
+    async def __aexit__(self, exc_type: Optional[Type[BaseException]],
+                        *exc: Any) -> None:
+        await self.disconnect()
@@ -0,0 +1,449 @@
+"""
+QMP connection pool.
+
+`QMPPool` keeps one negotiated `QEMUMonitorProtocol` session open per
+monitor, so that callers do not pay for the greeting and the
+qmp_capabilities handshake on every operation.  Sessions are shared
+safely between threads, health-checked while idle and re-established
+transparently after a failure.  Each monitor records a histogram of its
+command latencies.
+
+Monitors are registered by name with the address of a monitor QEMU
+listens on (``-qmp unix:PATH,server=on,wait=off``), since only those
+accept new connections after a failure; a `QEMUMachine` can be
+given such a monitor in addition to its own with add_args().  An
+already connected session can be handed over to the pool too, but is
+not re-established if it breaks.  It must then only be used through the
+pool: the pool's lock does not serialize the owner's direct use of the
+session.  In particular, do not hand over the session of a
+`QEMUMachine`, which uses it for its own commands and events::
+
+    vm.add_args('-qmp', 'unix:/run/vm0.qmp,server=on,wait=off')
+    vm.launch()
+    with QMPPool(keepalive=10.0) as pool:
+        pool.add('vm0', '/run/vm0.qmp')
+        pool.command('vm0', 'stop')
+        print(pool.monitor('vm0').latency.summary())
+"""
+
+# This work is licensed under the terms of the GNU GPL, version 2 or later.
+# See the COPYING file in the top-level directory.
+
+import bisect
+import logging
+import threading
+import time
+from types import TracebackType
+from typing import (
+    Callable,
+    Dict,
+    List,
+    Optional,
+    Sequence,
+    Type,
+    TypeVar,
+)
+
+from . import (
+    QEMUMonitorProtocol,
+    QMPConnectError,
+    QMPError,
+    QMPMessage,
+    QMPProtocolError,
+    QMPResponseError,
+    QMPReturnValue,
+    SocketAddrT,
+)
+
+
+LOG = logging.getLogger(__name__)
+
+T = TypeVar('T')
+
+
+class LatencyHistogram:
+    """
+    Histogram of latencies with power-of-two microsecond buckets.
+
+    Bucket N counts the samples below 2**N microseconds that do not fit
+    in bucket N-1; the last bucket holds all the slower samples.
+    """
+    #: Upper bounds of the buckets, in seconds.
+    BOUNDS: List[float] = [(1 << n) / 1e6 for n in range(25)]
+
+    def __init__(self) -> None:
+        self.counts = [0] * (len(self.BOUNDS) + 1)
+        self.count = 0
+        self.total = 0.0
+        self.max = 0.0
+
+    def record(self, seconds: float) -> None:
+        """
+        Add one sample.
+
+        @param seconds: latency in seconds
+        """
+        self.counts[bisect.bisect_right(self.BOUNDS, seconds)] += 1
+        self.count += 1
+        self.total += seconds
+        self.max = max(self.max, seconds)
+
+    def percentile(self, pct: float) -> float:
+        """
+        Estimate a percentile of the samples.
+
+        @param pct: percentile, between 0 and 100
+        @return The upper bound of the bucket containing the percentile,
+                in seconds (or the largest sample, if that is lower).
+        """
+        if not self.count:
+            return 0.0
+        rank = pct / 100 * self.count
+        seen = 0
+        for i, count in enumerate(self.counts):
+            seen += count
+            if count and seen >= rank:
+                if i < len(self.BOUNDS):
+                    return min(self.BOUNDS[i], self.max)
+                break
+        return self.max
+
+    def buckets(self) -> List[List[float]]:
+        """
+        @return A list of [upper bound in seconds, count] pairs for the
+                non-empty buckets; the bound of the last bucket is inf.
+        """
+        bounds = self.BOUNDS + [float('inf')]
+        return [[bound, count]
+                for bound, count in zip(bounds, self.counts) if count]
+
+    def summary(self) -> Dict[str, float]:
+        """
+        @return The number of samples, mean, p50, p90, p99 and maximum
+                latency, in seconds.
+        """
+        return {
+            'count': self.count,
+            'mean': self.total / self.count if self.count else 0.0,
+            'p50': self.percentile(50),
+            'p90': self.percentile(90),
+            'p99': self.percentile(99),
+            'max': self.max,
+        }
+
+
+class PooledMonitor:
+    """
+    A shared QMP session with one monitor.
+
+    Commands are serialized with a lock, so a PooledMonitor may be used
+    from several threads.  Events received on a session opened by the
+    PooledMonitor are discarded; those received on a `connection` are
+    kept for its owner.
+
+    @param name: name of the monitor, used in log messages
+    @param address: address of a QMP monitor in server mode, or None if
+                    `connection` is given
+    @param connection: an already negotiated session to use; it is not
+                       re-established after a failure, and must not be
+                       used other than through the PooledMonitor
+    @param timeout: socket timeout of the session, in seconds
+    """
+    # pylint: disable=too-many-instance-attributes
+
+    def __init__(self, name: str,
+                 address: Optional[SocketAddrT] = None,
+                 connection: Optional[QEMUMonitorProtocol] = None,
+                 timeout: Optional[float] = 15.0):
+        assert (address is None) != (connection is None)
+        self.name = name
+        self.address = address
+        self.timeout = timeout
+        self.latency = LatencyHistogram()
+        self.errors = 0
+        self.reconnects = 0
+        self.last_used = 0.0
+        self.greeting: Optional[QMPMessage] = None
+        self._lock = threading.RLock()
+        self._conn = connection
+
+    def _connect(self) -> QEMUMonitorProtocol:
+        if self._conn is not None:
+            return self._conn
+        if self.address is None:
+            raise QMPConnectError(f"monitor '{self.name}' is disconnected")
+        conn = QEMUMonitorProtocol(self.address, nickname=self.name)
+        try:
+            conn.settimeout(self.timeout)
+            self.greeting = conn.connect()
+        except BaseException:
+            conn.close()
+            raise
+        if self.last_used:
+            self.reconnects += 1
+            LOG.debug("%s: reconnected", self.name)
+        self._conn = conn
+        self.last_used = time.monotonic()
+        return conn
+
+    def _drop(self) -> None:
+        if self._conn is not None and self.address is not None:
+            self._conn.close()
+            self._conn = None
+
+    @property
+    def connected(self) -> bool:
+        """True if a session is currently open."""
+        return self._conn is not None
+
+    def _call(self, send: Callable[[QEMUMonitorProtocol], T],
+              retry: bool) -> T:
+        with self._lock:
+            for attempt in (False, True):
+                conn = self._connect()
+                start = time.monotonic()
+                try:
+                    resp = send(conn)
+                except (OSError, QMPError):
+                    self.errors += 1
+                    self._drop()
+                    if attempt or not retry or self.address is None:
+                        raise
+                    continue
+                finally:
+                    self.last_used = time.monotonic()
+                self.latency.record(self.last_used - start)
+                if self.address is not None:
+                    # Nobody else consumes the events of our own sessions
+                    conn.clear_events()
+                return resp
+        raise AssertionError("unreachable")
+
+    def cmd_obj(self, qmp_cmd: QMPMessage,
+                retry: bool = False) -> QMPMessage:
+        """
+        Send a QMP command and return its response, (re)connecting first
+        if needed.
+
+        If the session fails, it is closed and re-established on the next
+        call.  The failed command is sent again on a new session only if
+        `retry` is True; this is safe for commands without side effects.
+
+        @param qmp_cmd: QMP command to be sent as a Python dict
+        @param retry: resend the command once if the session failed
+        @return QMP response as a Python dict
+        @raise OSError, QMPError on connection errors
+        """
+        return self._call(lambda conn: conn.cmd_obj(qmp_cmd), retry)
+
+    def cmd_batch(self, qmp_cmds: Sequence[QMPMessage],
+                  retry: bool = False) -> List[QMPMessage]:
+        """
+        Send several QMP commands at once, see cmd_obj() and
+        QEMUMonitorProtocol.cmd_batch().  The latency of the whole batch is
+        recorded as one sample.
+
+        @param qmp_cmds: QMP commands to be sent as Python dicts
+        @param retry: resend the commands once if the session failed
+        @return QMP responses as Python dicts, in the order of the commands
+        """
+        return self._call(lambda conn: conn.cmd_batch(qmp_cmds), retry)
+
+    def cmd(self, name: str,
+            args: Optional[Dict[str, object]] = None,
+            retry: bool = False) -> QMPMessage:
+        """
+        Build a QMP command and send it, see cmd_obj().
+
+        @param name: command name (string)
+        @param args: command arguments (dict)
+        @param retry: resend the command once if the session failed
+        """
+        qmp_cmd: QMPMessage = {'execute': name}
+        if args:
+            qmp_cmd['arguments'] = args
+        return self.cmd_obj(qmp_cmd, retry)
+
+    def command(self, cmd: str, **kwds: object) -> QMPReturnValue:
+        """
+        Build and send a QMP command to the monitor, report errors if any
+        """
+        # pylint: disable=duplicate-code
+        ret = self.cmd(cmd, kwds)
+        if 'error' in ret:
+            raise QMPResponseError(ret)
+        if 'return' not in ret:
+            raise QMPProtocolError(
+                f"'return' key not found in QMP response '{ret}'"
+            )
+        return ret['return']
+
+    def health_check(self, idle: float = 0.0) -> bool:
+        """
+        Ping the monitor if it has been idle for at least `idle` seconds,
+        re-establishing the session if needed.  A monitor that is busy
+        with a command is assumed to be healthy.
+
+        @param idle: minimum idle time, in seconds
+        @return False if the monitor did not respond.
+        """
+        if not self._lock.acquire(blocking=False):  # pylint: disable=R1732
+            return True
+        try:
+            if self._conn and time.monotonic() - self.last_used < idle:
+                return True
+            self.cmd('query-version', retry=True)
+            return True
+        except (OSError, QMPError) as err:
+            LOG.debug("%s: health check failed: %s", self.name, err)
+            return False
+        finally:
+            self._lock.release()
+
+    def close(self) -> None:
+        """
+        Close the session.  A shared connection is left open.
+        """
+        with self._lock:
+            self._drop()
+
+
+class QMPPool:
+    """
+    A set of shared QMP sessions, indexed by name.
+
+    @param keepalive: if not None, a background thread health-checks the
+                      monitors idle for this many seconds, at the same
+                      interval
+    @param timeout: socket timeout of the sessions, in seconds
+    """
+    def __init__(self, keepalive: Optional[float] = None,
+                 timeout: Optional[float] = 15.0):
+        self.timeout = timeout
+        self._monitors: Dict[str, PooledMonitor] = {}
+        self._lock = threading.Lock()
+        self._stop = threading.Event()
+        self._thread: Optional[threading.Thread] = None
+        if keepalive is not None:
+            self._thread = threading.Thread(target=self._keepalive,
+                                            args=(keepalive,),
+                                            name='qmp-pool-keepalive',
+                                            daemon=True)
+            self._thread.start()
+
+    def add(self, name: str, address: Optional[SocketAddrT] = None,
+            connection: Optional[QEMUMonitorProtocol] = None
+            ) -> PooledMonitor:
+        """
+        Register a monitor.  Exactly one of `address` and `connection`
+        must be given; the session is only opened on first use.
+
+        @param name: unique name of the monitor
+        @param address: address of a QMP monitor in server mode
+        @param connection: an already negotiated session to hand over, see
+                           PooledMonitor
+        @return The new PooledMonitor
+        @raise ValueError if the name is already registered
+        """
+        monitor = PooledMonitor(name, address, connection, self.timeout)
+        with self._lock:
+            if name in self._monitors:
+                raise ValueError(f"monitor '{name}' already registered")
+            self._monitors[name] = monitor
+        return monitor
+
+    def remove(self, name: str) -> None:
+        """
+        Unregister a monitor and close its session.
+
+        @param name: name of the monitor
+        """
+        with self._lock:
+            monitor = self._monitors.pop(name)
+        monitor.close()
+
+    def monitor(self, name: str) -> PooledMonitor:
+        """
+        @param name: name of the monitor
+        @return The PooledMonitor registered with this name
+        @raise KeyError if there is none
+        """
+        with self._lock:
+            return self._monitors[name]
+
+    def names(self) -> List[str]:
+        """
+        @return The names of the registered monitors.
+        """
+        with self._lock:
+            return list(self._monitors)
+
+    def cmd(self, name: str, cmd: str,
+            args: Optional[Dict[str, object]] = None,
+            retry: bool = False) -> QMPMessage:
+        """
+        Send a QMP command to a monitor, see PooledMonitor.cmd_obj().
+
+        @param name: name of the monitor
+        @param cmd: command name (string)
+        @param args: command arguments (dict)
+        @param retry: resend the command once if the session failed
+        """
+        return self.monitor(name).cmd(cmd, args, retry)
+
+    def command(self, name: str, cmd: str, **kwds: object) -> QMPReturnValue:
+        """
+        Send a QMP command to a monitor, report errors if any
+
+        @param name: name of the monitor
+        @param cmd: command name (string)
+        """
+        return self.monitor(name).command(cmd, **kwds)
+
+    def health_check(self, idle: float = 0.0) -> Dict[str, bool]:
+        """
+        Health-check the monitors idle for at least `idle` seconds.
+
+        @param idle: minimum idle time, in seconds
+        @return A dict mapping monitor names to their health.
+        """
+        with self._lock:
+            monitors = list(self._monitors.values())
+        return {monitor.name: monitor.health_check(idle)
+                for monitor in monitors}
+
+    def latency(self) -> Dict[str, Dict[str, float]]:
+        """
+        @return A dict mapping monitor names to the summary of their
+                command latency histogram.
+        """
+        with self._lock:
+            monitors = list(self._monitors.values())
+        return {monitor.name: monitor.latency.summary()
+                for monitor in monitors}
+
+    def _keepalive(self, interval: float) -> None:
+        while not self._stop.wait(interval):
+            self.health_check(interval)
+
+    def close(self) -> None:
+        """
+        Stop the keepalive thread and close all sessions.
+        """
+        self._stop.set()
+        if self._thread is not None:
+            self._thread.join()
+            self._thread = None
+        with self._lock:
+            monitors, self._monitors = self._monitors, {}
+        for monitor in monitors.values():
+            monitor.close()
+
+    def __enter__(self: T) -> T:
+        return self
+
+    def __exit__(self,
+                 exc_type: Optional[Type[BaseException]],
+                 exc_val: Optional[BaseException],
+                 exc_tb: Optional[TracebackType]) -> None:
+        self.close()
@@ -1,7 +1,7 @@
 """
 QEMU Object Model testing tools.
 
-usage: qom [-h] {set,get,list,tree,fuse} ...
+usage: qom [-h] {set,get,list,tree,dump,fuse} ...
 
 Query and manipulate QOM data
 
@@ -9,11 +9,12 @@
   -h, --help           show this help message and exit
 
 QOM commands:
-  {set,get,list,tree,fuse}
+  {set,get,list,tree,dump,fuse}
     set                Set a QOM property value
     get                Get a QOM property value
     list               List QOM properties at a given path
     tree               Show QOM tree from a given path
+    dump               Dump QOM objects and property values as JSON lines
     fuse               Mount a QOM tree as a FUSE filesystem
 """
 ##
@@ -31,9 +32,19 @@
 ##
 
 import argparse
+from fnmatch import fnmatchcase
+import json
+import sys
+from typing import (
+    Dict,
+    List,
+    Optional,
+    Set,
+    Tuple,
+)
 
-from . import QMPResponseError
-from .qom_common import QOMCommand
+from . import QMPMessage, QMPResponseError
+from .qom_common import ObjectPropertyInfo, QOMCommand
 
 
 try:
@@ -248,6 +259,216 @@ def run(self) -> int:
         return 0
 
 
+class QOMDump(QOMCommand):
+    """
+    QOM Command - Dump objects and property values as JSON lines.
+
+    usage: qom-dump [-h] [--socket SOCKET] [--property GLOB]
+                    [--follow-links] [--batch-size N] [<path> ...]
+
+    Dump QOM objects and property values as JSON lines
+
+    positional arguments:
+      <path>                QOM path or glob; the matching objects and all
+                            the objects below them are dumped (default: /)
+
+    optional arguments:
+      -h, --help            show this help message and exit
+      --socket SOCKET, -s SOCKET
+                            QMP socket path or address (addr:port). May also be
+                            set via QMP_SOCKET environment variable.
+      --property GLOB, -p GLOB
+                            only dump the properties matching GLOB; may be
+                            given several times
+      --follow-links        also dump the objects that the dumped link
+                            properties point to
+      --batch-size N        number of QMP commands sent at once (default: 256)
+
+    Each object is printed as a JSON object on its own line, with its
+    "path", the names of its "children", the values of its other
+    "properties" and the "errors" for the properties that could not be
+    read.  The tree is walked breadth-first, one batch of qom-list and
+    qom-get commands per level, and each object is dumped only once.
+    """
+    name = 'dump'
+    help = 'Dump QOM objects and property values as JSON lines'
+
+    @classmethod
+    def configure_parser(cls, parser: argparse.ArgumentParser) -> None:
+        super().configure_parser(parser)
+        parser.add_argument(
+            'paths',
+            metavar='<path>',
+            nargs='*',
+            help='QOM path or glob; the matching objects and all the objects '
+            'below them are dumped (default: /)',
+        )
+        parser.add_argument(
+            '--property', '-p',
+            metavar='GLOB',
+            dest='properties',
+            action='append',
+            help='only dump the properties matching GLOB; may be given '
+            'several times',
+        )
+        parser.add_argument(
+            '--follow-links',
+            action='store_true',
+            help='also dump the objects that the dumped link properties '
+            'point to',
+        )
+        parser.add_argument(
+            '--batch-size',
+            metavar='N',
+            type=int,
+            default=256,
+            help='number of QMP commands sent at once (default: 256)',
+        )
+
+    def __init__(self, args: argparse.Namespace):
+        super().__init__(args)
+        self.patterns: List[str] = args.paths or ['/']
+        self.properties: Optional[List[str]] = args.properties
+        self.follow_links: bool = args.follow_links
+        self.batch_size: int = args.batch_size
+        self.link_targets: Set[str] = set()
+        self.dumped: Set[str] = set()
+        # The walk starts at the longest glob-free prefix of each pattern
+        self.roots: List[str] = []
+        for pattern in self.patterns:
+            root = []
+            for component in pattern.rstrip('/').split('/')[1:]:
+                if any(c in component for c in '*?['):
+                    break
+                root.append(component)
+            self.roots.append('/' + '/'.join(root))
+
+    @staticmethod
+    def _join(path: str, name: str) -> str:
+        return f"{path.rstrip('/')}/{name}"
+
+    @staticmethod
+    def _below(inner: str, outer: str) -> bool:
+        return inner == outer or inner.startswith(outer.rstrip('/') + '/')
+
+    def _selected(self, path: str) -> bool:
+        """Is the object at path, or one of its ancestors, matched?"""
+        if path in self.link_targets:
+            return True
+        return any(fnmatchcase(path, pattern) or
+                   fnmatchcase(path, pattern.rstrip('/') + '/*')
+                   for pattern in self.patterns)
+
+    def _worth_walking(self, path: str) -> bool:
+        """May the object at path or its descendants be matched?"""
+        return any(self._below(path, root) or self._below(root, path)
+                   for root in self.roots)
+
+    def _wanted(self, prop: str) -> bool:
+        return self.properties is None or any(
+            fnmatchcase(prop, pattern) for pattern in self.properties)
+
+    def _batch(self, cmd: str,
+               arguments: List[Dict[str, object]]) -> List[QMPMessage]:
+        replies: List[QMPMessage] = []
+        for i in range(0, len(arguments), self.batch_size):
+            replies.extend(self.qmp.cmd_batch([
+                {'execute': cmd, 'arguments': args}
+                for args in arguments[i:i + self.batch_size]
+            ]))
+        return replies
+
+    def _dump_level(self, frontier: List[str],
+                    seen: Set[str]) -> List[str]:
+        """
+        Dump the objects of one level of the walk.
+
+        :return: the paths of the objects of the next level.
+        """
+        listings = self._batch('qom-list', [{'path': path}
+                                            for path in frontier])
+        next_frontier = []
+        objects: List[Tuple[str, List[ObjectPropertyInfo]]] = []
+        for path, reply in zip(frontier, listings):
+            if 'error' in reply:
+                print(f"{path}: {QMPResponseError(reply)!s}", file=sys.stderr)
+                continue
+            items = [ObjectPropertyInfo.make(x) for x in reply['return']]
+            for item in items:
+                child = self._join(path, item.name)
+                if (item.child and child not in seen and
+                        self._worth_walking(child)):
+                    seen.add(child)
+                    next_frontier.append(child)
+            if self._selected(path):
+                objects.append((path, items))
+        # Link targets that were already walked are listed again
+        pending = set(next_frontier)
+        for target in self._dump_objects(objects):
+            if target not in pending:
+                seen.add(target)
+                next_frontier.append(target)
+        return next_frontier
+
+    def _dump_objects(self, objects: List[Tuple[str,
+                                                List[ObjectPropertyInfo]]]
+                      ) -> List[str]:
+        """
+        Read the properties of the given objects and dump them.
+
+        :return: the paths of the link targets to walk next.
+        """
+        targets: List[str] = []
+        gets = [(path, item) for path, items in objects for item in items
+                if not item.child and (self._wanted(item.name) or
+                                       (item.link and self.follow_links))]
+        values = self._batch('qom-get', [{'path': path, 'property': item.name}
+                                         for path, item in gets])
+        dumps: Dict[str, Dict[str, object]] = {}
+        for path, items in objects:
+            self.dumped.add(path)
+            dumps[path] = {
+                'path': path,
+                'children': [item.name for item in items if item.child],
+                'properties': {},
+                'errors': {},
+            }
+        for (path, item), reply in zip(gets, values):
+            if 'error' in reply:
+                key, value = 'errors', str(QMPResponseError(reply))
+            else:
+                key, value = 'properties', reply['return']
+                if item.link and self.follow_links and value:
+                    targets.append(str(value))
+
+            if self._wanted(item.name):
+                dump = dumps[path][key]
+                assert isinstance(dump, dict)
+                dump[item.name] = value
+        for dump in dumps.values():
+            print(json.dumps(dump))
+        sys.stdout.flush()
+
+        # Objects reachable through several links are dumped once, under
+        # their canonical path.
+        targets = [target for target in dict.fromkeys(targets)
+                   if target not in self.dumped and
+                   target not in self.link_targets]
+        self.link_targets.update(targets)
+        return targets
+
+    def run(self) -> int:
+        seen: Set[str] = set()
+        frontier: List[str] = []
+        for root in sorted(set(self.roots), key=len):
+            if not any(self._below(root, path) for path in frontier):
+                frontier.append(root)
+        seen.update(frontier)
+        while frontier:
+            frontier = self._dump_level(frontier, seen)
+        return 0
+
+
 def main() -> int:
     """QOM script main entry point."""
     parser = argparse.ArgumentParser(
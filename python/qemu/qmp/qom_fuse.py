@@ -7,7 +7,8 @@
 This script requires the 'fusepy' python package.
 
 
-usage: qom-fuse [-h] [--socket SOCKET] <mount>
+usage: qom-fuse [-h] [--socket SOCKET] [--cache-ttl SECONDS]
+                [--extra-socket SOCKET] [--connections N] <mount>
 
 Mount a QOM tree as a FUSE filesystem
 
@@ -19,6 +20,16 @@
   --socket SOCKET, -s SOCKET
                         QMP socket path or address (addr:port). May also be
                         set via QMP_SOCKET environment variable.
+  --cache-ttl SECONDS   How long QOM listings are cached (default: 2.0).
+                        0 disables the cache.
+  --extra-socket SOCKET
+                        Additional QMP socket path or address, for another
+                        QMP monitor of the same QEMU. May be repeated.
+  --connections N       Number of QMP connections serving concurrent
+                        requests, one per socket (default: all sockets).
+
+A QMP monitor serves one client at a time, so each connection needs a
+monitor of its own, e.g. several -qmp options on the QEMU command line.
 """
 ##
 # Copyright IBM, Corp. 2012
@@ -33,27 +44,88 @@
 ##
 
 import argparse
+from contextlib import contextmanager
 from errno import ENOENT, EPERM
+import queue
 import stat
 import sys
+import threading
+import time
 from typing import (
     IO,
     Dict,
     Iterator,
+    List,
     Mapping,
     Optional,
+    Tuple,
     Union,
 )
 
 import fuse
 from fuse import FUSE, FuseOSError, Operations
 
-from . import QMPResponseError
-from .qom_common import QOMCommand
+from . import (
+    QEMUMonitorProtocol,
+    QMPError,
+    QMPMessage,
+    QMPResponseError,
+)
+from .pool import PooledMonitor, QMPPool
+from .qom_common import ObjectPropertyInfo, QOMCommand
 
 
 fuse.fuse_python_api = (0, 2)
 
+#: A QOM listing, indexed by property name; None if the path is no object.
+Listing = Optional[Dict[str, ObjectPropertyInfo]]
+
+
+def split_path(path: str) -> Tuple[str, str]:
+    """Split a QOM path into its parent path and last component."""
+    path, prop = path.rsplit('/', 1)
+    return path or '/', prop
+
+
+class ListingCache:
+    """
+    Cache of qom-list results, keyed by QOM path.
+
+    Paths that are not objects are cached too, as negative entries.
+    The cache may be used from several threads.
+
+    :param ttl: lifetime of the entries, in seconds.
+    """
+    def __init__(self, ttl: float):
+        self.ttl = ttl
+        self._entries: Dict[str, Tuple[float, Listing]] = {}
+        self._lock = threading.Lock()
+
+    def get(self, path: str) -> Tuple[bool, Listing]:
+        """
+        Look up a listing.
+
+        :return: (True, listing) on a hit, (False, None) on a miss.
+        """
+        entry = self._entries.get(path)
+        if entry is None or entry[0] < time.monotonic():
+            return False, None
+        return True, entry[1]
+
+    def put(self, path: str, listing: Listing) -> None:
+        """Add or replace the listing of a path."""
+        if self.ttl > 0:
+            with self._lock:
+                self._entries[path] = (time.monotonic() + self.ttl, listing)
+
+    def invalidate(self, path: str) -> None:
+        """Drop the listings of a path and of everything below it."""
+        prefix = path.rstrip('/') + '/'
+        with self._lock:
+            for key in [key for key in self._entries
+                        if key == path or key.startswith(prefix)]:
+                del self._entries[key]
+
 
 class QOMFuse(QOMCommand, Operations):
     """
@@ -61,6 +133,7 @@ class QOMFuse(QOMCommand, Operations):
 
     Operations implements the FS, and QOMCommand implements the CLI command.
     """
+    # pylint: disable=too-many-instance-attributes
     name = 'fuse'
     help = 'Mount a QOM tree as a FUSE filesystem'
     fuse: FUSE
@@ -74,12 +147,63 @@ def configure_parser(cls, parser: argparse.ArgumentParser) -> None:
             action='store',
             help="Mount point",
         )
+        parser.add_argument(
+            '--cache-ttl',
+            metavar='SECONDS',
+            type=float,
+            default=2.0,
+            help="How long QOM listings are cached (default: 2.0). "
+            "0 disables the cache.",
+        )
+        parser.add_argument(
+            '--extra-socket',
+            metavar='SOCKET',
+            dest='extra_sockets',
+            action='append',
+            default=[],
+            help="Additional QMP socket path or address, for another QMP "
+            "monitor of the same QEMU. May be repeated.",
+        )
+        parser.add_argument(
+            '--connections',
+            metavar='N',
+            type=int,
+            default=None,
+            help="Number of QMP connections serving concurrent requests, "
+            "one per socket (default: all sockets).",
+        )
 
     def __init__(self, args: argparse.Namespace):
+        # A QMP monitor serves a single client, so every connection
+        # needs a socket of its own.
+        sockets = [args.socket] + args.extra_sockets
+        connections = args.connections or len(sockets)
+        if connections > len(sockets):
+            raise QMPError(
+                f"--connections {connections} needs {connections} QMP "
+                f"sockets, one per monitor, but only {len(sockets)} given; "
+                "add monitors with --extra-socket")
+
         super().__init__(args)
         self.mount = args.mount
+        self.lock = threading.Lock()
         self.ino_map: Dict[str, int] = {}
         self.ino_count = 1
+        self.cache = ListingCache(args.cache_ttl)
+
+        # FUSE requests are served by several threads; each QMP request
+        # takes a connection out of the queue for its duration.  The
+        # first connection is only used through the pool.
+        self.pool = QMPPool()
+        self.monitors: 'queue.Queue[PooledMonitor]' = queue.Queue()
+        self.monitors.put(self.pool.add('qmp0', connection=self.qmp))
+        for i in range(1, connections):
+            address = QEMUMonitorProtocol.parse_address(sockets[i])
+            self.monitors.put(self.pool.add(f'qmp{i}', address))
+
+        # Values of the open files, by file handle
+        self.files: Dict[int, bytes] = {}
+        self.fh_count = 1
 
     def run(self) -> int:
         print(f"Mounting QOMFS to '{self.mount}'", file=sys.stderr)
@@ -88,71 +212,131 @@ def run(self) -> int:
 
     def get_ino(self, path: str) -> int:
         """Get an inode number for a given QOM path."""
-        if path in self.ino_map:
+        with self.lock:
+            if path in self.ino_map:
+                return self.ino_map[path]
+            self.ino_map[path] = self.ino_count
+            self.ino_count += 1
             return self.ino_map[path]
-        self.ino_map[path] = self.ino_count
-        self.ino_count += 1
-        return self.ino_map[path]
+
+    @contextmanager
+    def monitor(self) -> Iterator[PooledMonitor]:
+        """Borrow a QMP connection from the pool."""
+        monitor = self.monitors.get()
+        try:
+            yield monitor
+        finally:
+            self.monitors.put(monitor)
+
+    def qom_get(self, path: str, prop: str) -> object:
+        """Get the value of a QOM property."""
+        with self.monitor() as monitor:
+            return monitor.command('qom-get', path=path, property=prop)
+
+    @staticmethod
+    def _make_listing(reply: QMPMessage) -> Listing:
+        if 'error' in reply:
+            return None
+        return {info.name: info for info in
+                map(ObjectPropertyInfo.make, reply['return'])}
+
+    def listing(self, path: str) -> Listing:
+        """
+        Get the properties of the object at the given QOM path, by name,
+        or None if there is no object there.
+        """
+        hit, listing = self.cache.get(path)
+        if not hit:
+            with self.monitor() as monitor:
+                reply = monitor.cmd('qom-list', {'path': path}, retry=True)
+            listing = self._make_listing(reply)
+            self.cache.put(path, listing)
+        return listing
+
+    def prefetch(self, paths: List[str]) -> None:
+        """Cache the listings of the given QOM paths in one batch."""
+        paths = [path for path in paths if not self.cache.get(path)[0]]
+        if len(paths) < 2 or self.cache.ttl <= 0:
+            return
+        with self.monitor() as monitor:
+            replies = monitor.cmd_batch([
+                {'execute': 'qom-list', 'arguments': {'path': path}}
+                for path in paths
+            ], retry=True)
+        for path, reply in zip(paths, replies):
+            self.cache.put(path, self._make_listing(reply))
+
+    def property_info(self, path: str) -> Optional[ObjectPropertyInfo]:
+        """Get the description of the property at the given QOM path."""
+        if path == '/':
+            return None
+        parent, prop = split_path(path)
+        listing = self.listing(parent)
+        if listing is None:
+            return None
+        return listing.get(prop)
 
     def is_object(self, path: str) -> bool:
         """Is the given QOM path an object?"""
-        try:
-            self.qom_list(path)
-            return True
-        except QMPResponseError:
-            return False
+        if path != '/':
+            info = self.property_info(path)
+            # Only child and link properties lead to objects
+            if info is None or not (info.child or info.link):
+                return False
+            if info.child:
+                return True
+        return self.listing(path) is not None
 
     def is_property(self, path: str) -> bool:
         """Is the given QOM path a property?"""
-        path, prop = path.rsplit('/', 1)
-        if path == '':
-            path = '/'
-        try:
-            for item in self.qom_list(path):
-                if item.name == prop:
-                    return True
-            return False
-        except QMPResponseError:
-            return False
+        return self.property_info(path) is not None
 
     def is_link(self, path: str) -> bool:
         """Is the given QOM path a link?"""
-        path, prop = path.rsplit('/', 1)
-        if path == '':
-            path = '/'
-        try:
-            for item in self.qom_list(path):
-                if item.name == prop and item.link:
-                    return True
-            return False
-        except QMPResponseError:
-            return False
+        info = self.property_info(path)
+        return info is not None and info.link
 
-    def read(self, path: str, size: int, offset: int, fh: IO[bytes]) -> bytes:
+    def _read_value(self, path: str) -> bytes:
         if not self.is_property(path):
             raise FuseOSError(ENOENT)
 
-        path, prop = path.rsplit('/', 1)
-        if path == '':
-            path = '/'
+        path, prop = split_path(path)
         try:
-            data = str(self.qmp.command('qom-get', path=path, property=prop))
+            data = str(self.qom_get(path, prop))
             data += '\n'  # make values shell friendly
         except QMPResponseError as err:
+            # The property may have gone away
+            self.cache.invalidate(path)
             raise FuseOSError(EPERM) from err
+        return bytes(data, encoding='utf-8')
 
-        if offset > len(data):
-            return b''
+    def open(self, path: str, flags: int) -> int:
+        # Snapshot the value, so that reading it in chunks is consistent
+        # and takes a single qom-get.
+        data = self._read_value(path)
+        with self.lock:
+            fh = self.fh_count
+            self.fh_count += 1
+            self.files[fh] = data
+        return fh
 
-        return bytes(data[offset:][:size], encoding='utf-8')
+    def release(self, path: str, fh: int) -> int:
+        with self.lock:
+            self.files.pop(fh, None)
+        return 0
+
+    def read(self, path: str, size: int, offset: int, fh: int) -> bytes:
+        data = self.files.get(fh)
+        if data is None:
+            data = self._read_value(path)
+        return data[offset:offset + size]
 
     def readlink(self, path: str) -> Union[bool, str]:
         if not self.is_link(path):
             return False
         path, prop = path.rsplit('/', 1)
         prefix = '/'.join(['..'] * (len(path.split('/')) - 1))
-        return prefix + str(self.qmp.command('qom-get', path=path,
-                                             property=prop))
+        return prefix + str(self.qom_get(path, prop))
 
     def getattr(self, path: str,
                 fh: Optional[IO[bytes]] = None) -> Mapping[str, object]:
@@ -200,7 +384,13 @@ def getattr(self, path: str,
         return value
 
     def readdir(self, path: str, fh: IO[bytes]) -> Iterator[str]:
+        listing = self.listing(path)
+        if listing is None:
+            raise FuseOSError(ENOENT)
+        # Directory walks list the children next
+        prefix = path.rstrip('/') + '/'
+        self.prefetch([prefix + name
+                       for name, info in listing.items() if info.child])
         yield '.'
         yield '..'
-        for item in self.qom_list(path):
-            yield item.name
+        yield from listing
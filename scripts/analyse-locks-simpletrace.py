@@ -22,12 +22,17 @@ def __init__(self):
     def _get_mutex(self, mutex):
         if not mutex in self.mutex_records:
             self.mutex_records[mutex] = {"locks": 0,
-                                         "lock_time": 0,
+                                         "lock_time": None,
                                          "acquire_times": [],
                                          "locked": 0,
-                                         "locked_time": 0,
+                                         "locked_time": None,
                                          "held_times": [],
-                                         "unlocked": 0}
+                                         "unlocked": 0,
+                                         # locked/unlock timestamps whose
+                                         # lock/locked event came before
+                                         # the start of this chunk
+                                         "pending_locked": [],
+                                         "pending_unlock": []}
 
         return self.mutex_records[mutex]
 
@@ -35,31 +40,66 @@ def qemu_mutex_lock(self, timestamp, mutex, filename, line):
         self.locks += 1
         rec = self._get_mutex(mutex)
         rec["locks"] += 1
-        rec["lock_time"] = timestamp[0]
+        rec["lock_time"] = timestamp
         rec["lock_loc"] = (filename, line)
 
     def qemu_mutex_locked(self, timestamp, mutex, filename, line):
         self.locked += 1
         rec = self._get_mutex(mutex)
         rec["locked"] += 1
-        rec["locked_time"] = timestamp[0]
-        acquire_time = rec["locked_time"] - rec["lock_time"]
+        rec["locked_time"] = timestamp
         rec["locked_loc"] = (filename, line)
-        rec["acquire_times"].append(acquire_time)
+        if rec["lock_time"] is not None:
+            rec["acquire_times"].append(timestamp - rec["lock_time"])
+        else:
+            rec["pending_locked"].append(timestamp)
 
     def qemu_mutex_unlock(self, timestamp, mutex, filename, line):
         self.unlocks += 1
         rec = self._get_mutex(mutex)
         rec["unlocked"] += 1
-        held_time = timestamp[0] - rec["locked_time"]
-        rec["held_times"].append(held_time)
         rec["unlock_loc"] = (filename, line)
+        if rec["locked_time"] is not None:
+            rec["held_times"].append(timestamp - rec["locked_time"])
+        else:
+            rec["pending_unlock"].append(timestamp)
+
+    def merge(self, other):
+        self.locks += other.locks
+        self.locked += other.locked
+        self.unlocks += other.unlocks
+
+        for mutex, orec in other.mutex_records.items():
+            rec = self._get_mutex(mutex)
+
+            # Pair the leading events of the later chunk with the last
+            # lock/locked events of this one
+            if rec["lock_time"] is not None:
+                rec["acquire_times"] += [t - rec["lock_time"]
+                                         for t in orec["pending_locked"]]
+            else:
+                rec["pending_locked"] += orec["pending_locked"]
+            if rec["locked_time"] is not None:
+                rec["held_times"] += [t - rec["locked_time"]
+                                      for t in orec["pending_unlock"]]
+            else:
+                rec["pending_unlock"] += orec["pending_unlock"]
+
+            for key in ("locks", "locked", "unlocked",
+                        "acquire_times", "held_times"):
+                rec[key] += orec[key]
+            for key in ("lock_time", "locked_time",
+                        "lock_loc", "locked_loc", "unlock_loc"):
+                if orec.get(key) is not None:
+                    rec[key] = orec[key]
 
 
 def get_args():
     "Grab options"
     parser = argparse.ArgumentParser()
     parser.add_argument("--output", "-o", type=str, help="Render plot to file")
+    parser.add_argument("--jobs", "-j", type=int, default=1,
+                        help="Number of worker processes")
     parser.add_argument("events", type=str, help='trace file read from')
     parser.add_argument("tracefile", type=str, help='trace file read from')
     return parser.parse_args()
@@ -69,13 +109,14 @@ def get_args():
 
     # Gather data from the trace
     analyser = MutexAnalyser()
-    simpletrace.process(args.events, args.tracefile, analyser)
+    simpletrace.process(args.events, args.tracefile, analyser,
+                        jobs=args.jobs)
 
     print ("Total locks: %d, locked: %d, unlocked: %d" %
            (analyser.locks, analyser.locked, analyser.unlocks))
 
     # Now dump the individual lock stats
-    for key, val in sorted(analyser.mutex_records.iteritems(),
+    for key, val in sorted(analyser.mutex_records.items(),
                            key=lambda k_v: k_v[1]["locks"]):
         print ("Lock: %#x locks: %d, locked: %d, unlocked: %d" %
                (key, val["locks"], val["locked"], val["unlocked"]))
@@ -21,8 +21,10 @@
 import os
 import argparse
 import collections
+import mmap
 import struct
 import sys
+import zlib
 
 
 def mkdir_p(path):
@@ -33,21 +35,53 @@ def mkdir_p(path):
 
 
 class MigrationFile(object):
+    """
+    A migration stream, memory-mapped so that sections are walked without
+    copying: readview() returns slices of the mapping, which can be written
+    to a file or hashed as they are.  Files that cannot be mapped are read
+    in memory.
+
+    The parts of the mapping that were read are dropped from time to time,
+    so that the memory use does not grow with the size of the stream.
+    """
+
+    DISCARD_SIZE = 64 * 1024 * 1024
+
+    int64 = struct.Struct('>q')
+    int32 = struct.Struct('>i')
+    int16 = struct.Struct('>h')
+    int8 = struct.Struct('>b')
+
     def __init__(self, filename):
         self.filename = filename
         self.file = open(self.filename, "rb")
+        try:
+            self.data = mmap.mmap(self.file.fileno(), 0,
+                                  access=mmap.ACCESS_READ)
+        except (ValueError, OSError):
+            self.data = self.file.read()
+        self.view = memoryview(self.data)
+        self.pos = 0
+        self.discarded = 0
+
+    def advance(self, size):
+        pos = self.pos
+        if pos + size > len(self.data):
+            raise Exception("Unexpected end of %s at 0x%x" % (self.filename, pos))
+        self.pos = pos + size
+        return pos
 
     def read64(self):
-        return int.from_bytes(self.file.read(8), byteorder='big', signed=True)
+        return self.int64.unpack_from(self.data, self.advance(8))[0]
 
     def read32(self):
-        return int.from_bytes(self.file.read(4), byteorder='big', signed=True)
+        return self.int32.unpack_from(self.data, self.advance(4))[0]
 
     def read16(self):
-        return int.from_bytes(self.file.read(2), byteorder='big', signed=True)
+        return self.int16.unpack_from(self.data, self.advance(2))[0]
 
     def read8(self):
-        return int.from_bytes(self.file.read(1), byteorder='big', signed=True)
+        return self.int8.unpack_from(self.data, self.advance(1))[0]
 
     def readstr(self, len = None):
         return self.readvar(len).decode('utf-8')
@@ -57,52 +91,207 @@ def readvar(self, size = None):
             size = self.read8()
         if size == 0:
             return ""
-        value = self.file.read(size)
-        if len(value) != size:
-            raise Exception("Unexpected end of %s at 0x%x" % (self.filename, self.file.tell()))
-        return value
+        return bytes(self.readview(size))
+
+    def readview(self, size):
+        pos = self.advance(size)
+        return self.view[pos:pos + size]
+
+    def skip(self, size):
+        self.advance(size)
 
     def tell(self):
-        return self.file.tell()
+        return self.pos
+
+    def discard(self):
+        # The pages are read back from the file if they are accessed again
+        if self.pos - self.discarded < self.DISCARD_SIZE:
+            return
+        end = self.pos - self.pos % mmap.PAGESIZE
+        if isinstance(self.data, mmap.mmap) and hasattr(mmap, 'MADV_DONTNEED'):
+            self.data.madvise(mmap.MADV_DONTNEED, self.discarded,
+                              end - self.discarded)
+        self.discarded = end
+
+    def seek(self, pos):
+        self.pos = pos
 
     # The VMSD description is at the end of the file, after EOF. Look for
     # the last NULL byte, then for the beginning brace of JSON.
     def read_migration_debug_json(self):
         QEMU_VM_VMDESCRIPTION = 0x06
 
-        # Remember the offset in the file when we started
-        entrypos = self.file.tell()
-
-        # Read the last 10MB
-        self.file.seek(0, os.SEEK_END)
-        endpos = self.file.tell()
-        self.file.seek(max(-endpos, -10 * 1024 * 1024), os.SEEK_END)
-        datapos = self.file.tell()
-        data = self.file.read()
-        # The full file read closed the file as well, reopen it
-        self.file = open(self.filename, "rb")
+        # Look in the last 10MB
+        datapos = max(len(self.data) - 10 * 1024 * 1024, 0)
 
         # Find the last NULL byte, then the first brace after that. This should
         # be the beginning of our JSON data.
-        nulpos = data.rfind(b'\0')
-        jsonpos = data.find(b'{', nulpos)
+        nulpos = self.data.rfind(b'\0', datapos)
+        jsonpos = self.data.find(b'{', nulpos)
 
         # Check backwards from there and see whether we guessed right
-        self.file.seek(datapos + jsonpos - 5, 0)
-        if self.read8() != QEMU_VM_VMDESCRIPTION:
+        if jsonpos < 5 or self.data[jsonpos - 5] != QEMU_VM_VMDESCRIPTION:
             raise Exception("No Debug Migration device found")
 
-        jsonlen = self.read32()
-
-        # Seek back to where we were at the beginning
-        self.file.seek(entrypos, 0)
+        jsonlen = self.int32.unpack_from(self.data, jsonpos - 4)[0]
 
         # explicit decode() needed for Python 3.5 compatibility
-        return data[jsonpos:jsonpos + jsonlen].decode("utf-8")
+        return bytes(self.view[jsonpos:jsonpos + jsonlen]).decode("utf-8")
 
     def close(self):
+        self.view.release()
+        if isinstance(self.data, mmap.mmap):
+            self.data.close()
         self.file.close()
 
+def uleb128_decode_small(data, i):
+    n = data[i]
+    if n & 0x80:
+        return (n & 0x7f) | (data[i + 1] << 7), i + 2
+    return n, i + 1
+
+def xbzrle_decode(encoded, page):
+    """
+    Apply an XBZRLE encoded page, a sequence of zero runs and nonzero runs
+    with ULEB128 encoded lengths, to the previous contents of the page.
+    """
+    i = 0
+    d = 0
+    end = len(encoded)
+    try:
+        while i < end:
+            zrun, i = uleb128_decode_small(encoded, i)
+            nzrun, i = uleb128_decode_small(encoded, i)
+            d += zrun
+            if nzrun == 0 or d + nzrun > len(page) or i + nzrun > end:
+                raise IndexError
+            page[d:d + nzrun] = encoded[i:i + nzrun]
+            d += nzrun
+            i += nzrun
+    except IndexError:
+        raise Exception("Invalid XBZRLE page")
+
+class PageCache(object):
+    """
+    The last contents sent for RAM pages, needed to decode XBZRLE pages.
+
+    Like the cache of the sender, it is direct-mapped by page number and
+    its size is a power of two number of pages.  The sender indexes it by
+    the address of the page in the whole guest RAM, which is not in the
+    stream, so this cache uses the offset in the RAM block.  Pages of
+    different RAM blocks thus evict each other in other slots than on the
+    sender, and a cache of the sender's size can be missing pages that the
+    sender still has.  A larger cache makes this unlikely, but no size
+    rules it out.
+    """
+
+    def __init__(self, size, page_size):
+        items = 1
+        while items * 2 * page_size <= size:
+            items *= 2
+        self.page_size = page_size
+        self.tags = [None] * items
+        self.pages = [None] * items
+        self.mask = items - 1
+
+    def get(self, name, addr):
+        pos = (addr // self.page_size) & self.mask
+        if self.tags[pos] != (name, addr):
+            raise Exception("XBZRLE page %s (0x%016x) is not cached, try a "
+                            "larger --xbzrle-cache-size, see PageCache" % (name, addr))
+        return self.pages[pos]
+
+    def put(self, name, addr, data):
+        pos = (addr // self.page_size) & self.mask
+        self.tags[pos] = (name, addr)
+        self.pages[pos] = bytearray(data)
+
+class MultifdChannel(object):
+    """The stream of one multifd channel, one packet at a time."""
+
+    MULTIFD_MAGIC = 0x11223344
+    MULTIFD_VERSION = 1
+    MULTIFD_FLAG_SYNC = 1 << 0
+    MULTIFD_FLAG_COMPRESSION_MASK = 7 << 1
+    MULTIFD_FLAG_NOCOMP = 0 << 1
+    MULTIFD_FLAG_ZLIB = 1 << 1
+
+    init = struct.Struct('>II16sB7x32x')
+    header = struct.Struct('>IIIIIIQ32x256s')
+
+    def __init__(self, filename, page_size):
+        self.file = MigrationFile(filename)
+        self.page_size = page_size
+        self.zlib = None
+        magic, version, uuid, self.id = self.init.unpack_from(
+            self.file.data, self.file.advance(self.init.size))
+        if magic != self.MULTIFD_MAGIC or version != self.MULTIFD_VERSION:
+            raise Exception("%s is not a multifd channel" % filename)
+
+    def read_packet(self):
+        """
+        Return the next packet as (packet number, flags, RAM block, page
+        offsets, page data, bytes in the stream), or None at the end of
+        the channel.
+        """
+        file = self.file
+        if file.tell() == len(file.data):
+            return None
+        start = file.tell()
+        (magic, version, flags, pages_alloc, pages_used, size, packet_num,
+         ramblock) = self.header.unpack_from(file.data,
+                                             file.advance(self.header.size))
+        if magic != self.MULTIFD_MAGIC or version != self.MULTIFD_VERSION:
+            raise Exception("Invalid multifd packet at 0x%x of %s" %
+                            (start, file.filename))
+        offsets = struct.unpack_from('>%dQ' % pages_used, file.data, file.tell())
+        file.skip(8 * pages_alloc)
+        data = file.readview(size)
+        compression = flags & self.MULTIFD_FLAG_COMPRESSION_MASK
+        if compression == self.MULTIFD_FLAG_ZLIB:
+            # One deflate stream per channel, flushed after each packet
+            if self.zlib is None:
+                self.zlib = zlib.decompressobj()
+            data = self.zlib.decompress(data)
+        elif compression != self.MULTIFD_FLAG_NOCOMP:
+            raise Exception("Unsupported multifd compression %d" % (compression >> 1))
+        if len(data) != pages_used * self.page_size:
+            raise Exception("Invalid multifd packet size at 0x%x of %s" %
+                            (start, file.filename))
+        ramblock = ramblock.split(b'\0', 1)[0].decode('utf-8')
+        return (packet_num, flags, ramblock, offsets, data, file.tell() - start)
+
+class MultifdStreams(object):
+    """
+    The multifd channels of a migration, one file per channel.
+
+    The channels are synchronized at the end of each RAM section of the
+    main stream: read_sync() returns the pages sent by all the channels
+    until their next synchronization, in the order the sender queued them.
+    """
+
+    def __init__(self, filenames, page_size):
+        self.channels = [MultifdChannel(filename, page_size)
+                         for filename in filenames]
+        self.page_size = page_size
+
+    def read_sync(self):
+        packets = []
+        for channel in self.channels:
+            while True:
+                packet = channel.read_packet()
+                if packet is None:
+                    break
+                packets.append(packet)
+                if packet[1] & MultifdChannel.MULTIFD_FLAG_SYNC:
+                    break
+        packets.sort(key = lambda packet: packet[0])
+        return packets
+
+    def close(self):
+        for channel in self.channels:
+            channel.file.close()
+
 class RamSection(object):
     RAM_SAVE_FLAG_COMPRESS = 0x02
     RAM_SAVE_FLAG_MEM_SIZE = 0x04
@@ -112,6 +301,8 @@ class RamSection(object):
     RAM_SAVE_FLAG_XBZRLE   = 0x40
     RAM_SAVE_FLAG_HOOK     = 0x80
 
+    ENCODING_FLAG_XBZRLE   = 0x1
+
     def __init__(self, file, version_id, ramargs, section_key):
         if version_id != 4:
             raise Exception("Unknown RAM version %d" % version_id)
@@ -121,13 +312,24 @@ def __init__(self, file, version_id, ramargs, section_key):
         self.TARGET_PAGE_SIZE = ramargs['page_size']
         self.dump_memory = ramargs['dump_memory']
         self.write_memory = ramargs['write_memory']
+        # When streaming, pages are passed to emit() instead of being kept
+        self.emit = ramargs.get('emit')
+        self.stats = ramargs.get('stats')
+        self.multifd = ramargs.get('multifd')
+        # Previous contents of the pages, for XBZRLE, when they are not
+        # written to files
+        self.cache = None
+        if self.dump_memory and not self.write_memory:
+            self.cache = PageCache(ramargs['xbzrle_cache_size'], self.TARGET_PAGE_SIZE)
         self.sizeinfo = collections.OrderedDict()
         self.data = collections.OrderedDict()
         self.data['section sizes'] = self.sizeinfo
         self.name = ''
         if self.write_memory:
             self.files = { }
-        if self.dump_memory:
+            # Pages written to each file, the others are still zero
+            self.written = { }
+        if self.dump_memory and not self.emit:
             self.memory = collections.OrderedDict()
             self.data['memory'] = self.memory
 
@@ -140,9 +342,55 @@ def __str__(self):
     def getDict(self):
         return self.data
 
+    def dump_page(self, addr, data = None, fill_char = None):
+        if self.emit:
+            record = collections.OrderedDict()
+            record['ram'] = self.name
+            record['addr'] = '0x%016x' % addr
+            if data is None:
+                record['fill'] = '0x%02x' % fill_char
+            else:
+                record['data'] = data.hex()
+            self.emit(record)
+        elif data is None:
+            self.memory['%s (0x%016x)' % (self.name, addr)] = 'Filled with 0x%02x' % fill_char
+        else:
+            hexdata = " ".join("{0:02x}".format(c) for c in data)
+            self.memory['%s (0x%016x)' % (self.name, addr)] = hexdata
+
+    def put_page(self, addr, data):
+        if self.write_memory:
+            self.files[self.name].seek(addr, os.SEEK_SET)
+            self.files[self.name].write(data)
+            self.written[self.name][addr // self.TARGET_PAGE_SIZE] = 1
+        if self.dump_memory:
+            self.dump_page(addr, data = data)
+        if self.cache:
+            self.cache.put(self.name, addr, data)
+
+    def get_page(self, addr):
+        if self.write_memory:
+            f = self.files[self.name]
+            f.seek(addr, os.SEEK_SET)
+            return bytearray(f.read(self.TARGET_PAGE_SIZE))
+        return self.cache.get(self.name, addr)
+
+    def read_multifd(self):
+        # The pages sent by the multifd channels since the last section
+        for packet_num, flags, name, offsets, data, size in self.multifd.read_sync():
+            if self.stats:
+                self.stats.multifd_packet(size, len(offsets))
+            self.name = name
+            for i, addr in enumerate(offsets):
+                if self.write_memory or self.dump_memory:
+                    self.put_page(addr, data[i * self.TARGET_PAGE_SIZE:(i + 1) * self.TARGET_PAGE_SIZE])
+                if self.stats:
+                    self.stats.ram_page(self.name, addr)
+
     def read(self):
         # Read all RAM sections
         while True:
+            self.file.discard()
             addr = self.file.read64()
             flags = addr & (self.TARGET_PAGE_SIZE - 1)
             addr &= ~(self.TARGET_PAGE_SIZE - 1)
@@ -155,18 +403,21 @@ def read(self):
                     # a zero here we know it has to be an address, not the
                     # length of the next block.
                     if namelen == 0:
-                        self.file.file.seek(-1, 1)
+                        self.file.seek(self.file.tell() - 1)
                         break
                     self.name = self.file.readstr(len = namelen)
                     len = self.file.read64()
                     self.sizeinfo[self.name] = '0x%016x' % len
+                    if self.stats:
+                        self.stats.ram_block(self.name, len)
                     if self.write_memory:
                         print(self.name)
                         mkdir_p('./' + os.path.dirname(self.name))
-                        f = open('./' + self.name, "wb")
+                        f = open('./' + self.name, "w+b")
                         f.truncate(0)
                         f.truncate(len)
                         self.files[self.name] = f
+                        self.written[self.name] = bytearray(len // self.TARGET_PAGE_SIZE)
                 flags &= ~self.RAM_SAVE_FLAG_MEM_SIZE
 
             if flags & self.RAM_SAVE_FLAG_COMPRESS:
@@ -176,11 +427,17 @@ def read(self):
                     self.name = self.file.readstr()
                 fill_char = self.file.read8()
                 # The page in question is filled with fill_char now
-                if self.write_memory and fill_char != 0:
+                if self.write_memory and (fill_char != 0 or
+                                          self.written[self.name][addr // self.TARGET_PAGE_SIZE]):
                     self.files[self.name].seek(addr, os.SEEK_SET)
-                    self.files[self.name].write(chr(fill_char) * self.TARGET_PAGE_SIZE)
+                    self.files[self.name].write(struct.pack('b', fill_char) * self.TARGET_PAGE_SIZE)
+                    self.written[self.name][addr // self.TARGET_PAGE_SIZE] = 1
                 if self.dump_memory:
-                    self.memory['%s (0x%016x)' % (self.name, addr)] = 'Filled with 0x%02x' % fill_char
+                    self.dump_page(addr, fill_char = fill_char & 0xff)
+                if self.cache:
+                    self.cache.put(self.name, addr, struct.pack('b', fill_char) * self.TARGET_PAGE_SIZE)
+                if self.stats:
+                    self.stats.ram_page(self.name, addr, fill_char & 0xff)
                 flags &= ~self.RAM_SAVE_FLAG_COMPRESS
             elif flags & self.RAM_SAVE_FLAG_PAGE:
                 if flags & self.RAM_SAVE_FLAG_CONTINUE:
@@ -189,25 +446,39 @@ def read(self):
                     self.name = self.file.readstr()
 
                 if self.write_memory or self.dump_memory:
-                    data = self.file.readvar(size = self.TARGET_PAGE_SIZE)
+                    # A slice of the mapped stream, copied straight to the
+                    # output
+                    data = self.file.readview(self.TARGET_PAGE_SIZE)
+                    self.put_page(addr, data)
                 else: # Just skip RAM data
-                    self.file.file.seek(self.TARGET_PAGE_SIZE, 1)
-
-                if self.write_memory:
-                    self.files[self.name].seek(addr, os.SEEK_SET)
-                    self.files[self.name].write(data)
-                if self.dump_memory:
-                    hexdata = " ".join("{0:02x}".format(ord(c)) for c in data)
-                    self.memory['%s (0x%016x)' % (self.name, addr)] = hexdata
+                    self.file.skip(self.TARGET_PAGE_SIZE)
+                if self.stats:
+                    self.stats.ram_page(self.name, addr)
 
                 flags &= ~self.RAM_SAVE_FLAG_PAGE
             elif flags & self.RAM_SAVE_FLAG_XBZRLE:
-                raise Exception("XBZRLE RAM compression is not supported yet")
+                if flags & self.RAM_SAVE_FLAG_CONTINUE:
+                    flags &= ~self.RAM_SAVE_FLAG_CONTINUE
+                else:
+                    self.name = self.file.readstr()
+                if self.file.read8() != self.ENCODING_FLAG_XBZRLE:
+                    raise Exception("Unknown XBZRLE encoding at 0x%x" % self.file.tell())
+                size = self.file.read16() & 0xffff
+                encoded = self.file.readview(size)
+                if self.write_memory or self.dump_memory:
+                    data = self.get_page(addr)
+                    xbzrle_decode(encoded, data)
+                    self.put_page(addr, data)
+                if self.stats:
+                    self.stats.ram_xbzrle_page(self.name, addr, size)
+                flags &= ~self.RAM_SAVE_FLAG_XBZRLE
             elif flags & self.RAM_SAVE_FLAG_HOOK:
                 raise Exception("RAM hooks don't make sense with files")
 
             # End of RAM section
             if flags & self.RAM_SAVE_FLAG_EOS:
+                if self.multifd:
+                    self.read_multifd()
                 break
 
             if flags != 0:
@@ -476,6 +747,166 @@ def __init__(self, file, version_id, device, section_key):
 
 ###############################################################################
 
+class RamBlockStats(object):
+    def __init__(self, size, page_size):
+        self.size = size
+        self.pages = 0
+        self.fill_pages = 0
+        self.zero_pages = 0
+        self.xbzrle_pages = 0
+        self.xbzrle_bytes = 0
+        # Number of times each page was sent, saturated at 255
+        self.sends = bytearray((size + page_size - 1) // page_size)
+
+class MigrationStats(object):
+    """
+    Counters of a migration stream, gathered while it is read: bytes per
+    section type and per device, and for each RAM block the number of full
+    and fill pages and of times each page was sent.  Pages sent with XBZRLE
+    or through multifd channels are counted with the bytes they took.
+    """
+
+    SECTION_TYPES = {
+        0x01: 'start',
+        0x02: 'part',
+        0x03: 'end',
+        0x04: 'full',
+        0x07: 'configuration',
+        0x7e: 'footer',
+    }
+
+    def __init__(self, page_size, region_size = 2 * 1024 * 1024):
+        self.page_size = page_size
+        self.region_pages = max(region_size // page_size, 1)
+        self.stream_bytes = 0
+        self.section_bytes = collections.OrderedDict()
+        self.device_bytes = collections.OrderedDict()
+        self.blocks = collections.OrderedDict()
+        self.multifd_packets = 0
+        self.multifd_pages = 0
+        self.multifd_bytes = 0
+
+    def section(self, section_type, device, size):
+        name = self.SECTION_TYPES[section_type]
+        self.section_bytes[name] = self.section_bytes.get(name, 0) + size
+        if device is not None:
+            self.device_bytes[device] = self.device_bytes.get(device, 0) + size
+
+    def ram_block(self, name, size):
+        if name not in self.blocks:
+            self.blocks[name] = RamBlockStats(size, self.page_size)
+
+    def ram_page(self, name, addr, fill_char = None):
+        block = self.sent_page(name, addr)
+        if fill_char is None:
+            block.pages += 1
+        else:
+            block.fill_pages += 1
+            if fill_char == 0:
+                block.zero_pages += 1
+
+    def ram_xbzrle_page(self, name, addr, size):
+        block = self.sent_page(name, addr)
+        block.xbzrle_pages += 1
+        block.xbzrle_bytes += size
+
+    def multifd_packet(self, size, pages):
+        self.multifd_packets += 1
+        self.multifd_pages += pages
+        self.multifd_bytes += size
+
+    def sent_page(self, name, addr):
+        block = self.blocks.get(name)
+        if block is None:
+            block = self.blocks[name] = RamBlockStats(0, self.page_size)
+        index = addr // self.page_size
+        sends = block.sends
+        if index >= len(sends):
+            sends.extend(bytes(index + 1 - len(sends)))
+        if sends[index] < 255:
+            sends[index] += 1
+        return block
+
+    def saved(self, pages, size):
+        """Percentage of the bytes of pages saved by sending size bytes."""
+        return 100.0 - 100.0 * size / (pages * self.page_size) if pages else 0.0
+
+    def summary(self):
+        """Return the counters as an ordered dictionary of numbers."""
+        r = collections.OrderedDict()
+        r['stream bytes'] = self.stream_bytes
+        for name, size in self.section_bytes.items():
+            r['section bytes: %s' % name] = size
+        for name, size in self.device_bytes.items():
+            r['device bytes: %s' % name] = size
+        if self.multifd_packets:
+            r['multifd packets'] = self.multifd_packets
+            r['multifd pages'] = self.multifd_pages
+            r['multifd bytes'] = self.multifd_bytes
+            r['multifd saved %'] = self.saved(self.multifd_pages, self.multifd_bytes)
+        for name, block in self.blocks.items():
+            sent = block.pages + block.fill_pages + block.xbzrle_pages
+            prefix = 'ram %s: ' % name
+            r[prefix + 'size'] = block.size
+            r[prefix + 'full pages'] = block.pages
+            r[prefix + 'fill pages'] = block.fill_pages
+            r[prefix + 'zero pages'] = block.zero_pages
+            r[prefix + 'fill ratio %'] = 100.0 * block.fill_pages / sent if sent else 0.0
+            if block.xbzrle_pages:
+                r[prefix + 'xbzrle pages'] = block.xbzrle_pages
+                r[prefix + 'xbzrle bytes'] = block.xbzrle_bytes
+                r[prefix + 'xbzrle saved %'] = self.saved(block.xbzrle_pages,
+                                                          block.xbzrle_bytes)
+            r[prefix + 'pages never sent'] = block.sends.count(0)
+            for count in range(1, 256):
+                pages = block.sends.count(count)
+                if pages:
+                    label = 'pages sent %d%s time%s' % (count, '+' if count == 255 else '',
+                                                         's' if count > 1 else '')
+                    r[prefix + label] = pages
+        return r
+
+    def hot_regions(self, name, top):
+        """Return the (address, sends) of the regions of a RAM block where
+        the most pages were sent, hottest first."""
+        sends = self.blocks[name].sends
+        step = self.region_pages
+        regions = [(index * self.page_size, sum(sends[index:index + step]))
+                   for index in range(0, len(sends), step)]
+        regions.sort(key = lambda region: region[1], reverse = True)
+        return [region for region in regions[:top] if region[1]]
+
+    def report(self, out, top = 10, other = None):
+        """Print the counters, compared with those of other if given."""
+        mine = self.summary()
+        if other is None:
+            for label, value in mine.items():
+                out.write('%-44s %16s\n' % (label, format_stat(value)))
+        else:
+            theirs = other.summary()
+            labels = list(mine)
+            labels.extend(label for label in theirs if label not in mine)
+            for label in labels:
+                a = mine.get(label, 0)
+                b = theirs.get(label, 0)
+                delta = '%+.1f%%' % (100.0 * (b - a) / a) if a else ''
+                out.write('%-44s %16s %16s %8s\n' % (label, format_stat(a),
+                                                      format_stat(b), delta))
+        for stats in (self, other):
+            if stats is None:
+                continue
+            for name in stats.blocks:
+                out.write('\nhottest %d KiB regions of %s%s:\n' %
+                          (stats.region_pages * stats.page_size // 1024, name,
+                           ' (second dump)' if stats is other else ''))
+                for addr, sends in stats.hot_regions(name, top):
+                    out.write('  0x%016x %16d\n' % (addr, sends))
+
+def format_stat(value):
+    if isinstance(value, float):
+        return '%.1f' % value
+    return str(value)
+
 class MigrationDump(object):
     QEMU_VM_FILE_MAGIC    = 0x5145564d
     QEMU_VM_FILE_VERSION  = 0x00000003
@@ -495,8 +926,20 @@ def __init__(self, filename):
         self.filename = filename
         self.vmsd_desc = None
 
-    def read(self, desc_only = False, dump_memory = False, write_memory = False):
-        # Read in the whole file
+    def read(self, desc_only = False, dump_memory = False, write_memory = False,
+             emit = None, stats = None, multifd = (),
+             xbzrle_cache_size = 256 * 1024 * 1024):
+        """
+        Read the migration stream.  If emit is given, it is called with the
+        state of each section as soon as the section is complete, and with
+        each RAM page if dump_memory is set, instead of keeping them for
+        getDict().  If stats is given, it is a MigrationStats which counts
+        the contents of the stream.  multifd lists the files holding the
+        streams of the multifd channels.  xbzrle_cache_size is the size of
+        the cache of RAM pages used to decode XBZRLE pages when they are not
+        written to files.  It should be larger than the cache of the source,
+        see PageCache.
+        """
         file = MigrationFile(self.filename)
 
         # File magic
@@ -521,9 +964,17 @@ def read(self, desc_only = False, dump_memory = False, write_memory = False):
         ramargs['page_size'] = self.vmsd_desc['page_size']
         ramargs['dump_memory'] = dump_memory
         ramargs['write_memory'] = write_memory
+        ramargs['emit'] = emit
+        ramargs['stats'] = stats
+        ramargs['xbzrle_cache_size'] = xbzrle_cache_size
+        ramargs['multifd'] = None
+        if multifd:
+            ramargs['multifd'] = MultifdStreams(multifd, ramargs['page_size'])
         self.section_classes[('ram',0)][1] = ramargs
 
         while True:
+            start = file.tell()
+            device = None
             section_type = file.read8()
             if section_type == self.QEMU_VM_EOF:
                 break
@@ -539,18 +990,38 @@ def read(self, desc_only = False, dump_memory = False, write_memory = False):
                 classdesc = self.section_classes[section_key]
                 section = classdesc[0](file, version_id, classdesc[1], section_key)
                 self.sections[section_id] = section
+                device = name
                 section.read()
+                if section_type == self.QEMU_VM_SECTION_FULL:
+                    self.emit_section(emit, section_id)
             elif section_type == self.QEMU_VM_SECTION_PART or section_type == self.QEMU_VM_SECTION_END:
                 section_id = file.read32()
+                device = self.sections[section_id].section_key[0]
                 self.sections[section_id].read()
+                if section_type == self.QEMU_VM_SECTION_END:
+                    self.emit_section(emit, section_id)
             elif section_type == self.QEMU_VM_SECTION_FOOTER:
                 read_section_id = file.read32()
                 if read_section_id != section_id:
                     raise Exception("Mismatched section footer: %x vs %x" % (read_section_id, section_id))
             else:
                 raise Exception("Unknown section type: %d" % section_type)
+            if stats:
+                stats.section(section_type, device, file.tell() - start)
+        if stats:
+            stats.stream_bytes = file.tell()
+        if ramargs['multifd']:
+            ramargs['multifd'].close()
         file.close()
 
+    def emit_section(self, emit, section_id):
+        if emit:
+            section = self.sections.pop(section_id)
+            record = collections.OrderedDict()
+            record['section'] = "%s (%d)" % (section.section_key[0], section_id)
+            record['state'] = section.getDict()
+            emit(record)
+
     def load_vmsd_json(self, file):
         vmsd_json = file.read_migration_debug_json()
         self.vmsd_desc = json.loads(vmsd_json, object_pairs_hook=collections.OrderedDict)
@@ -577,37 +1048,62 @@ def default(self, o):
 parser = argparse.ArgumentParser()
 parser.add_argument("-f", "--file", help='migration dump to read from', required=True)
 parser.add_argument("-m", "--memory", help='dump RAM contents as well', action='store_true')
-parser.add_argument("-d", "--dump", help='what to dump ("state" or "desc")', default='state')
+parser.add_argument("-d", "--dump", help='what to dump ("state", "desc" or "stats")', default='state')
 parser.add_argument("-x", "--extract", help='extract contents into individual files', action='store_true')
+parser.add_argument("-l", "--json-lines", help='with -d state, print each section and RAM page as a JSON line as soon as it is read', action='store_true')
+parser.add_argument("-c", "--compare", help='with -d stats, migration dump to compare with')
+parser.add_argument("--region-size", help='with -d stats, size of the RAM regions in KiB', type=int, default=2048)
+parser.add_argument("--top", help='with -d stats, number of hot RAM regions to show', type=int, default=10)
+parser.add_argument("--multifd", help='stream of a multifd channel, to be given once per channel', action='append', default=[])
+parser.add_argument("--xbzrle-cache-size", help='size of the page cache for XBZRLE pages in MiB (default: 256).  The source indexes its cache by the address of the page in the whole guest RAM, which is not in the stream, so pages collide differently here: use a few times the source\'s xbzrle-cache-size, and more if a page is reported as not cached', type=int, default=256)
 args = parser.parse_args()
 
 jsonenc = JSONEncoder(indent=4, separators=(',', ': '))
+ramopts = { 'multifd': args.multifd,
+            'xbzrle_cache_size': args.xbzrle_cache_size * 1024 * 1024 }
 
 if args.extract:
     dump = MigrationDump(args.file)
 
     dump.read(desc_only = True)
     print("desc.json")
-    f = open("desc.json", "wb")
+    f = open("desc.json", "w")
     f.truncate()
     f.write(jsonenc.encode(dump.vmsd_desc))
     f.close()
 
-    dump.read(write_memory = True)
+    dump.read(write_memory = True, **ramopts)
     dict = dump.getDict()
     print("state.json")
-    f = open("state.json", "wb")
+    f = open("state.json", "w")
     f.truncate()
     f.write(jsonenc.encode(dict))
     f.close()
+elif args.dump == "state" and args.json_lines:
+    lineenc = JSONEncoder(separators=(',', ':'))
+    def emit(record):
+        sys.stdout.write(lineenc.encode(record) + '\n')
+    dump = MigrationDump(args.file)
+    dump.read(dump_memory = args.memory, emit = emit, **ramopts)
 elif args.dump == "state":
     dump = MigrationDump(args.file)
-    dump.read(dump_memory = args.memory)
+    dump.read(dump_memory = args.memory, **ramopts)
     dict = dump.getDict()
     print(jsonenc.encode(dict))
+elif args.dump == "stats":
+    all_stats = []
+    for filename in [args.file] + ([args.compare] if args.compare else []):
+        dump = MigrationDump(filename)
+        dump.read(desc_only = True)
+        stats = MigrationStats(dump.vmsd_desc['page_size'], args.region_size * 1024)
+        # The multifd channels are those of the first dump
+        dump.read(stats = stats, **ramopts)
+        ramopts['multifd'] = []
+        all_stats.append(stats)
+    all_stats[0].report(sys.stdout, args.top, *all_stats[1:])
 elif args.dump == "desc":
     dump = MigrationDump(args.file)
     dump.read(desc_only = True)
     print(jsonenc.encode(dump.vmsd_desc))
 else:
-    raise Exception("Please specify either -x, -d state or -d dump")
+    raise Exception("Please specify either -x, -d state, -d desc or -d stats")
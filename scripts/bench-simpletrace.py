@@ -0,0 +1,142 @@
+#!/usr/bin/env python3
+#
+# Micro-benchmark for simpletrace.py record decoding
+#
+# This work is licensed under the terms of the GNU GPL, version 2 or later.
+# See the COPYING file in the top-level directory.
+#
+# Usage: ./bench-simpletrace.py [--records N] [--runs N]
+#
+# Writes a synthetic trace with a mix of fixed-size and string events and
+# reports how many records per second are processed when the trace is read
+# as a stream with read() calls, when it is memory-mapped and decoded with
+# the precompiled per-event decoders, and (if NumPy is available) when its
+# fixed-size events are decoded in bulk.
+
+import argparse
+import io
+import os
+import random
+import struct
+import tempfile
+import time
+
+import simpletrace
+from tracetool import read_events
+
+
+TRACE_EVENTS = """\
+bench_fixed0(void) ""
+bench_fixed2(int a, uint64_t b) "a %d b 0x%"PRIx64
+bench_fixed6(int a, int b, int c, int d, int e, int f) "%d %d %d %d %d %d"
+bench_string(void *ptr, const char *name, int line) "%p %s:%d"
+"""
+
+
+def write_trace(path, events, nrecords):
+    "Write a synthetic trace of nrecords records of the given events"
+    random.seed(0)
+    with open(path, 'wb') as f:
+        f.write(struct.pack(simpletrace.log_header_fmt,
+                            simpletrace.header_event_id,
+                            simpletrace.header_magic, 4))
+        for event_id, event in enumerate(events):
+            name = event.name.encode()
+            f.write(struct.pack('=QQL', simpletrace.record_type_mapping,
+                                event_id, len(name)) + name)
+
+        timestamp = 0
+        for i in range(nrecords):
+            event_id = random.randrange(len(events))
+            args = b''
+            for type_, _ in events[event_id].args:
+                if simpletrace.is_string(type_):
+                    s = b'file%d.c' % (i % 10)
+                    args += struct.pack('=L', len(s)) + s
+                else:
+                    args += struct.pack('=Q', i)
+            timestamp += random.randint(1, 100)
+            f.write(struct.pack('=QQQII', simpletrace.record_type_event,
+                                event_id, timestamp, 24 + len(args), 1) +
+                    args)
+
+
+class CountingAnalyzer(simpletrace.Analyzer):
+    "Counts records, with a specific handler for one event"
+
+    def __init__(self):
+        self.records = 0
+
+    def bench_fixed2(self, timestamp, a, b):
+        self.records += 1
+
+    def catchall(self, event, rec):
+        self.records += 1
+
+
+def measure(fn, runs):
+    "Return (records, best time in seconds) of several runs of fn()"
+    best = None
+    for _ in range(runs):
+        start = time.perf_counter()
+        records = fn()
+        elapsed = time.perf_counter() - start
+        if best is None or elapsed < best:
+            best = elapsed
+    return records, best
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--records', type=int, default=500000,
+                        help='number of records in the synthetic trace')
+    parser.add_argument('--runs', type=int, default=3,
+                        help='number of runs, the best one is reported')
+    args = parser.parse_args()
+
+    events = read_events(io.StringIO(TRACE_EVENTS), 'bench-trace-events')
+    with tempfile.TemporaryDirectory() as tmpdir:
+        path = os.path.join(tmpdir, 'trace')
+        write_trace(path, events, args.records)
+        with open(path, 'rb') as f:
+            data = f.read()
+
+        def stream():
+            analyzer = CountingAnalyzer()
+            # In-memory files cannot be mapped and are read as a stream
+            simpletrace.process(events, io.BytesIO(data), analyzer)
+            return analyzer.records
+
+        def mapped():
+            analyzer = CountingAnalyzer()
+            simpletrace.process(events, path, analyzer)
+            return analyzer.records
+
+        def bulk():
+            with open(path, 'rb') as f:
+                simpletrace.read_trace_header(f)
+                edict = {event.name: event for event in events}
+                idtoname = {}
+                with simpletrace.MappedTrace(f) as trace:
+                    arrays = trace.event_arrays(edict, idtoname)
+            return sum(len(a) for a in arrays.values())
+
+        benchmarks = [('stream', stream), ('mapped', mapped)]
+        try:
+            import numpy  # pylint: disable=unused-import
+            benchmarks.append(('bulk (fixed-size events only)', bulk))
+        except ImportError:
+            pass
+
+        baseline = None
+        for name, fn in benchmarks:
+            records, elapsed = measure(fn, args.runs)
+            rate = records / elapsed
+            if baseline is None:
+                baseline = rate
+            print('%-30s %9d records %8.3f s %12.0f records/s %6.2fx' %
+                  (name, records, elapsed, rate, rate / baseline))
+
+
+if __name__ == '__main__':
+    main()
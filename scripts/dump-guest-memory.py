@@ -14,7 +14,23 @@
 """
 
 import ctypes
+import os
 import struct
+import threading
+import time
+import zlib
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+
+# Optional page compression formats of the kdump output
+try:
+    import lzo
+except ImportError:
+    lzo = None
+try:
+    import snappy
+except ImportError:
+    snappy = None
 
 try:
     UINTPTR_T = gdb.lookup_type("uintptr_t")
@@ -26,6 +42,16 @@
 TARGET_PAGE_SIZE = 0x1000
 TARGET_PAGE_MASK = 0xFFFFFFFFFFFFF000
 
+# Guest memory is read in chunks of READ_CHUNK_SIZE bytes.  Chunks are
+# scanned for zeroes in blocks of SPARSE_BLOCK_SIZE bytes, which are not
+# written but left as holes in the vmcore.
+READ_CHUNK_SIZE = 0x400000
+SPARSE_BLOCK_SIZE = 0x10000
+ZERO_BLOCK = bytes(SPARSE_BLOCK_SIZE)
+
+# Interval between progress reports, in seconds
+PROGRESS_INTERVAL = 5
+
 # Special value for e_phnum. This indicates that the real number of
 # program headers is too large to fit into e_phnum. Instead the real
 # value is in the field sh_info of section 0.
@@ -53,6 +79,26 @@
 
 VMCOREINFO_FORMAT_ELF = 1
 
+# kdump-compressed format, as written by the dump-guest-memory QMP command
+KDUMP_SIGNATURE = b"KDUMP   "
+KDUMP_HEADER_VERSION = 6
+DISKDUMP_HEADER_BLOCKS = 1
+DUMP_LEVEL = 1
+DUMP_DH_COMPRESSED_ZLIB = 0x1
+DUMP_DH_COMPRESSED_LZO = 0x2
+DUMP_DH_COMPRESSED_SNAPPY = 0x4
+ZERO_PAGE = bytes(TARGET_PAGE_SIZE)
+
+KDUMP_MACHINE_UNAME = {
+    'aarch64-le': 'aarch64',
+    'aarch64-be': 'aarch64',
+    'X86_64': 'x86_64',
+    '386': 'i686',
+    's390': 'S390X',
+    'ppc64-le': 'ppc64le',
+    'ppc64-be': 'ppc64',
+}
+
 def le16_to_cpu(val):
     return struct.unpack("<H", struct.pack("=H", val))[0]
 
@@ -62,6 +108,9 @@ def le32_to_cpu(val):
 def le64_to_cpu(val):
     return struct.unpack("<Q", struct.pack("=Q", val))[0]
 
+def div_round_up(val, divisor):
+    return (val + divisor - 1) // divisor
+
 class ELF(object):
     """Representation of a ELF file."""
 
@@ -348,6 +397,65 @@ class PHDR32(superclass):
         return PHDR32()
 
 
+def get_kdump_headers(endianness, elfclass):
+    """Returns the disk dump header and kdump sub header of the
+    kdump-compressed format, with the specified endianness and class."""
+
+    if endianness == ELFDATA2LSB:
+        superclass = ctypes.LittleEndianStructure
+    else:
+        superclass = ctypes.BigEndianStructure
+
+    if elfclass == ELFCLASS64:
+        ulong = ctypes.c_uint64
+        timestamp_len = 22
+    else:
+        ulong = ctypes.c_uint32
+        timestamp_len = 10
+
+    class NewUtsname(ctypes.Structure):
+        _pack_ = 1
+        _fields_ = [(name, ctypes.c_char * 65)
+                    for name in ("sysname", "nodename", "release", "version",
+                                 "machine", "domainname")]
+
+    class DiskDumpHeader(superclass):
+        _pack_ = 1
+        _fields_ = [("signature", ctypes.c_char * len(KDUMP_SIGNATURE)),
+                    ("header_version", ctypes.c_uint32),
+                    ("utsname", NewUtsname),
+                    ("timestamp", ctypes.c_char * timestamp_len),
+                    ("status", ctypes.c_uint32),
+                    ("block_size", ctypes.c_uint32),
+                    ("sub_hdr_size", ctypes.c_uint32),
+                    ("bitmap_blocks", ctypes.c_uint32),
+                    ("max_mapnr", ctypes.c_uint32),
+                    ("total_ram_blocks", ctypes.c_uint32),
+                    ("device_blocks", ctypes.c_uint32),
+                    ("written_blocks", ctypes.c_uint32),
+                    ("current_cpu", ctypes.c_uint32),
+                    ("nr_cpus", ctypes.c_uint32)]
+
+    class KdumpSubHeader(superclass):
+        _pack_ = 1
+        _fields_ = [("phys_base", ulong),
+                    ("dump_level", ctypes.c_uint32),
+                    ("split", ctypes.c_uint32),
+                    ("start_pfn", ulong),
+                    ("end_pfn", ulong),
+                    ("offset_vmcoreinfo", ctypes.c_uint64),
+                    ("size_vmcoreinfo", ulong),
+                    ("offset_note", ctypes.c_uint64),
+                    ("note_size", ulong),
+                    ("offset_eraseinfo", ctypes.c_uint64),
+                    ("size_eraseinfo", ulong),
+                    ("start_pfn_64", ctypes.c_uint64),
+                    ("end_pfn_64", ctypes.c_uint64),
+                    ("max_mapnr_64", ctypes.c_uint64)]
+
+    return DiskDumpHeader(), KdumpSubHeader()
+
+
 def int128_get64(val):
     """Returns low 64bit part of Int128 struct."""
 
@@ -464,6 +572,308 @@ def get_guest_phys_blocks():
     return guest_phys_blocks
 
 
+def pwrite_all(fd, data, offset):
+    """Writes all of data at offset, without moving the file position."""
+    view = memoryview(data)
+    pos = 0
+    while pos < len(view):
+        pos += os.pwrite(fd, view[pos:], offset + pos)
+
+
+class ChunkWriter(object):
+    """Writes chunks of guest memory at their offset in the vmcore,
+    leaving holes for zeroes, from a pool of threads if jobs > 1."""
+
+    def __init__(self, fd, jobs):
+        self.fd = fd
+        self.executor = None
+        if jobs > 1:
+            self.executor = ThreadPoolExecutor(jobs)
+            # Bound the memory used by the chunks not written yet
+            self.slots = threading.BoundedSemaphore(2 * jobs)
+            self.futures = []
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+    def write(self, chunk, offset):
+        """Writes chunk at offset. Returns the number of bytes that were
+        zeroes and not written."""
+        runs, skipped = self.nonzero_runs(chunk)
+        if not runs:
+            return skipped
+        if self.executor is None:
+            self.write_runs(chunk, offset, runs)
+            return skipped
+        self.slots.acquire()
+        for future in [f for f in self.futures if f.done()]:
+            # Raise the errors of the previous writes
+            future.result()
+            self.futures.remove(future)
+        future = self.executor.submit(self.write_runs, chunk, offset, runs)
+        future.add_done_callback(lambda f: self.slots.release())
+        self.futures.append(future)
+        return skipped
+
+    @staticmethod
+    def nonzero_runs(chunk):
+        """Returns the (start, end) ranges of chunk that are not zero, and
+        the number of zero bytes outside of them."""
+        runs = []
+        skipped = 0
+        for start in range(0, len(chunk), SPARSE_BLOCK_SIZE):
+            end = min(start + SPARSE_BLOCK_SIZE, len(chunk))
+            if chunk[start:end] == ZERO_BLOCK[:end - start]:
+                skipped += end - start
+            elif runs and runs[-1][1] == start:
+                runs[-1] = (runs[-1][0], end)
+            else:
+                runs.append((start, end))
+        return runs, skipped
+
+    def write_runs(self, chunk, offset, runs):
+        view = memoryview(chunk)
+        for start, end in runs:
+            pwrite_all(self.fd, view[start:end], offset + start)
+
+    def close(self):
+        """Waits for the pending writes, and raises their errors."""
+        if self.executor is None:
+            return
+        self.executor.shutdown(wait=True)
+        for future in self.futures:
+            future.result()
+        self.executor = None
+
+
+class DumpProgress(object):
+    """Prints the progress and throughput of a dump."""
+
+    def __init__(self, total):
+        self.total = total
+        self.done_bytes = 0
+        self.zero_bytes = 0
+        self.start = time.time()
+        self.last_report = self.start
+
+    def update(self, size, zero_bytes):
+        self.done_bytes += size
+        self.zero_bytes += zero_bytes
+        now = time.time()
+        if now - self.last_report >= PROGRESS_INTERVAL:
+            self.last_report = now
+            print("dumped %d of %d MiB (%d%%), %.1f MiB/s" %
+                  (self.done_bytes >> 20, self.total >> 20,
+                   100 * self.done_bytes // max(self.total, 1),
+                   self.done_bytes / (now - self.start) / (1 << 20)))
+
+    def done(self):
+        elapsed = max(time.time() - self.start, 1e-6)
+        print("dumped %d MiB in %.1f s, %.1f MiB/s, %d MiB of zeroes "
+              "not written" %
+              (self.done_bytes >> 20, elapsed,
+               self.done_bytes / elapsed / (1 << 20), self.zero_bytes >> 20))
+
+
+class KdumpFile(object):
+    """Writes guest memory in the kdump-compressed format of makedumpfile,
+    like the dump-guest-memory QMP command does. Pages are compressed
+    from a pool of threads if jobs > 1.
+
+    Structure:
+    Disk dump header                (block 0)
+    Kdump sub header, ELF notes     (sub_hdr_size blocks)
+    1st and 2nd dump bitmap         (bitmap_blocks blocks)
+    Page descriptors                (one per dumpable page)
+    Zero page, page data
+    """
+
+    def __init__(self, fd, elf, arch, guest_phys_blocks, flag_compress,
+                 jobs):
+        self.fd = fd
+        self.elf = elf
+        self.arch = arch
+        self.guest_phys_blocks = guest_phys_blocks
+        self.flag_compress = flag_compress
+        self.block_size = TARGET_PAGE_SIZE
+        if elf.endianness == ELFDATA2LSB:
+            self.desc_fmt = "<QIIQ"
+        else:
+            self.desc_fmt = ">QIIQ"
+        self.max_mapnr = 0
+        self.num_dumpable = 0
+        for block in guest_phys_blocks:
+            start, end = self.block_pfns(block)
+            self.max_mapnr = max(self.max_mapnr, end)
+            self.num_dumpable += end - start
+        self.len_dump_bitmap = div_round_up(div_round_up(self.max_mapnr, 8),
+                                            self.block_size) * self.block_size
+        self.offset_desc = None
+        self.offset_data = None
+        self.zero_desc = None
+
+        self.executor = None
+        if jobs > 1:
+            self.executor = ThreadPoolExecutor(jobs)
+            # Chunks compressed ahead of the writes, written in order
+            self.window = 2 * jobs
+            self.pending = deque()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+    def block_pfns(self, block):
+        """Returns the range of page frame numbers of a guest block."""
+        return (block["target_start"] // self.block_size,
+                div_round_up(block["target_end"], self.block_size))
+
+    def write_headers(self):
+        """Writes the headers, the notes and the bitmaps, and sets the
+        offsets of the page descriptors and of the page data."""
+
+        header, sub_header = get_kdump_headers(self.elf.endianness,
+                                               self.elf.elfclass)
+        notes = b"".join(bytes(note) for note in self.elf.notes)
+        sub_hdr_size = div_round_up(ctypes.sizeof(sub_header) + len(notes),
+                                    self.block_size)
+        bitmap_blocks = 2 * self.len_dump_bitmap // self.block_size
+
+        header.signature = KDUMP_SIGNATURE
+        header.header_version = KDUMP_HEADER_VERSION
+        header.utsname.machine = KDUMP_MACHINE_UNAME[self.arch].encode()
+        header.status = self.flag_compress
+        header.block_size = self.block_size
+        header.sub_hdr_size = sub_hdr_size
+        header.bitmap_blocks = bitmap_blocks
+        header.max_mapnr = min(self.max_mapnr, 0xffffffff)
+        header.nr_cpus = 1
+
+        sub_header.dump_level = DUMP_LEVEL
+        sub_header.offset_note = (DISKDUMP_HEADER_BLOCKS * self.block_size +
+                                  ctypes.sizeof(sub_header))
+        sub_header.note_size = len(notes)
+        sub_header.max_mapnr_64 = self.max_mapnr
+        offset = sub_header.offset_note
+        for note in self.elf.notes:
+            if note.n_name == b"VMCOREINFO":
+                sub_header.offset_vmcoreinfo = offset + type(note).n_desc.offset
+                sub_header.size_vmcoreinfo = note.n_descsz
+            offset += ctypes.sizeof(note)
+
+        pwrite_all(self.fd, bytes(header), 0)
+        pwrite_all(self.fd, bytes(sub_header) + notes,
+                   DISKDUMP_HEADER_BLOCKS * self.block_size)
+
+        # Every page of the guest blocks is dumped, so both bitmaps are
+        # the same
+        bitmap = bytearray(self.len_dump_bitmap)
+        for block in self.guest_phys_blocks:
+            pfn, end = self.block_pfns(block)
+            while pfn < end and pfn % 8:
+                bitmap[pfn // 8] |= 1 << (pfn % 8)
+                pfn += 1
+            full = (end - pfn) // 8
+            bitmap[pfn // 8:pfn // 8 + full] = b"\xff" * full
+            pfn += 8 * full
+            while pfn < end:
+                bitmap[pfn // 8] |= 1 << (pfn % 8)
+                pfn += 1
+        offset = (DISKDUMP_HEADER_BLOCKS + sub_hdr_size) * self.block_size
+        pwrite_all(self.fd, bitmap + bitmap, offset)
+
+        # Zero pages are not stored, their descriptors all point to a
+        # single zero page at the start of the page data
+        self.offset_desc = offset + bitmap_blocks * self.block_size
+        self.offset_data = (self.offset_desc +
+                            struct.calcsize(self.desc_fmt) * self.num_dumpable)
+        self.zero_desc = struct.pack(self.desc_fmt, self.offset_data,
+                                     self.block_size, 0, 0)
+        pwrite_all(self.fd, ZERO_PAGE, self.offset_data)
+        self.offset_data += self.block_size
+
+    def compress_page(self, page):
+        if self.flag_compress == DUMP_DH_COMPRESSED_ZLIB:
+            return zlib.compress(page, 1)
+        if self.flag_compress == DUMP_DH_COMPRESSED_LZO:
+            return lzo.compress(bytes(page), 1, False)
+        return snappy.compress(bytes(page))
+
+    def compress_chunk(self, chunk):
+        """Returns the (flags, data) of each page of chunk, or None for
+        zero pages. Pages are stored uncompressed unless it saves space."""
+        pages = []
+        view = memoryview(chunk)
+        for start in range(0, len(chunk), self.block_size):
+            page = view[start:start + self.block_size]
+            if page == ZERO_PAGE:
+                pages.append(None)
+                continue
+            data = self.compress_page(page)
+            if len(data) < self.block_size:
+                pages.append((self.flag_compress, data))
+            else:
+                pages.append((0, page.tobytes()))
+        return pages
+
+    def write_pages(self, pages):
+        """Writes the descriptors and the data of compressed pages.
+        Returns the number of bytes of zero pages."""
+        descs = []
+        data = []
+        zero_pages = 0
+        offset = self.offset_data
+        for page in pages:
+            if page is None:
+                descs.append(self.zero_desc)
+                zero_pages += 1
+                continue
+            flags, buf = page
+            descs.append(struct.pack(self.desc_fmt, offset, len(buf),
+                                     flags, 0))
+            data.append(buf)
+            offset += len(buf)
+        descs = b"".join(descs)
+        pwrite_all(self.fd, descs, self.offset_desc)
+        pwrite_all(self.fd, b"".join(data), self.offset_data)
+        self.offset_desc += len(descs)
+        self.offset_data = offset
+        return zero_pages * self.block_size
+
+    def write(self, chunk):
+        """Compresses and writes the pages of chunk, whose size must be a
+        multiple of the page size. Returns the number of bytes of zero
+        pages written so far that were not stored."""
+        if self.executor is None:
+            return self.write_pages(self.compress_chunk(chunk))
+        self.pending.append(self.executor.submit(self.compress_chunk, chunk))
+        zero_bytes = 0
+        while len(self.pending) > self.window:
+            zero_bytes += self.write_pages(self.pending.popleft().result())
+        return zero_bytes
+
+    def close(self):
+        """Writes the pages still being compressed. Returns the number of
+        bytes of zero pages among them."""
+        zero_bytes = 0
+        if self.executor is not None:
+            try:
+                while self.pending:
+                    zero_bytes += self.write_pages(
+                        self.pending.popleft().result())
+            finally:
+                for future in self.pending:
+                    future.cancel()
+                self.executor.shutdown(wait=True)
+                self.executor = None
+        return zero_bytes
+
+
 # The leading docstring doesn't have idiomatic Python formatting. It is
 # printed by gdb's "help" command (the first line is printed in the
 # "help data" summary), and it should match how other help texts look in
@@ -471,10 +881,22 @@ def get_guest_phys_blocks():
 class DumpGuestMemory(gdb.Command):
     """Extract guest vmcore from qemu process coredump.
 
+Usage: dump-guest-memory [-j JOBS] [-z|-l|-s] FILE ARCH
+
 The two required arguments are FILE and ARCH:
 FILE identifies the target file to write the guest vmcore to.
 ARCH specifies the architecture for which the core will be generated.
 
+By default, the vmcore is an ELF file. With -z, -l or -s, it is written
+in the kdump-compressed format instead, with pages compressed by zlib,
+lzo or snappy respectively. lzo and snappy need the python-lzo and
+python-snappy modules.
+
+With -j, JOBS threads write (or compress) the vmcore in parallel; by
+default, it is done by a single thread. Guest memory that only holds
+zeroes is not written: it is left as holes in ELF files if the file
+system supports it, and zero pages share the same data in kdump files.
+
 This GDB command reimplements the dump-guest-memory QMP command in
 python, using the representation of guest memory as captured in the qemu
 coredump. The qemu process that has been dumped must have had the
@@ -506,6 +928,8 @@ def __init__(self):
                                               gdb.COMPLETE_FILENAME)
         self.elf = None
         self.guest_phys_blocks = None
+        self.jobs = 1
+        self.flag_compress = 0
 
     def dump_init(self, vmcore):
         """Prepares and writes ELF structures to core file."""
@@ -531,18 +955,65 @@ def dump_iterate(self, vmcore):
         """Writes guest core to file."""
 
         qemu_core = gdb.inferiors()[0]
-        for block in self.guest_phys_blocks:
-            cur = block["host_addr"]
-            left = block["target_end"] - block["target_start"]
-            print("dumping range at %016x for length %016x" %
-                  (cur.cast(UINTPTR_T), left))
-
-            while left > 0:
-                chunk_size = min(TARGET_PAGE_SIZE, left)
-                chunk = qemu_core.read_memory(cur, chunk_size)
-                vmcore.write(chunk)
-                cur += chunk_size
-                left -= chunk_size
+        offset = vmcore.tell()
+        total = sum(block["target_end"] - block["target_start"]
+                    for block in self.guest_phys_blocks)
+        # Zero memory is skipped, make sure the file has its final size
+        vmcore.flush()
+        vmcore.truncate(offset + total)
+        progress = DumpProgress(total)
+
+        with ChunkWriter(vmcore.fileno(), self.jobs) as writer:
+            for block in self.guest_phys_blocks:
+                cur = block["host_addr"]
+                left = block["target_end"] - block["target_start"]
+                print("dumping range at %016x for length %016x" %
+                      (cur.cast(UINTPTR_T), left))
+
+                while left > 0:
+                    chunk_size = min(READ_CHUNK_SIZE, left)
+                    chunk = bytes(qemu_core.read_memory(cur, chunk_size))
+                    progress.update(chunk_size,
+                                    writer.write(chunk, offset))
+                    cur += chunk_size
+                    offset += chunk_size
+                    left -= chunk_size
+
+        progress.done()
+
+    def dump_kdump(self, vmcore, arch):
+        """Writes guest core to file in the kdump-compressed format."""
+
+        # Needed to make crash happy, as in dump_init()
+        self.elf.add_note("NONE", "EMPTY", 0)
+
+        qemu_core = gdb.inferiors()[0]
+        total = sum(block["target_end"] - block["target_start"]
+                    for block in self.guest_phys_blocks)
+        progress = DumpProgress(total)
+
+        with KdumpFile(vmcore.fileno(), self.elf, arch,
+                       self.guest_phys_blocks, self.flag_compress,
+                       self.jobs) as kdump:
+            kdump.write_headers()
+            for block in self.guest_phys_blocks:
+                cur = block["host_addr"]
+                left = block["target_end"] - block["target_start"]
+                print("dumping range at %016x for length %016x" %
+                      (cur.cast(UINTPTR_T), left))
+
+                while left > 0:
+                    chunk_size = min(READ_CHUNK_SIZE, left)
+                    chunk = bytes(qemu_core.read_memory(cur, chunk_size))
+                    if chunk_size % TARGET_PAGE_SIZE:
+                        # The last page of the block is partial
+                        chunk += bytes(-chunk_size % TARGET_PAGE_SIZE)
+                    progress.update(chunk_size, kdump.write(chunk))
+                    cur += chunk_size
+                    left -= chunk_size
+            progress.update(0, kdump.close())
+
+        progress.done()
 
     def phys_memory_read(self, addr, size):
         qemu_core = gdb.inferiors()[0]
@@ -583,16 +1054,48 @@ def invoke(self, args, from_tty):
         # not dump the same multi-gig coredump to the same file.
         self.dont_repeat()
 
+        usage = "usage: dump-guest-memory [-j JOBS] [-z|-l|-s] FILE ARCH"
         argv = gdb.string_to_argv(args)
+        self.jobs = 1
+        self.flag_compress = 0
+        while len(argv) > 2:
+            opt = argv.pop(0)
+            if opt == "-j":
+                jobs = argv.pop(0)
+                try:
+                    self.jobs = int(jobs)
+                except ValueError:
+                    self.jobs = 0
+                if self.jobs < 1:
+                    raise gdb.GdbError("dump-guest-memory: invalid number "
+                                       "of jobs '%s'" % jobs)
+            elif opt == "-z":
+                self.flag_compress = DUMP_DH_COMPRESSED_ZLIB
+            elif opt == "-l":
+                if lzo is None:
+                    raise gdb.GdbError("dump-guest-memory: lzo compression "
+                                       "needs the python-lzo module")
+                self.flag_compress = DUMP_DH_COMPRESSED_LZO
+            elif opt == "-s":
+                if snappy is None:
+                    raise gdb.GdbError("dump-guest-memory: snappy "
+                                       "compression needs the "
+                                       "python-snappy module")
+                self.flag_compress = DUMP_DH_COMPRESSED_SNAPPY
+            else:
+                raise gdb.GdbError(usage)
         if len(argv) != 2:
-            raise gdb.GdbError("usage: dump-guest-memory FILE ARCH")
+            raise gdb.GdbError(usage)
 
         self.elf = ELF(argv[1])
         self.guest_phys_blocks = get_guest_phys_blocks()
         self.add_vmcoreinfo()
 
         with open(argv[0], "wb") as vmcore:
-            self.dump_init(vmcore)
-            self.dump_iterate(vmcore)
+            if self.flag_compress:
+                self.dump_kdump(vmcore, argv[1])
+            else:
+                self.dump_init(vmcore)
+                self.dump_iterate(vmcore)
 
 DumpGuestMemory()
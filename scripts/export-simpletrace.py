@@ -0,0 +1,195 @@
+#!/usr/bin/env python3
+#
+# Export a simpletrace log to columnar Parquet or Arrow files
+#
+# This work is licensed under the terms of the GNU GPL, version 2 or later.
+# See the COPYING file in the top-level directory.
+#
+# Usage: ./export-simpletrace.py [options] [<trace-events>] <trace-file> <dir>
+#
+# One file is written per event type, named after the event, with a
+# timestamp_ns and a pid column followed by one column per event argument.
+# Argument columns are typed according to the C types declared in the
+# trace-events file, or in the trace file if it describes its events.
+# Arguments named like the first two columns are exported as
+# arg_timestamp_ns and arg_pid.
+
+import argparse
+import os
+
+import pyarrow as pa
+import pyarrow.parquet as pq
+
+import simpletrace
+from tracetool.backend.simple import is_string
+
+
+C_TYPES = {
+    "bool": pa.bool_(),
+    "char": pa.int8(),
+    "signed char": pa.int8(),
+    "unsigned char": pa.uint8(),
+    "short": pa.int16(),
+    "short int": pa.int16(),
+    "signed short": pa.int16(),
+    "unsigned short": pa.uint16(),
+    "int": pa.int32(),
+    "signed": pa.int32(),
+    "signed int": pa.int32(),
+    "unsigned": pa.uint32(),
+    "unsigned int": pa.uint32(),
+    "long": pa.int64(),
+    "long int": pa.int64(),
+    "signed long": pa.int64(),
+    "unsigned long": pa.uint64(),
+    "long long": pa.int64(),
+    "unsigned long long": pa.uint64(),
+    "int8_t": pa.int8(),
+    "uint8_t": pa.uint8(),
+    "int16_t": pa.int16(),
+    "uint16_t": pa.uint16(),
+    "int32_t": pa.int32(),
+    "uint32_t": pa.uint32(),
+    "int64_t": pa.int64(),
+    "uint64_t": pa.uint64(),
+    "size_t": pa.uint64(),
+    "ssize_t": pa.int64(),
+    "uintptr_t": pa.uint64(),
+    "ptrdiff_t": pa.int64(),
+}
+
+HEADER_COLUMNS = ("timestamp_ns", "pid")
+
+
+def arrow_type(c_type):
+    """Return the Arrow type of a trace event argument of the given C type."""
+    if is_string(c_type):
+        return pa.string()
+    if c_type.endswith("*"):
+        return pa.uint64()
+    c_type = " ".join(bit for bit in c_type.split() if bit != "const")
+    return C_TYPES.get(c_type, pa.uint64())
+
+
+def converter(c_type, type_):
+    """Return a function converting the value of an argument as stored in
+    the log to a Python value of the argument's Arrow type."""
+    if is_string(c_type):
+        return lambda value: value.decode("utf-8", "replace")
+    if pa.types.is_boolean(type_):
+        return bool
+    if pa.types.is_signed_integer(type_):
+        # Signed arguments are sign-extended to 64 bits in the log
+        return lambda value: value - (1 << 64) if value >> 63 else value
+    if type_.bit_width < 64:
+        mask = (1 << type_.bit_width) - 1
+        return lambda value: value & mask
+    return None
+
+
+class EventTable(object):
+    "Buffered columns of one event type, written out in batches."
+
+    def __init__(self, event, path, fmt, compression):
+        fields = [pa.field("timestamp_ns", pa.uint64()),
+                  pa.field("pid", pa.uint32())]
+        self.converters = []
+        for c_type, name in event.args:
+            type_ = arrow_type(c_type)
+            if name in HEADER_COLUMNS:
+                name = "arg_" + name
+            fields.append(pa.field(name, type_))
+            self.converters.append(converter(c_type, type_))
+        self.fields = fields
+        self.schema = pa.schema(fields)
+        self.columns = [[] for _ in fields]
+
+        if fmt == "parquet":
+            self.writer = pq.ParquetWriter(path, self.schema,
+                                           compression=compression)
+        else:
+            options = pa.ipc.IpcWriteOptions(compression=compression)
+            self.writer = pa.ipc.new_file(path, self.schema, options=options)
+
+    def append(self, rec):
+        columns = self.columns
+        for i, value in enumerate(rec[1:len(columns) + 1]):
+            columns[i].append(value)
+        return len(columns[0])
+
+    def flush(self):
+        if not self.columns[0]:
+            return
+        arrays = [pa.array(self.columns[0], pa.uint64()),
+                  pa.array(self.columns[1], pa.uint32())]
+        for conv, field, values in zip(self.converters, self.fields[2:],
+                                       self.columns[2:]):
+            if conv is not None:
+                values = [conv(value) for value in values]
+            arrays.append(pa.array(values, field.type))
+        self.writer.write_batch(pa.RecordBatch.from_arrays(arrays,
+                                                           schema=self.schema))
+        self.columns = [[] for _ in self.columns]
+
+    def close(self):
+        self.flush()
+        self.writer.close()
+
+
+class ColumnarExporter(simpletrace.Analyzer):
+    "A simpletrace Analyzer writing one columnar file per event type."
+
+    def __init__(self, directory, fmt="parquet", compression="zstd",
+                 batch_size=65536):
+        self.directory = directory
+        self.fmt = fmt
+        self.compression = compression
+        self.batch_size = batch_size
+        self.tables = {}
+
+    def begin(self):
+        os.makedirs(self.directory, exist_ok=True)
+
+    def catchall(self, event, rec):
+        name = rec[0]
+        table = self.tables.get(name)
+        if table is None:
+            path = os.path.join(self.directory, "%s.%s" % (name, self.fmt))
+            table = EventTable(event, path, self.fmt, self.compression)
+            self.tables[name] = table
+        if table.append(rec) >= self.batch_size:
+            table.flush()
+
+    def end(self):
+        for table in self.tables.values():
+            table.close()
+
+
+def get_args():
+    "Grab options"
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--format", choices=["parquet", "arrow"],
+                        default="parquet", help="output file format")
+    parser.add_argument("--compression", default="zstd",
+                        help="compression codec, e.g. zstd, lz4, snappy "
+                             "(Parquet only) or none")
+    parser.add_argument("--batch-size", type=int, default=65536,
+                        help="rows buffered per event type before writing")
+    parser.add_argument("--follow", "-f", action="store_true",
+                        help="keep exporting records as they are appended "
+                             "to the trace file, until interrupted")
+    parser.add_argument("events", type=str, nargs="?",
+                        help="trace events file, not needed if the trace "
+                             "file describes its events")
+    parser.add_argument("tracefile", type=str, help="trace file read from")
+    parser.add_argument("directory", type=str, help="output directory")
+    return parser.parse_args()
+
+
+if __name__ == '__main__':
+    args = get_args()
+    compression = None if args.compression == "none" else args.compression
+    exporter = ColumnarExporter(args.directory, args.format, compression,
+                                args.batch_size)
+    simpletrace.process(args.events, args.tracefile, exporter,
+                        follow=args.follow)
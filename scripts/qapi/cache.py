@@ -0,0 +1,206 @@
+#
+# QAPI schema cache
+#
+# This work is licensed under the terms of the GNU GPL, version 2.
+# See the COPYING file in the top-level directory.
+
+"""
+QAPI schema cache
+
+Persistent cache of parsed and checked QAPI schemas, so that qapi-gen
+does not parse again the source files that it has already seen.
+"""
+
+import hashlib
+import io
+import os
+import pickle
+from typing import (
+    TYPE_CHECKING,
+    Dict,
+    List,
+    Optional,
+    Tuple,
+)
+
+
+if TYPE_CHECKING:
+    # pylint: disable=cyclic-import
+    from .parser import QAPISchemaParser
+    from .schema import QAPISchema
+
+
+def package_digest() -> str:
+    """Hash the source code of the QAPI package."""
+    hsh = hashlib.sha256()
+    pkg_dir = os.path.dirname(os.path.abspath(__file__))
+    for name in sorted(os.listdir(pkg_dir)):
+        if name.endswith('.py'):
+            with open(os.path.join(pkg_dir, name), 'rb') as file:
+                hsh.update(name.encode('utf-8') + b'\0' + file.read())
+    return hsh.hexdigest()
+
+
+def _source_digest(src: str) -> str:
+    return hashlib.sha256(src.encode('utf-8')).hexdigest()
+
+
+class _Pickler(pickle.Pickler):
+    """Pickle objects, except for references to the external objects."""
+    def __init__(self, file: io.BytesIO, externals: Dict[str, object]):
+        super().__init__(file, pickle.HIGHEST_PROTOCOL)
+        self._pids = {id(obj): pid for pid, obj in externals.items()}
+
+    def persistent_id(self, obj: object) -> Optional[str]:
+        return self._pids.get(id(obj))
+
+
+class _Unpickler(pickle.Unpickler):
+    """Unpickle objects, resolving references to the external objects."""
+    def __init__(self, file: io.BytesIO, externals: Dict[str, object]):
+        super().__init__(file)
+        self._externals = externals
+
+    def persistent_load(self, pid: str) -> object:
+        return self._externals[pid]
+
+
+class QAPISchemaCache:
+    """
+    Content-addressed cache of parsed and checked QAPI schemas.
+
+    Entries are pickles in ``cache_dir``, named after a hash of their key.
+    All keys cover the source code of the QAPI package, so changing the
+    generator invalidates the whole cache.
+
+    The parse results of a source file are keyed by its contents, so that
+    schemas including the same files share them even if they name them
+    differently.  They do not cover the files it includes, and refer to
+    its name, to the including file's `QAPISourceInfo` and to the schema's
+    pragmas by reference, so that they can be reused in another context.
+
+    Checked schemas are keyed by the name of their main file, and are only
+    used if none of their source files changed since.
+
+    Errors accessing the cache are ignored: it is only an optimization.
+
+    :param cache_dir: The directory holding the cache entries.
+    """
+    def __init__(self, cache_dir: str):
+        self._dir = cache_dir
+        self._version = package_digest()
+        # (name, digest) of the source files parsed so far
+        self._sources: List[Tuple[str, str]] = []
+
+    def _key(self, *parts: str) -> str:
+        hsh = hashlib.sha256(self._version.encode('utf-8'))
+        for part in parts:
+            hsh.update(b'\0' + part.encode('utf-8'))
+        return hsh.hexdigest()
+
+    def _path(self, key: str) -> str:
+        return os.path.join(self._dir, key + '.pickle')
+
+    def _read(self, key: str) -> Optional[bytes]:
+        try:
+            with open(self._path(key), 'rb') as file:
+                return file.read()
+        except OSError:
+            return None
+
+    def _write(self, key: str, data: bytes) -> None:
+        path = self._path(key)
+        # Other qapi-gen processes may be writing the same entry
+        tmp_path = f'{path}.{os.getpid()}'
+        try:
+            os.makedirs(self._dir, exist_ok=True)
+            with open(tmp_path, 'wb') as file:
+                file.write(data)
+            os.replace(tmp_path, path)
+        except OSError:
+            pass
+
+    @staticmethod
+    def _module_externals(parser: 'QAPISchemaParser') -> Dict[str, object]:
+        externals = {'parser': parser, 'fname': parser.info.fname,
+                     'pragma': parser.info.pragma}
+        if parser.info.parent:
+            externals['parent'] = parser.info.parent
+        return externals
+
+    def _module_key(self, parser: 'QAPISchemaParser') -> str:
+        return self._key('module', _source_digest(parser.src),
+                         'included' if parser.info.parent else 'main')
+
+    def load_module(self,
+                    parser: 'QAPISchemaParser'
+                    ) -> Optional[List[Tuple[str, object]]]:
+        """
+        Look up the parse results of a source file.
+
+        :param parser: The parser of the file, which has read its source.
+        :return: The items recorded by `store_module`, or ``None``.
+        """
+        self._sources.append((parser.info.fname, _source_digest(parser.src)))
+        data = self._read(self._module_key(parser))
+        if data is None:
+            return None
+        try:
+            items: List[Tuple[str, object]] = _Unpickler(
+                io.BytesIO(data), self._module_externals(parser)).load()
+        except Exception:  # pylint: disable=broad-except
+            return None
+        return items
+
+    def store_module(self, parser: 'QAPISchemaParser',
+                     items: List[Tuple[str, object]]) -> None:
+        """
+        Store the parse results of a source file.
+
+        :param parser: The parser of the file.
+        :param items: The file's expressions, documentation blocks and
+                      directives.
+        """
+        buf = io.BytesIO()
+        _Pickler(buf, self._module_externals(parser)).dump(items)
+        self._write(self._module_key(parser), buf.getvalue())
+
+    def _schema_key(self, fname: str) -> str:
+        return self._key('schema', fname, os.path.abspath(fname))
+
+    def load_schema(self, fname: str) -> Optional['QAPISchema']:
+        """
+        Look up a checked schema.
+
+        :param fname: The main source file of the schema.
+        :return: The schema, or ``None`` if it is not in the cache or if
+                 any of its source files changed.
+        """
+        data = self._read(self._schema_key(fname))
+        if data is None:
+            return None
+        try:
+            sources, schema_data = pickle.loads(data)
+            for src_fname, digest in sources:
+                with open(src_fname, 'r', encoding='utf-8') as file:
+                    src = file.read()
+                # Same as QAPISchemaParser
+                if src == '' or src[-1] != '\n':
+                    src += '\n'
+                if _source_digest(src) != digest:
+                    return None
+            schema: 'QAPISchema' = pickle.loads(schema_data)
+        except Exception:  # pylint: disable=broad-except
+            return None
+        return schema
+
+    def store_schema(self, schema: 'QAPISchema') -> None:
+        """
+        Store a checked schema, built with this cache.
+
+        :param schema: The schema.
+        """
+        schema_data = pickle.dumps(schema, pickle.HIGHEST_PROTOCOL)
+        self._write(self._schema_key(schema.fname),
+                    pickle.dumps((self._sources, schema_data),
+                                 pickle.HIGHEST_PROTOCOL))
@@ -24,12 +24,15 @@
 from .common import c_name, mcgen
 from .gen import (
     QAPIGenC,
+    QAPIGenFingerprints,
     QAPISchemaModularCVisitor,
     build_params,
     ifcontext,
 )
 from .schema import (
     QAPISchema,
+    QAPISchemaCommand,
+    QAPISchemaEntity,
     QAPISchemaFeature,
     QAPISchemaObjectType,
     QAPISchemaType,
@@ -242,10 +245,12 @@ def gen_register_command(name: str,
 
 
 class QAPISchemaGenCommandVisitor(QAPISchemaModularCVisitor):
-    def __init__(self, prefix: str):
+    def __init__(self, prefix: str,
+                 fingerprints: Optional[QAPIGenFingerprints] = None):
         super().__init__(
             prefix, 'qapi-commands',
-            ' * Schema-defined QAPI/QMP commands', None, __doc__)
+            ' * Schema-defined QAPI/QMP commands', None, __doc__,
+            fingerprints)
         self._visited_ret_types: Dict[QAPIGenC, Set[QAPISchemaType]] = {}
 
     def _begin_user_module(self, name: str) -> None:
@@ -298,6 +303,30 @@ def visit_end(self) -> None:
 }
 '''))
 
+    def _register_command(self,
+                          name: str,
+                          ifcond: Sequence[str],
+                          features: List[QAPISchemaFeature],
+                          success_response: bool,
+                          allow_oob: bool,
+                          allow_preconfig: bool,
+                          coroutine: bool) -> None:
+        with self._temp_module('./init'):
+            with ifcontext(ifcond, self._genh, self._genc):
+                self._genc.add(gen_register_command(
+                    name, features, success_response, allow_oob,
+                    allow_preconfig, coroutine))
+
+    def visit_needed(self, entity: QAPISchemaEntity) -> bool:
+        if super().visit_needed(entity):
+            return True
+        if isinstance(entity, QAPISchemaCommand) and entity.gen:
+            self._register_command(
+                entity.name, entity.ifcond, entity.features,
+                entity.success_response, entity.allow_oob,
+                entity.allow_preconfig, entity.coroutine)
+        return False
+
     def visit_command(self,
                       name: str,
                       info: Optional[QAPISourceInfo],
@@ -327,16 +356,14 @@ def visit_command(self,
             self._genh.add(gen_command_decl(name, arg_type, boxed, ret_type))
             self._genh.add(gen_marshal_decl(name))
             self._genc.add(gen_marshal(name, arg_type, boxed, ret_type))
-        with self._temp_module('./init'):
-            with ifcontext(ifcond, self._genh, self._genc):
-                self._genc.add(gen_register_command(
-                    name, features, success_response, allow_oob,
-                    allow_preconfig, coroutine))
+        self._register_command(name, ifcond, features, success_response,
+                               allow_oob, allow_preconfig, coroutine)
 
 
 def gen_commands(schema: QAPISchema,
                  output_dir: str,
-                 prefix: str) -> None:
-    vis = QAPISchemaGenCommandVisitor(prefix)
+                 prefix: str,
+                 fingerprints: Optional[QAPIGenFingerprints] = None) -> None:
+    vis = QAPISchemaGenCommandVisitor(prefix, fingerprints)
     schema.visit(vis)
     vis.write(output_dir)
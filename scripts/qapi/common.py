@@ -11,8 +11,17 @@
 # This work is licensed under the terms of the GNU GPL, version 2.
 # See the COPYING file in the top-level directory.
 
+from collections import OrderedDict
+from contextlib import contextmanager
 import re
-from typing import Match, Optional, Sequence
+import time
+from typing import (
+    Dict,
+    Iterator,
+    Match,
+    Optional,
+    Sequence,
+)
 
 
 #: Magic string that gets removed along with all space to its right.
@@ -216,3 +225,37 @@ def must_match(pattern: str, string: str) -> Match[str]:
     match = re.match(pattern, string)
     assert match is not None
     return match
+
+
+class QAPIProfile:
+    """
+    Time spent in the phases of code generation.
+
+    Phases run by worker processes may overlap, so the total reported
+    is the wall-clock time since the profile was created.
+
+    :ivar phases: The accumulated time of each phase, in seconds.
+    """
+    def __init__(self) -> None:
+        self.phases: Dict[str, float] = OrderedDict()
+        self._start = time.perf_counter()
+
+    @contextmanager
+    def phase(self, name: str) -> Iterator[None]:
+        """Account the time spent in the ``with`` block to phase ``name``."""
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.add(name, time.perf_counter() - start)
+
+    def add(self, name: str, elapsed: float) -> None:
+        """Account ``elapsed`` seconds to phase ``name``."""
+        self.phases[name] = self.phases.get(name, 0.0) + elapsed
+
+    def report(self) -> str:
+        lines = [f'{name:<12} {elapsed:8.3f}s'
+                 for name, elapsed in self.phases.items()]
+        total = time.perf_counter() - self._start
+        lines.append(f"{'total':<12} {total:8.3f}s")
+        return '\n'.join(lines)
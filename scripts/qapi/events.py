@@ -15,10 +15,17 @@
 from typing import List, Optional, Sequence
 
 from .common import c_enum_const, c_name, mcgen
-from .gen import QAPISchemaModularCVisitor, build_params, ifcontext
+from .gen import (
+    QAPIGenFingerprints,
+    QAPISchemaModularCVisitor,
+    build_params,
+    ifcontext,
+)
 from .schema import (
     QAPISchema,
+    QAPISchemaEntity,
     QAPISchemaEnumMember,
+    QAPISchemaEvent,
     QAPISchemaFeature,
     QAPISchemaObjectType,
 )
@@ -172,10 +179,11 @@ def gen_event_send(name: str,
 
 class QAPISchemaGenEventVisitor(QAPISchemaModularCVisitor):
 
-    def __init__(self, prefix: str):
+    def __init__(self, prefix: str,
+                 fingerprints: Optional[QAPIGenFingerprints] = None):
         super().__init__(
             prefix, 'qapi-events',
-            ' * Schema-defined QAPI/QMP events', None, __doc__)
+            ' * Schema-defined QAPI/QMP events', None, __doc__, fingerprints)
         self._event_enum_name = c_name(prefix + 'QAPIEvent', protect=False)
         self._event_enum_members: List[QAPISchemaEnumMember] = []
         self._event_emit_name = c_name(prefix + 'qapi_event_emit')
@@ -203,6 +211,14 @@ def _begin_user_module(self, name: str) -> None:
 ''',
                              types=types))
 
+    def visit_needed(self, entity: QAPISchemaEntity) -> bool:
+        if super().visit_needed(entity):
+            return True
+        if isinstance(entity, QAPISchemaEvent):
+            self._event_enum_members.append(
+                QAPISchemaEnumMember(entity.name, None))
+        return False
+
     def visit_end(self) -> None:
         self._add_module('./emit', ' * QAPI Events emission')
         self._genc.preamble_add(mcgen('''
@@ -243,7 +259,8 @@ def visit_event(self,
 
 def gen_events(schema: QAPISchema,
                output_dir: str,
-               prefix: str) -> None:
-    vis = QAPISchemaGenEventVisitor(prefix)
+               prefix: str,
+               fingerprints: Optional[QAPIGenFingerprints] = None) -> None:
+    vis = QAPISchemaGenEventVisitor(prefix, fingerprints)
     schema.visit(vis)
     vis.write(output_dir)
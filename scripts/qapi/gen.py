@@ -11,17 +11,23 @@
 # This work is licensed under the terms of the GNU GPL, version 2.
 # See the COPYING file in the top-level directory.
 
+from collections import OrderedDict
 from contextlib import contextmanager
+import hashlib
+import json
 import os
 import re
 from typing import (
     Dict,
     Iterator,
+    List,
     Optional,
     Sequence,
+    Set,
     Tuple,
 )
 
+from .cache import package_digest
 from .common import (
     c_fname,
     c_name,
@@ -32,8 +38,15 @@
     mcgen,
 )
 from .schema import (
+    QAPISchema,
+    QAPISchemaEntity,
+    QAPISchemaEnumMember,
+    QAPISchemaFeature,
     QAPISchemaModule,
     QAPISchemaObjectType,
+    QAPISchemaObjectTypeMember,
+    QAPISchemaType,
+    QAPISchemaVariants,
     QAPISchemaVisitor,
 )
 from .source import QAPISourceInfo
@@ -214,6 +227,194 @@ def ifcontext(ifcond: Sequence[str], *args: QAPIGenCCode) -> Iterator[None]:
         arg.end_if()
 
 
+class _QAPISchemaDependencyVisitor(QAPISchemaVisitor):
+    """Collect the entities of each module, and the types they use."""
+    def __init__(self) -> None:
+        self.modules: Dict[str, List[str]] = OrderedDict()
+        self.module_of: Dict[str, str] = {}
+        self.uses: Dict[str, Set[str]] = {}
+        self._module = ''
+
+    def visit_module(self, name: str) -> None:
+        self._module = name
+        self.modules[name] = []
+
+    def visit_include(self, name: str, info: Optional[QAPISourceInfo]) -> None:
+        self.modules[self._module].append('include ' + name)
+
+    def _add(self, name: str,
+             *types: Optional[QAPISchemaType]) -> None:
+        self.modules[self._module].append(name)
+        self.module_of[name] = self._module
+        self.uses[name] = {typ.name for typ in types if typ}
+
+    @staticmethod
+    def _variant_types(variants: Optional[QAPISchemaVariants]
+                       ) -> List[QAPISchemaType]:
+        if not variants:
+            return []
+        return ([variants.tag_member.type]
+                + [var.type for var in variants.variants])
+
+    def visit_builtin_type(self, name: str, info: Optional[QAPISourceInfo],
+                           json_type: str) -> None:
+        self._add(name)
+
+    def visit_enum_type(self, name: str, info: Optional[QAPISourceInfo],
+                        ifcond: Sequence[str],
+                        features: List[QAPISchemaFeature],
+                        members: List[QAPISchemaEnumMember],
+                        prefix: Optional[str]) -> None:
+        self._add(name)
+
+    def visit_array_type(self, name: str, info: Optional[QAPISourceInfo],
+                         ifcond: Sequence[str],
+                         element_type: QAPISchemaType) -> None:
+        self._add(name, element_type)
+
+    def visit_object_type(self, name: str, info: Optional[QAPISourceInfo],
+                          ifcond: Sequence[str],
+                          features: List[QAPISchemaFeature],
+                          base: Optional[QAPISchemaObjectType],
+                          members: List[QAPISchemaObjectTypeMember],
+                          variants: Optional[QAPISchemaVariants]) -> None:
+        self._add(name, base, *[memb.type for memb in members],
+                  *self._variant_types(variants))
+
+    def visit_alternate_type(self, name: str, info: Optional[QAPISourceInfo],
+                             ifcond: Sequence[str],
+                             features: List[QAPISchemaFeature],
+                             variants: QAPISchemaVariants) -> None:
+        self._add(name, *self._variant_types(variants))
+
+    def visit_command(self, name: str, info: Optional[QAPISourceInfo],
+                      ifcond: Sequence[str],
+                      features: List[QAPISchemaFeature],
+                      arg_type: Optional[QAPISchemaObjectType],
+                      ret_type: Optional[QAPISchemaType],
+                      gen: bool, success_response: bool, boxed: bool,
+                      allow_oob: bool, allow_preconfig: bool,
+                      coroutine: bool) -> None:
+        self._add(name, arg_type, ret_type)
+
+    def visit_event(self, name: str, info: Optional[QAPISourceInfo],
+                    ifcond: Sequence[str],
+                    features: List[QAPISchemaFeature],
+                    arg_type: Optional[QAPISchemaObjectType],
+                    boxed: bool) -> None:
+        self._add(name, arg_type)
+
+
+class QAPIGenFingerprints:
+    """
+    Fingerprints of the inputs of the modules of the generated code.
+
+    The fingerprint of a module covers the generator's source code and
+    options, the list of the module's entities, and the source files
+    defining them and all the types they use, directly or indirectly.
+    A module whose fingerprint is unchanged since its files were
+    generated needs not be generated again.
+
+    The fingerprints of the previous run are kept in the output directory.
+
+    :param schema: The schema.
+    :param output_dir: The output directory.
+    :param prefix: The C-code prefix for symbol names.
+    :param options: Other options that affect the generated code.
+    :param incremental: False to ignore the fingerprints of the previous
+                        run, so that all modules are generated again.
+                        The fingerprints of this run are still saved.
+    """
+    def __init__(self, schema: QAPISchema, output_dir: str, prefix: str,
+                 options: str, incremental: bool = True):
+        self._output_dir = output_dir
+        self._path = os.path.join(output_dir,
+                                  '.' + prefix + 'qapi-fingerprints.json')
+        self.old = self._load() if incremental else {}
+        #: The fingerprints of this run, by generator and module
+        self.new: Dict[str, Dict[str, str]] = {}
+
+        deps = _QAPISchemaDependencyVisitor()
+        schema.visit(deps)
+        schema_dir = os.path.dirname(schema.fname)
+        digests = {name: self._file_digest(schema_dir, name)
+                   for name in deps.modules}
+        salt = '\0'.join([package_digest(), prefix, options,
+                          next(name for name in deps.modules
+                               if QAPISchemaModule.is_user_module(name))])
+
+        self._names: Dict[str, Set[str]] = {}
+        self._fingerprints: Dict[str, str] = {}
+        for module, entities in deps.modules.items():
+            names = self._closure(deps, entities)
+            modules = {deps.module_of[name] for name in names}
+            modules.add(module)
+            self._names[module] = names
+            self._fingerprints[module] = self._digest(
+                salt, module, *entities,
+                *[mod + ':' + digests[mod] for mod in sorted(modules)])
+
+    @staticmethod
+    def _closure(deps: _QAPISchemaDependencyVisitor,
+                 entities: List[str]) -> Set[str]:
+        # The entities and the types they use, directly or indirectly
+        names = set()
+        todo = [name for name in entities if name in deps.uses]
+        while todo:
+            name = todo.pop()
+            if name not in names:
+                names.add(name)
+                todo.extend(deps.uses[name])
+        return names
+
+    @staticmethod
+    def _digest(*parts: str) -> str:
+        return hashlib.sha256('\0'.join(parts).encode('utf-8')).hexdigest()
+
+    @staticmethod
+    def _file_digest(schema_dir: str, name: str) -> str:
+        if QAPISchemaModule.is_system_module(name):
+            return ''
+        with open(os.path.join(schema_dir, name), 'rb') as file:
+            return hashlib.sha256(file.read()).hexdigest()
+
+    def _load(self) -> Dict[str, Dict[str, str]]:
+        try:
+            with open(self._path, 'r', encoding='utf-8') as file:
+                old: Dict[str, Dict[str, str]] = json.load(file)
+                return old
+        except (OSError, ValueError):
+            return {}
+
+    def names(self, module: str) -> Set[str]:
+        """Return the names of the entities a module depends on."""
+        return self._names[module]
+
+    def check(self, what: str, module: str, fnames: Sequence[str],
+              state: str = '') -> bool:
+        """
+        Record the fingerprint of a module, and tell if it is up to date.
+
+        :param what: The generator.
+        :param module: The module name.
+        :param fnames: The names of the module's output files.
+        :param state: Generator state the module's code depends on.
+        :return: True if the fingerprint did not change and the output
+                 files exist.
+        """
+        fingerprint = self._digest(self._fingerprints[module], state)
+        self.new.setdefault(what, {})[module] = fingerprint
+        return (self.old.get(what, {}).get(module) == fingerprint
+                and all(os.path.exists(os.path.join(self._output_dir, fname))
+                        for fname in fnames))
+
+    def save(self) -> None:
+        """Save the fingerprints of this run for the next one."""
+        os.makedirs(self._output_dir or '.', exist_ok=True)
+        with open(self._path, 'w', encoding='utf-8') as file:
+            json.dump(self.new, file, indent=1, sort_keys=True)
+
+
 class QAPISchemaMonolithicCVisitor(QAPISchemaVisitor):
     def __init__(self,
                  prefix: str,
@@ -238,15 +439,19 @@ def __init__(self,
                  what: str,
                  user_blurb: str,
                  builtin_blurb: Optional[str],
-                 pydoc: str):
+                 pydoc: str,
+                 fingerprints: Optional[QAPIGenFingerprints] = None):
         self._prefix = prefix
         self._what = what
         self._user_blurb = user_blurb
         self._builtin_blurb = builtin_blurb
         self._pydoc = pydoc
+        self._fingerprints = fingerprints
         self._current_module: Optional[str] = None
         self._module: Dict[str, Tuple[QAPIGenC, QAPIGenH]] = {}
         self._main_module: Optional[str] = None
+        # Modules whose code is not generated
+        self._skipped_modules: Set[str] = set()
 
     @property
     def _genc(self) -> QAPIGenC:
@@ -301,6 +506,8 @@ def write(self, output_dir: str, opt_builtins: bool = False) -> None:
         for name in self._module:
             if QAPISchemaModule.is_builtin_module(name) and not opt_builtins:
                 continue
+            if name in self._skipped_modules:
+                continue
             (genc, genh) = self._module[name]
             genc.write(output_dir)
             genh.write(output_dir)
@@ -311,6 +518,26 @@ def _begin_builtin_module(self) -> None:
     def _begin_user_module(self, name: str) -> None:
         pass
 
+    def _module_state(self, name: str) -> str:
+        """
+        Return the visitor state that the code of a module depends on,
+        besides the module's dependencies.
+        """
+        # pylint: disable=unused-argument,no-self-use
+        return ''
+
+    def _skip_module(self, name: str) -> bool:
+        (genc, genh) = self._module[name]
+        # Modules reused from the main schema are not written, see
+        # QAPIGen.write()
+        if genc.fname.startswith('../') and genh.fname.startswith('../'):
+            return True
+        if not self._fingerprints:
+            return False
+        return self._fingerprints.check(
+            self._what, name, [genc.fname, genh.fname],
+            self._module_state(name))
+
     def visit_module(self, name: str) -> None:
         if QAPISchemaModule.is_builtin_module(name):
             if self._builtin_blurb:
@@ -324,6 +551,13 @@ def visit_module(self, name: str) -> None:
             assert QAPISchemaModule.is_user_module(name)
             self._add_module(name, self._user_blurb)
             self._begin_user_module(name)
+        if self._current_module is not None and self._skip_module(name):
+            self._skipped_modules.add(name)
+
+    def visit_needed(self, entity: QAPISchemaEntity) -> bool:
+        # Subclasses must still account for the entities of skipped
+        # modules in the code of other modules
+        return self._current_module not in self._skipped_modules
 
     def visit_include(self, name: str, info: Optional[QAPISourceInfo]) -> None:
         relname = os.path.relpath(self._module_filename(self._what, name),
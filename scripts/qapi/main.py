@@ -8,13 +8,17 @@
 """
 
 import argparse
+import multiprocessing
 import sys
-from typing import Optional
+import time
+from typing import Dict, Optional, Tuple
 
+from .cache import QAPISchemaCache
 from .commands import gen_commands
-from .common import must_match
+from .common import QAPIProfile, must_match
 from .error import QAPIError
 from .events import gen_events
+from .gen import QAPIGenFingerprints
 from .introspect import gen_introspect
 from .schema import QAPISchema
 from .types import gen_types
@@ -28,11 +32,87 @@ def invalid_prefix_char(prefix: str) -> Optional[str]:
     return None
 
 
+#: The code generators run on the schema, in order
+GENERATORS = ('types', 'visit', 'commands', 'events', 'introspect')
+
+# Arguments of run_generator() after the name
+_GeneratorArgs = Tuple[QAPISchema, str, str, bool, bool,
+                       Optional[QAPIGenFingerprints]]
+
+# The arguments in the worker processes, see _init_worker()
+_worker_args: Optional[_GeneratorArgs] = None  # pylint: disable=invalid-name
+
+
+def run_generator(name: str,
+                  schema: QAPISchema,
+                  output_dir: str,
+                  prefix: str,
+                  unmask: bool,
+                  builtins: bool,
+                  fingerprints: Optional[QAPIGenFingerprints]) -> None:
+    """
+    Run one of the `GENERATORS`.
+
+    The generators only share the schema, so they can run concurrently.
+    """
+    if name == 'types':
+        gen_types(schema, output_dir, prefix, builtins, fingerprints)
+    elif name == 'visit':
+        gen_visit(schema, output_dir, prefix, builtins, fingerprints)
+    elif name == 'commands':
+        gen_commands(schema, output_dir, prefix, fingerprints)
+    elif name == 'events':
+        gen_events(schema, output_dir, prefix, fingerprints)
+    else:
+        assert name == 'introspect'
+        gen_introspect(schema, output_dir, prefix, unmask)
+
+
+def _init_worker(args: _GeneratorArgs) -> None:
+    # Passed once per process rather than pickled with every task; with
+    # the fork start method, it is not pickled at all.
+    global _worker_args  # pylint: disable=global-statement
+    _worker_args = args
+
+
+def _run_worker(name: str) -> Tuple[str, float, Dict[str, Dict[str, str]]]:
+    assert _worker_args is not None
+    start = time.perf_counter()
+    run_generator(name, *_worker_args)
+    fingerprints = _worker_args[-1]
+    return (name, time.perf_counter() - start,
+            fingerprints.new if fingerprints else {})
+
+
+def _run_generators(args: _GeneratorArgs, jobs: int,
+                    profile: QAPIProfile) -> None:
+    if jobs <= 1:
+        for name in GENERATORS:
+            with profile.phase(name):
+                run_generator(name, *args)
+        return
+
+    fingerprints = args[-1]
+    with multiprocessing.Pool(min(jobs, len(GENERATORS)),
+                              _init_worker, (args,)) as pool:
+        results = pool.imap_unordered(_run_worker, GENERATORS)
+        for name, elapsed, new in results:
+            profile.add(name, elapsed)
+            # Collect the fingerprints recorded by the worker
+            if fingerprints:
+                for what, modules in new.items():
+                    fingerprints.new.setdefault(what, {}).update(modules)
+
+
 def generate(schema_file: str,
              output_dir: str,
              prefix: str,
              unmask: bool = False,
-             builtins: bool = False) -> None:
+             builtins: bool = False,
+             cache_dir: Optional[str] = None,
+             profile: Optional[QAPIProfile] = None,
+             incremental: bool = True,
+             jobs: int = 1) -> None:
     """
     Generate C code for the given schema into the target directory.
 
@@ -41,17 +121,43 @@ def generate(schema_file: str,
     :param prefix: Optional C-code prefix for symbol names.
     :param unmask: Expose non-ABI names through introspection?
     :param builtins: Generate code for built-in types?
+    :param cache_dir: Optional directory for the parsed schema cache.
+    :param profile: Optional `QAPIProfile` to record the time spent in
+                    each phase.
+    :param incremental: Skip the modules whose inputs did not change since
+                        they were generated?  See `QAPIGenFingerprints`.
+    :param jobs: Number of worker processes running the generators, or 1
+                 to run them in this process.
 
     :raise QAPIError: On failures.
     """
     assert invalid_prefix_char(prefix) is None
-
-    schema = QAPISchema(schema_file)
-    gen_types(schema, output_dir, prefix, builtins)
-    gen_visit(schema, output_dir, prefix, builtins)
-    gen_commands(schema, output_dir, prefix)
-    gen_events(schema, output_dir, prefix)
-    gen_introspect(schema, output_dir, prefix, unmask)
+    profile = profile or QAPIProfile()
+
+    schema = None
+    cache = None
+    if cache_dir:
+        cache = QAPISchemaCache(cache_dir)
+        with profile.phase('cache load'):
+            schema = cache.load_schema(schema_file)
+    if schema is None:
+        schema = QAPISchema(schema_file, cache, profile)
+        if cache:
+            with profile.phase('cache store'):
+                cache.store_schema(schema)
+
+    # Without incremental generation, the fingerprints are still saved
+    # for the next incremental run
+    with profile.phase('fingerprint'):
+        fingerprints = QAPIGenFingerprints(
+            schema, output_dir, prefix,
+            f'builtins={builtins} unmask={unmask}', incremental)
+
+    _run_generators((schema, output_dir, prefix, unmask, builtins,
+                     fingerprints),
+                    jobs, profile)
+
+    fingerprints.save()
 
 
 def main() -> int:
@@ -74,6 +180,18 @@ def main() -> int:
     parser.add_argument('-u', '--unmask-non-abi-names', action='store_true',
                         dest='unmask',
                         help="expose non-ABI names in introspection")
+    parser.add_argument('--cache-dir', action='store',
+                        help="cache parsed schemas in directory CACHE_DIR")
+    parser.add_argument('--profile', action='store_true',
+                        help="report the time spent in each phase")
+    parser.add_argument('--no-incremental', action='store_false',
+                        dest='incremental',
+                        help="generate all modules, even if their inputs "
+                        "did not change")
+    parser.add_argument('-j', '--jobs', action='store', type=int,
+                        default=1,
+                        help="run the generators in up to JOBS processes "
+                        "(default: 1, i.e. in this process)")
     parser.add_argument('schema', action='store')
     args = parser.parse_args()
 
@@ -83,13 +201,20 @@ def main() -> int:
         print(f"{sys.argv[0]}: {msg}", file=sys.stderr)
         return 1
 
+    profile = QAPIProfile()
     try:
         generate(args.schema,
                  output_dir=args.output_dir,
                  prefix=args.prefix,
                  unmask=args.unmask,
-                 builtins=args.builtins)
+                 builtins=args.builtins,
+                 cache_dir=args.cache_dir,
+                 profile=profile,
+                 incremental=args.incremental,
+                 jobs=args.jobs)
     except QAPIError as err:
         print(f"{sys.argv[0]}: {str(err)}", file=sys.stderr)
         return 1
+    if args.profile:
+        print(profile.report(), file=sys.stderr)
     return 0
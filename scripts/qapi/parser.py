@@ -18,11 +18,14 @@
 import os
 import re
 from typing import (
+    TYPE_CHECKING,
     Dict,
     List,
     Optional,
     Set,
+    Tuple,
     Union,
+    cast,
 )
 
 from .common import must_match
@@ -30,6 +33,11 @@
 from .source import QAPISourceInfo
 
 
+if TYPE_CHECKING:
+    # pylint: disable=cyclic-import
+    from .cache import QAPISchemaCache
+
+
 # Return value alias for get_expr().
 _ExprValue = Union[List[object], Dict[str, object], str, bool]
 
@@ -61,6 +69,9 @@ class QAPISchemaParser:
     :param incl_info:
        `QAPISourceInfo` belonging to the parent module.
        ``None`` implies this is the root module.
+    :param cache:
+       `QAPISchemaCache` to look up and store the parse results of each
+       source file, or ``None``.
 
     :ivar exprs: Resulting parsed expressions.
     :ivar docs: Resulting parsed documentation blocks.
@@ -71,10 +82,12 @@ class QAPISchemaParser:
     def __init__(self,
                  fname: str,
                  previously_included: Optional[Set[str]] = None,
-                 incl_info: Optional[QAPISourceInfo] = None):
+                 incl_info: Optional[QAPISourceInfo] = None,
+                 cache: Optional['QAPISchemaCache'] = None):
         self._fname = fname
         self._included = previously_included or set()
         self._included.add(os.path.abspath(self._fname))
+        self._cache = cache
         self.src = ''
 
         # Lexer state (see `accept` for details):
@@ -89,6 +102,10 @@ def __init__(self,
         self.exprs: List[Dict[str, object]] = []
         self.docs: List[QAPIDoc] = []
 
+        # This file's own expressions, documentation blocks and
+        # directives, in source order, for the cache:
+        self._items: List[Tuple[str, object]] = []
+
         # Showtime!
         self._parse()
 
@@ -106,6 +123,12 @@ def _parse(self) -> None:
         if self.src == '' or self.src[-1] != '\n':
             self.src += '\n'
 
+        if self._cache:
+            items = self._cache.load_module(self)
+            if items is not None:
+                self._replay(items)
+                return
+
         # Prime the lexer:
         self.accept()
 
@@ -116,6 +139,7 @@ def _parse(self) -> None:
                 self.reject_expr_doc(cur_doc)
                 for cur_doc in self.get_doc(info):
                     self.docs.append(cur_doc)
+                    self._items.append(('doc', cur_doc))
                 continue
 
             expr = self.get_expr()
@@ -131,15 +155,8 @@ def _parse(self) -> None:
                 if not isinstance(include, str):
                     raise QAPISemError(info,
                                        "value of 'include' must be a string")
-                incl_fname = os.path.join(os.path.dirname(self._fname),
-                                          include)
-                self.exprs.append({'expr': {'include': incl_fname},
-                                   'info': info})
-                exprs_include = self._include(include, info, incl_fname,
-                                              self._included)
-                if exprs_include:
-                    self.exprs.extend(exprs_include.exprs)
-                    self.docs.extend(exprs_include.docs)
+                self._items.append(('include', (include, info)))
+                self._def_include(include, info)
             elif "pragma" in expr:
                 self.reject_expr_doc(cur_doc)
                 if len(expr) != 1:
@@ -148,6 +165,7 @@ def _parse(self) -> None:
                 if not isinstance(pragma, dict):
                     raise QAPISemError(
                         info, "value of 'pragma' must be an object")
+                self._items.append(('pragma', (pragma, info)))
                 for name, value in pragma.items():
                     self._pragma(name, value, info)
             else:
@@ -159,9 +177,47 @@ def _parse(self) -> None:
                             cur_doc.info, "definition documentation required")
                     expr_elem['doc'] = cur_doc
                 self.exprs.append(expr_elem)
+                self._items.append(('expr', expr_elem))
             cur_doc = None
         self.reject_expr_doc(cur_doc)
 
+        if self._cache:
+            self._cache.store_module(self, self._items)
+
+    def _replay(self, items: List[Tuple[str, object]]) -> None:
+        """
+        Process the cached parse results of the schema document.
+
+        :param items: The document's items, as recorded by `_parse`.
+        """
+        for kind, item in items:
+            if kind == 'doc':
+                assert isinstance(item, QAPIDoc)
+                self.docs.append(item)
+            elif kind == 'expr':
+                assert isinstance(item, dict)
+                self.exprs.append(item)
+            elif kind == 'include':
+                include, info = cast(Tuple[str, QAPISourceInfo], item)
+                self._def_include(include, info)
+            elif kind == 'pragma':
+                pragma, info = cast(Tuple[Dict[str, object], QAPISourceInfo],
+                                    item)
+                for name, value in pragma.items():
+                    self._pragma(name, value, info)
+            else:
+                assert False, "unexpected item %s" % kind
+
+    def _def_include(self, include: str, info: QAPISourceInfo) -> None:
+        incl_fname = os.path.join(os.path.dirname(self._fname), include)
+        self.exprs.append({'expr': {'include': incl_fname},
+                           'info': info})
+        exprs_include = self._include(include, info, incl_fname,
+                                      self._included, self._cache)
+        if exprs_include:
+            self.exprs.extend(exprs_include.exprs)
+            self.docs.extend(exprs_include.docs)
+
     @staticmethod
     def reject_expr_doc(doc: Optional['QAPIDoc']) -> None:
         if doc and doc.symbol:
@@ -174,7 +230,8 @@ def reject_expr_doc(doc: Optional['QAPIDoc']) -> None:
     def _include(include: str,
                  info: QAPISourceInfo,
                  incl_fname: str,
-                 previously_included: Set[str]
+                 previously_included: Set[str],
+                 cache: Optional['QAPISchemaCache'] = None
                  ) -> Optional['QAPISchemaParser']:
         incl_abs_fname = os.path.abspath(incl_fname)
         # catch inclusion cycle
@@ -189,7 +246,8 @@ def _include(include: str,
             return None
 
         try:
-            return QAPISchemaParser(incl_fname, previously_included, info)
+            return QAPISchemaParser(incl_fname, previously_included, info,
+                                    cache)
         except OSError as err:
             raise QAPISemError(
                 info,
@@ -19,7 +19,7 @@
 import re
 from typing import Optional
 
-from .common import POINTER_SUFFIX, c_name
+from .common import POINTER_SUFFIX, QAPIProfile, c_name
 from .error import QAPIError, QAPISemError, QAPISourceError
 from .expr import check_exprs
 from .parser import QAPISchemaParser
@@ -413,7 +413,7 @@ def check(self, schema):
         for m in self.local_members:
             m.check(schema)
             m.check_clash(self.info, seen)
-        members = seen.values()
+        members = list(seen.values())
 
         if self.variants:
             self.variants.check(schema, seen)
@@ -847,16 +847,22 @@ def visit(self, visitor):
 
 
 class QAPISchema:
-    def __init__(self, fname):
+    def __init__(self, fname, cache=None, profile=None):
         self.fname = fname
+        profile = profile or QAPIProfile()
 
-        try:
-            parser = QAPISchemaParser(fname)
-        except OSError as err:
-            raise QAPIError(
-                f"can't read schema file '{fname}': {err.strerror}"
-            ) from err
+        with profile.phase('parse'):
+            try:
+                parser = QAPISchemaParser(fname, cache=cache)
+            except OSError as err:
+                raise QAPIError(
+                    f"can't read schema file '{fname}': {err.strerror}"
+                ) from err
 
+        with profile.phase('check'):
+            self._build(fname, parser)
+
+    def _build(self, fname, parser):
         exprs = check_exprs(parser.exprs)
         self.docs = parser.docs
         self._entity_list = []
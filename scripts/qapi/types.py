@@ -22,9 +22,15 @@
     gen_if,
     mcgen,
 )
-from .gen import QAPISchemaModularCVisitor, ifcontext
+from .gen import (
+    QAPIGenFingerprints,
+    QAPISchemaModularCVisitor,
+    ifcontext,
+)
 from .schema import (
     QAPISchema,
+    QAPISchemaAlternateType,
+    QAPISchemaEntity,
     QAPISchemaEnumMember,
     QAPISchemaFeature,
     QAPISchemaObjectType,
@@ -197,6 +203,18 @@ def gen_object(name: str, ifcond: Sequence[str],
     return ret
 
 
+def mark_object_seen(name: str,
+                     variants: Optional[QAPISchemaVariants]) -> None:
+    """Update objects_seen like gen_object(), without generating code."""
+    if name in objects_seen:
+        return
+    objects_seen.add(name)
+    for var in variants.variants if variants else ():
+        obj = var.type
+        if isinstance(obj, QAPISchemaObjectType):
+            mark_object_seen(obj.name, obj.variants)
+
+
 def gen_upcast(name: str, base: QAPISchemaObjectType) -> str:
     # C makes const-correctness ugly.  We have to cast away const to let
     # this function work for both const and non-const obj.
@@ -266,10 +284,11 @@ def gen_type_cleanup(name: str) -> str:
 
 class QAPISchemaGenTypeVisitor(QAPISchemaModularCVisitor):
 
-    def __init__(self, prefix: str):
+    def __init__(self, prefix: str,
+                 fingerprints: Optional[QAPIGenFingerprints] = None):
         super().__init__(
             prefix, 'qapi-types', ' * Schema-defined QAPI types',
-            ' * Built-in QAPI types', __doc__)
+            ' * Built-in QAPI types', __doc__, fingerprints)
 
     def _begin_builtin_module(self) -> None:
         self._genc.preamble_add(mcgen('''
@@ -300,6 +319,22 @@ def visit_begin(self, schema: QAPISchema) -> None:
         # gen_object() is recursive, ensure it doesn't visit the empty type
         objects_seen.add(schema.the_empty_object_type.name)
 
+    def _module_state(self, name: str) -> str:
+        # gen_object() skips the objects already generated by the
+        # previous modules
+        assert self._fingerprints
+        return ' '.join(sorted(objects_seen & self._fingerprints.names(name)))
+
+    def visit_needed(self, entity: QAPISchemaEntity) -> bool:
+        if super().visit_needed(entity):
+            return True
+        if isinstance(entity, QAPISchemaObjectType):
+            if entity.name != 'q_empty':
+                mark_object_seen(entity.name, entity.variants)
+        elif isinstance(entity, QAPISchemaAlternateType):
+            mark_object_seen(entity.name, entity.variants)
+        return False
+
     def _gen_type_cleanup(self, name: str) -> None:
         self._genh.add(gen_type_cleanup_decl(name))
         self._genc.add(gen_type_cleanup(name))
@@ -365,7 +400,8 @@ def visit_alternate_type(self,
 def gen_types(schema: QAPISchema,
               output_dir: str,
               prefix: str,
-              opt_builtins: bool) -> None:
-    vis = QAPISchemaGenTypeVisitor(prefix)
+              opt_builtins: bool,
+              fingerprints: Optional[QAPIGenFingerprints] = None) -> None:
+    vis = QAPISchemaGenTypeVisitor(prefix, fingerprints)
     schema.visit(vis)
     vis.write(output_dir, opt_builtins)
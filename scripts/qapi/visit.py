@@ -23,7 +23,11 @@
     indent,
     mcgen,
 )
-from .gen import QAPISchemaModularCVisitor, ifcontext
+from .gen import (
+    QAPIGenFingerprints,
+    QAPISchemaModularCVisitor,
+    ifcontext,
+)
 from .schema import (
     QAPISchema,
     QAPISchemaEnumMember,
@@ -315,10 +319,11 @@ def gen_visit_object(name: str) -> str:
 
 class QAPISchemaGenVisitVisitor(QAPISchemaModularCVisitor):
 
-    def __init__(self, prefix: str):
+    def __init__(self, prefix: str,
+                 fingerprints: Optional[QAPIGenFingerprints] = None):
         super().__init__(
             prefix, 'qapi-visit', ' * Schema-defined QAPI visitors',
-            ' * Built-in QAPI visitors', __doc__)
+            ' * Built-in QAPI visitors', __doc__, fingerprints)
 
     def _begin_builtin_module(self) -> None:
         self._genc.preamble_add(mcgen('''
@@ -405,7 +410,8 @@ def visit_alternate_type(self,
 def gen_visit(schema: QAPISchema,
               output_dir: str,
               prefix: str,
-              opt_builtins: bool) -> None:
-    vis = QAPISchemaGenVisitVisitor(prefix)
+              opt_builtins: bool,
+              fingerprints: Optional[QAPIGenFingerprints] = None) -> None:
+    vis = QAPISchemaGenVisitVisitor(prefix, fingerprints)
     schema.visit(vis)
     vis.write(output_dir, opt_builtins)
@@ -9,10 +9,17 @@
 #
 # For help see docs/devel/tracing.rst
 
+import io
+import os
+import json
+import mmap
+import stat
+import time
 import struct
 import inspect
-from tracetool import read_events, Event
-from tracetool.backend.simple import is_string
+from array import array
+from tracetool import read_events, Event, Arguments
+from tracetool.backend.simple import is_string, event_layout
 
 header_event_id = 0xffffffffffffffff
 header_magic    = 0xf2b177cb0aa429b4
@@ -23,6 +30,15 @@
 
 log_header_fmt = '=QQQ'
 rec_header_fmt = '=QQII'
+mapping_header_fmt = '=QL'
+
+u32_struct = struct.Struct('=L')
+u64_struct = struct.Struct('=Q')
+# Sign-extends negative values to 64 bits when mapped over them
+sign_extend = (0xffffffffffffffff).__and__
+rec_header_struct = struct.Struct(rec_header_fmt)
+rec_struct = struct.Struct('=Q' + rec_header_fmt[1:])
+mapping_header_struct = struct.Struct(mapping_header_fmt)
 
 def read_header(fobj, hfmt):
     '''Read a trace record header'''
@@ -32,23 +48,33 @@ def read_header(fobj, hfmt):
         return None
     return struct.unpack(hfmt, hdr)
 
-def get_record(edict, idtoname, rechdr, fobj):
+def get_event(edict, name):
+    """Look up the declaration of a logged event, exiting if it is unknown."""
+    try:
+        return edict[name]
+    except KeyError as e:
+        import sys
+        sys.stderr.write('%s event is logged but is not declared ' \
+                         'in the trace events file, try using ' \
+                         'trace-events-all instead.\n' % str(e))
+        sys.exit(1)
+
+def get_record(edict, idtoname, rechdr, fobj, schema=None):
     """Deserialize a trace record from a file into a tuple
-       (name, timestamp, pid, arg1, ..., arg6)."""
+       (name, timestamp, pid, arg1, ..., arg6).
+
+       `schema` receives the events described by a v5 log, see TraceBuffer.
+    """
     if rechdr is None:
         return None
+    if schema is not None:
+        args = fobj.read(rechdr[2] - 24)
+        return unpack_record(edict, idtoname, rechdr, args, 0, schema)
     if rechdr[0] != dropped_event_id:
         event_id = rechdr[0]
         name = idtoname[event_id]
         rec = (name, rechdr[1], rechdr[3])
-        try:
-            event = edict[name]
-        except KeyError as e:
-            import sys
-            sys.stderr.write('%s event is logged but is not declared ' \
-                             'in the trace events file, try using ' \
-                             'trace-events-all instead.\n' % str(e))
-            sys.exit(1)
+        event = get_event(edict, name)
 
         for type, name in event.args:
             if is_string(type):
@@ -65,20 +91,167 @@ def get_record(edict, idtoname, rechdr, fobj):
         rec = rec + (value,)
     return rec
 
-def get_mapping(fobj):
+def read_varint(buf, offset):
+    """Decode an unsigned LEB128 varint, returning (value, next offset)."""
+    value = 0
+    shift = 0
+    while True:
+        byte = buf[offset]
+        offset += 1
+        value |= (byte & 0x7f) << shift
+        if byte < 0x80:
+            return value, offset
+        shift += 7
+
+class LoggedEvent(Event):
+    """An event described by a mapping record of a v5 log.
+
+    It has the argument types and names of the event as QEMU was built, and
+    the layout of its arguments in the log, see
+    tracetool.backend.simple.arg_layout().
+    """
+
+    def __init__(self, name, layout, args):
+        super().__init__(name, [], '""', Arguments(args), 0, 'trace file')
+        self.layout = layout
+
+    @classmethod
+    def parse(cls, name, layout, schema):
+        """Build a LoggedEvent from the layout and the argument schema of
+        a mapping record, see tracetool.backend.simple.event_schema()."""
+        fields = []
+        off = 0
+        while off < len(schema):
+            length = schema[off]
+            fields.append(schema[off + 1:off + 1 + length].decode())
+            off += 1 + length
+        if off != len(schema) or len(fields) != 2 * len(layout):
+            raise ValueError('Invalid mapping record for event %s' % name)
+        return cls(name, layout, list(zip(fields[0::2], fields[1::2])))
+
+def get_layout(schema, event):
+    """Return the layout of the arguments of an event in a log.
+
+    v5 logs have a `schema`, see TraceBuffer.  The events that it describes
+    are LoggedEvents and carry their layout.  Other events, for example
+    when reading started past their mapping record, get the layout that
+    tracetool derives from their declaration.  v4 logs have no schema and
+    return None.
+    """
+    if schema is None:
+        return None
+    if isinstance(event, LoggedEvent):
+        return event.layout
+    return event_layout(event)
+
+# Argument decoders, built on demand by get_decoder()
+event_decoders = {}
+
+def get_decoder(event, layout=None):
+    """Return a function unpacking the arguments of an event from a buffer.
+
+    The function takes (buf, offset) and returns a tuple of the argument
+    values.  Each run of fixed-size arguments is unpacked by a single
+    precompiled struct.Struct, so events without string or varint arguments
+    take one unpack_from() call.  `layout` is the layout of the arguments in
+    a v5 log, see get_layout(); in v4 logs all arguments but strings are
+    64-bit wide.  Whatever their width in the log, signed arguments are
+    returned sign-extended to 64 bits, as they are stored in v4 logs.
+    Decoders are cached per Event and layout.
+    """
+    try:
+        return event_decoders[(event, layout)]
+    except KeyError:
+        pass
+
+    if layout is None:
+        layout = ''.join('s' if is_string(type) else 'Q'
+                         for type, _ in event.args)
+
+    # Steps are a struct.Struct and whether it has signed fields, or 's' for
+    # a string and 'v' for a varint
+    steps = []
+    fmt = '='
+    for code in layout:
+        if code in 'sv':
+            if fmt != '=':
+                steps.append((struct.Struct(fmt), fmt != fmt.upper()))
+                fmt = '='
+            steps.append((code, False))
+        else:
+            fmt += code
+    if fmt != '=' or not steps:
+        steps.append((struct.Struct(fmt), fmt != fmt.upper()))
+
+    if len(steps) == 1 and not isinstance(steps[0][0], str):
+        unpack_from, signed = steps[0][0].unpack_from, steps[0][1]
+        if signed:
+            decode = lambda buf, offset: tuple(map(sign_extend,
+                                                   unpack_from(buf, offset)))
+        else:
+            decode = unpack_from
+    else:
+        def decode(buf, offset):
+            args = ()
+            for step, signed in steps:
+                if step == 's':
+                    (length,) = u32_struct.unpack_from(buf, offset)
+                    offset += 4
+                    args += (buf[offset:offset + length],)
+                    offset += length
+                elif step == 'v':
+                    value, offset = read_varint(buf, offset)
+                    args += (value,)
+                elif signed:
+                    args += tuple(map(sign_extend,
+                                      step.unpack_from(buf, offset)))
+                    offset += step.size
+                else:
+                    args += step.unpack_from(buf, offset)
+                    offset += step.size
+            return args
+
+    event_decoders[(event, layout)] = decode
+    return decode
+
+def unpack_record(edict, idtoname, rechdr, buf, offset, schema=None):
+    """Deserialize the arguments of a trace record starting at offset in a
+       buffer into a tuple (name, timestamp, pid, arg1, ..., arg6)."""
+    if rechdr[0] == dropped_event_id:
+        name = "dropped"
+    else:
+        name = idtoname[rechdr[0]]
+    event = get_event(edict, name)
+    decode = get_decoder(event, get_layout(schema, event))
+    return (name, rechdr[1], rechdr[3]) + decode(buf, offset)
+
+def get_mapping(fobj, schema=None):
+    """Read a mapping record, adding the event that it describes to `schema`
+    for v5 logs."""
     (event_id, ) = struct.unpack('=Q', fobj.read(8))
     (len, ) = struct.unpack('=L', fobj.read(4))
     name = fobj.read(len).decode()
+    if schema is not None:
+        (len, ) = struct.unpack('=L', fobj.read(4))
+        layout = fobj.read(len).decode()
+        (len, ) = struct.unpack('=L', fobj.read(4))
+        schema[name] = LoggedEvent.parse(name, layout, fobj.read(len))
 
     return (event_id, name)
 
-def read_record(edict, idtoname, fobj):
+def read_record(edict, idtoname, fobj, schema=None):
     """Deserialize a trace record from a file into a tuple (event_num, timestamp, pid, arg1, ..., arg6)."""
     rechdr = read_header(fobj, rec_header_fmt)
-    return get_record(edict, idtoname, rechdr, fobj)
+    return get_record(edict, idtoname, rechdr, fobj, schema)
 
 def read_trace_header(fobj):
-    """Read and verify trace file header"""
+    """Read and verify trace file header, returning the log version.
+
+    Version 4 logs store all arguments as 64-bit values except for strings.
+    Version 5 logs store them at their declared width or as varints, and
+    describe each event in its mapping record: the layout of its arguments,
+    and their types and names.
+    """
     header = read_header(fobj, log_header_fmt)
     if header is None:
         raise ValueError('Not a valid trace file!')
@@ -90,22 +263,630 @@ def read_trace_header(fobj):
                          (header[1], header_magic))
 
     log_version = header[2]
-    if log_version not in [0, 2, 3, 4]:
+    if log_version not in [0, 2, 3, 4, 5]:
         raise ValueError('Unknown version of tracelog format!')
-    if log_version != 4:
+    if log_version < 4:
         raise ValueError('Log format %d not supported with this QEMU release!'
                          % log_version)
+    return log_version
+
+def unaligned_array(buf, code):
+    """Return a NumPy array with an element of struct format `code` starting
+    at every byte of buf, so that unaligned record fields can be gathered
+    by offset."""
+    import numpy as np
+
+    dtype = np.dtype('=' + code)
+    return np.ndarray((max(len(buf) - dtype.itemsize + 1, 0),), dtype=dtype,
+                      buffer=buf, strides=(1,))
+
+class EventRuns(object):
+    """Find runs of consecutive event records in a buffer with NumPy.
+
+    Every offset in a window of the buffer that holds a complete record
+    with the event record type is a candidate record, and is linked to the
+    candidate that would follow it according to its length.  Most
+    candidates are real records, a few are argument or timestamp bytes that
+    happen to look like one.  A run is followed from a known record by
+    jumping through the links `jump` records at a time, so that the Python
+    loop only takes one step per `jump` records.  `jump` is a power of two.
+    """
+
+    window = 1 << 24
+    jump = 256
+
+    def __init__(self, buf):
+        import numpy as np
+
+        self.np = np
+        self.u32 = unaligned_array(buf, 'I')
+        self.u64 = unaligned_array(buf, 'Q')
+        self.size = len(buf)
+        self.stop = 0
+        self.pos = None
+
+    def scan(self, start):
+        """Find and link the candidate records in the window at start."""
+        np = self.np
+        self.stop = min(start + self.window, self.size - 31)
+        pos = np.flatnonzero(self.u64[start:self.stop] ==
+                             record_type_event) + start
+        next_pos = pos + 8 + self.u32[pos + 24]
+        complete = next_pos <= self.size
+        pos, next_pos = pos[complete], next_pos[complete]
+
+        # The last candidate, n, stands for the end of a run.  Most records
+        # are followed by one of the next two candidates, look the others up.
+        n = len(pos)
+        links = np.full(n + 1, n)
+        for step in (1, 2):
+            follows = np.flatnonzero(pos[step:] == next_pos[:-step])
+            links[follows] = follows + step
+        others = np.flatnonzero(links[:n] == n)
+        found = np.minimum(np.searchsorted(pos, next_pos[others]), n - 1)
+        match = pos[found] == next_pos[others]
+        links[others[match]] = found[match]
+        jumps = links
+        for _ in range(self.jump.bit_length() - 1):
+            jumps = jumps[jumps]
+        self.pos, self.next_pos = pos, next_pos
+        self.links, self.jumps = links, jumps
+
+    def run(self, off):
+        """Return the offsets of the run of event records that starts at off,
+        their event IDs, and the offset of the record after the run."""
+        np = self.np
+        if self.pos is None or not off < self.stop:
+            self.scan(off)
+        i = np.searchsorted(self.pos, off)
+        if i == len(self.pos) or self.pos[i] != off:
+            self.scan(off)
+            i = 0
+
+        n = len(self.pos)
+        links, jumps = self.links, self.jumps
+        starts = [i]
+        i = jumps[i]
+        while i != n:
+            starts.append(i)
+            i = jumps[i]
+
+        # Each row holds the records that follow the previous row, only the
+        # last one reaches the end of the run
+        rows = np.empty((self.jump, len(starts)), dtype=links.dtype)
+        rows[0] = starts
+        for j in range(1, self.jump):
+            rows[j] = links[rows[j - 1]]
+            if len(starts) == 1 and rows[j, 0] == n:
+                rows = rows[:j]
+                break
+        run = rows.T.ravel()
+        run = run[run != n]
+
+        offsets = self.pos[run] + 8
+        return offsets, self.u64[offsets], int(self.next_pos[run[-1]])
+
+def group_offsets(found):
+    """Group the (offsets, event IDs) pairs found by index() by event ID."""
+    import numpy as np
+
+    offsets = np.concatenate([offsets for offsets, _ in found])
+    groups = np.concatenate([event_ids for _, event_ids in found])
+    if groups.max() < 0x10000:
+        # Event IDs are normally small enough to number the groups, and
+        # stable sorts of 16-bit integers are radix sorts
+        event_ids = None
+        groups = groups.astype(np.uint16)
+    else:
+        event_ids, groups = np.unique(groups, return_inverse=True)
+    order = np.argsort(groups, kind='stable')
+    offsets = offsets[order].astype(np.uint64)
+    counts = np.bincount(groups)
+    ends = np.cumsum(counts)
+    starts = ends - counts
+    # Keep the event IDs in the order of their first record
+    present = np.flatnonzero(counts)
+    result = {}
+    for i in present[np.argsort(order[starts[present]])]:
+        event_id = i if event_ids is None else event_ids[i]
+        result[int(event_id)] = array(
+            'Q', offsets[starts[i]:ends[i]].tobytes())
+    return result
+
+class TraceBuffer(object):
+    """Simpletrace records held in a buffer.
+
+    Records are decoded straight out of the buffer with struct.unpack_from()
+    rather than with several small read() calls per record.  index() walks
+    the records once and remembers the offset of every event record, after
+    which events whose arguments all have a fixed width can be decoded in
+    bulk into NumPy structured arrays with event_arrays().
+
+    For v5 logs, `schema` is the events dict, indexed by name, to which the
+    mapping records add the LoggedEvents that they describe.  It is normally
+    the dict used to look events up, so that logs can be decoded without a
+    trace events file.  It is None for v4 logs.
+    """
+
+    def __init__(self, buf, offset=0, schema=None):
+        self.buf = buf
+        self.start = offset
+        self.end = offset
+        self.offsets = None
+        self.schema = schema
+
+    def read_mapping(self, off, idtoname):
+        """Apply the mapping record at off to `idtoname`.
+
+        Returns the offset of the next record, or None if the mapping record
+        is truncated.
+        """
+        buf = self.buf
+        if off + 20 > len(buf):
+            return None
+        event_id, length = mapping_header_struct.unpack_from(buf, off + 8)
+        end = off + 20 + length
+        if end > len(buf):
+            return None
+        name = buf[off + 20:end].decode()
+        if self.schema is not None:
+            fields = []
+            for _ in range(2):
+                if end + 4 > len(buf):
+                    return None
+                (length,) = u32_struct.unpack_from(buf, end)
+                if end + 4 + length > len(buf):
+                    return None
+                fields.append(buf[end + 4:end + 4 + length])
+                end += 4 + length
+            self.schema[name] = LoggedEvent.parse(name, fields[0].decode(),
+                                                  fields[1])
+        idtoname[event_id] = name
+        return end
+
+    def walk(self, idtoname, start=None, stop=None):
+        """Yield (offset, header) for each complete event record.
+
+        The offset is that of the record header.  Mapping records are applied
+        to `idtoname` as they are encountered.  The walk covers records that
+        begin in [start, stop), by default the whole log.  A truncated record
+        at the end of the log ends the walk, and self.end is left pointing at
+        it.
+        """
+        buf = self.buf
+        size = len(buf)
+        if stop is None:
+            stop = size
+        off = self.start if start is None else start
+        unpack_from = rec_header_struct.unpack_from
+        while off < stop and off + 8 <= size:
+            if u64_struct.unpack_from(buf, off)[0] == record_type_mapping:
+                next_off = self.read_mapping(off, idtoname)
+                if next_off is None:
+                    break
+                off = next_off
+                continue
+            if off + 32 > size:
+                break
+            rechdr = unpack_from(buf, off + 8)
+            if off + 8 + rechdr[2] > size:
+                break
+            yield off + 8, rechdr
+            off += 8 + rechdr[2]
+        self.end = off
+
+    def records(self, edict, idtoname, start=None, stop=None):
+        """Yield record tuples (name, timestamp, pid, arg1, ..., arg6).
+
+        Note that `idtoname` is modified if the log contains mapping records.
+        See walk() for `start` and `stop`.
+        """
+        buf = self.buf
+        schema = self.schema
+        for off, rechdr in self.walk(idtoname, start, stop):
+            yield unpack_record(edict, idtoname, rechdr, buf, off + 24,
+                                schema)
+
+    def index(self, idtoname):
+        """Walk the log once and group event record offsets by event ID.
+
+        Returns a dict mapping each event ID to an array('Q') holding the
+        offsets of its record headers in file order.  If NumPy is available,
+        runs of event records are found with EventRuns and grouped with NumPy,
+        leaving only the mapping records to the loop below.
+        """
+        try:
+            runs = EventRuns(self.buf)
+        except ImportError:
+            runs = None
+        # This is the hot loop when indexing multi-gigabyte logs without
+        # NumPy, so it reads the record type and header with a single
+        # unpack_from() call instead of going through walk()
+        buf = self.buf
+        size = len(buf)
+        off = self.start
+        unpack_from = rec_struct.unpack_from
+        offsets = {}
+        found = []
+        try:
+            while off + 32 <= size:
+                rectype, event_id, _, length, _ = unpack_from(buf, off)
+                if rectype == record_type_mapping:
+                    next_off = self.read_mapping(off, idtoname)
+                    if next_off is None:
+                        break
+                    off = next_off
+                    continue
+                if off + 8 + length > size:
+                    break
+                if runs is not None and rectype == record_type_event:
+                    run_offsets, run_ids, off = runs.run(off)
+                    found.append((run_offsets, run_ids))
+                    continue
+                if runs is not None:
+                    found.append((array('q', [off + 8]),
+                                  array('Q', [event_id])))
+                else:
+                    try:
+                        offsets[event_id].append(off + 8)
+                    except KeyError:
+                        offsets[event_id] = array('Q', [off + 8])
+                off += 8 + length
+        finally:
+            del runs
+        if off + 32 > size and off + 8 <= size and \
+           u64_struct.unpack_from(buf, off)[0] == record_type_mapping:
+            # A short mapping record can end the log
+            off = self.read_mapping(off, idtoname) or off
+        if found:
+            offsets = group_offsets(found)
+        self.end = off
+        self.offsets = offsets
+        return offsets
+
+    def event_arrays(self, edict, idtoname):
+        """Decode all fixed-width events into NumPy structured arrays.
+
+        Returns a dict mapping event ID to an array with 'timestamp_ns' and
+        'pid' fields plus, if the event has arguments, an 'args' field with
+        one uint64 sub-field per argument name.  Events with string arguments
+        (or, in v5 logs, varint arguments) are variable-length and are left
+        out, use records() for them.  The log is indexed first if index() has
+        not been called yet.
+        """
+        import numpy as np
+
+        if self.offsets is None:
+            self.index(idtoname)
+
+        data = np.frombuffer(self.buf, dtype=np.uint8)
+        arrays = {}
+        try:
+            for event_id, offsets in self.offsets.items():
+                if event_id == dropped_event_id:
+                    name = "dropped"
+                else:
+                    name = idtoname[event_id]
+                event = get_event(edict, name)
+                layout = get_layout(self.schema, event)
+                if layout is None:
+                    if any(is_string(type) for type, _ in event.args):
+                        continue
+                    layout = 'Q' * len(event.args)
+                elif 's' in layout or 'v' in layout:
+                    continue
+
+                names = ['timestamp_ns', 'pid']
+                formats = ['=u8', '=u4']
+                if len(event.args) > 0:
+                    names.append('args')
+                    formats.append([(arg, '=u8') for arg in event.args.names()])
+                dtype = np.dtype({'names': names, 'formats': formats,
+                                  'offsets': [8, 20, 24][:len(names)],
+                                  'itemsize': 24 + 8 * len(event.args)})
+                if layout == 'Q' * len(event.args):
+                    rec_dtype = dtype
+                else:
+                    # Arguments narrower than 64 bits are widened below
+                    arg_formats = [(arg, '=' + np.dtype(code).str[1:])
+                                   for arg, code in zip(event.args.names(),
+                                                        layout)]
+                    rec_dtype = np.dtype({
+                        'names': names, 'formats': formats[:2] + [arg_formats],
+                        'offsets': [8, 20, 24],
+                        'itemsize': 24 + struct.calcsize('=' + layout)})
+
+                # Copy whole records out of a view of the buffer that has a
+                # record starting at every byte
+                itemsize = rec_dtype.itemsize
+                offsets = np.frombuffer(offsets, dtype=np.uint64)
+                result = np.lib.stride_tricks.as_strided(
+                    data, shape=(max(len(data) - itemsize + 1, 0), itemsize),
+                    strides=(1, 1), writeable=False)[offsets.astype(np.intp)]
+                result = result.view(rec_dtype).reshape(len(offsets))
+                if rec_dtype is not dtype:
+                    # Signed arguments are sign-extended as in v4 logs
+                    packed, result = result, np.empty(len(offsets), dtype=dtype)
+                    result['timestamp_ns'] = packed['timestamp_ns']
+                    result['pid'] = packed['pid']
+                    for arg in event.args.names():
+                        result['args'][arg] = packed['args'][arg].astype(
+                            np.uint64)
+                arrays[event_id] = result
+        finally:
+            del data
+        return arrays
+
+class MappedTrace(TraceBuffer):
+    """A memory-mapped simpletrace log."""
+
+    def __init__(self, fobj, offset=None, schema=None):
+        """Map the file behind fobj, starting at offset.
+
+        The offset defaults to the current file position, i.e. just after the
+        log header if it has been read already.  Raises ValueError, OSError or
+        io.UnsupportedOperation if the file cannot be mapped, for example
+        because it is empty or is a pipe.
+        """
+        if offset is None:
+            offset = fobj.tell()
+        mm = mmap.mmap(fobj.fileno(), 0, access=mmap.ACCESS_READ)
+        super().__init__(mm, offset, schema)
+
+    def close(self):
+        self.buf.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+class TraceIndex(object):
+    """A persistent index of checkpoints into a simpletrace log.
+
+    The log is split into chunks of about `interval` event records.  For each
+    chunk the index records the file offset where it starts, the range of
+    timestamps and the set of events it contains, and the event ID to name
+    mapping in effect at its start.  This lets readers seek straight to the
+    chunks that overlap a time window or contain the events of interest,
+    without decoding the log from its header.
+
+    The index is saved as a JSON sidecar file next to the log and is only
+    reused while the log's size and modification time are unchanged.  For v5
+    logs, it also keeps the events described by the mapping records, which
+    are skipped when reading selected chunks.
+    """
+
+    version = 2
+
+    def __init__(self, size, mtime_ns, chunks, mappings, names, events=None):
+        self.size = size
+        self.mtime_ns = mtime_ns
+        # (offset, min_ns, max_ns, mapping index, [name index, ...])
+        self.chunks = chunks
+        # idtoname dicts, one per distinct mapping state
+        self.mappings = mappings
+        self.names = names
+        # name -> [layout, [[type, name], ...]] for each LoggedEvent
+        self.events = events or {}
+
+    @classmethod
+    def build(cls, trace, idtoname, fobj, interval=32768):
+        """Index a MappedTrace in a single pass over its records.
+
+        Note that `idtoname` is modified if the log contains mapping records.
+        """
+        st = os.fstat(fobj.fileno())
+        chunks = []
+        mappings = []
+        names = []
+        name_index = {}
+        count = interval
+        chunk_ids = None
+        for off, rechdr in trace.walk(idtoname):
+            if count == interval:
+                if chunk_ids is not None:
+                    chunks.append(chunk + [sorted(chunk_ids)])
+                if not mappings or mappings[-1] != idtoname:
+                    mappings.append(dict(idtoname))
+                chunk = [off - 8, rechdr[1], rechdr[1], len(mappings) - 1]
+                chunk_ids = set()
+                count = 0
+            count += 1
+
+            timestamp = rechdr[1]
+            if timestamp < chunk[1]:
+                chunk[1] = timestamp
+            elif timestamp > chunk[2]:
+                chunk[2] = timestamp
+
+            name = idtoname[rechdr[0]]
+            try:
+                chunk_ids.add(name_index[name])
+            except KeyError:
+                name_index[name] = len(names)
+                names.append(name)
+                chunk_ids.add(name_index[name])
+        if chunk_ids is not None:
+            chunks.append(chunk + [sorted(chunk_ids)])
+        events = {}
+        for name, event in (trace.schema or {}).items():
+            if isinstance(event, LoggedEvent):
+                events[name] = [event.layout, [list(arg) for arg in event.args]]
+        return cls(st.st_size, st.st_mtime_ns, chunks, mappings, names, events)
+
+    @classmethod
+    def load(cls, path, fobj):
+        """Load an index, or return None if it is missing or out of date."""
+        try:
+            with open(path, 'r') as f:
+                data = json.load(f)
+        except (OSError, ValueError):
+            return None
+
+        st = os.fstat(fobj.fileno())
+        if data.get('version') != cls.version or \
+           data.get('size') != st.st_size or \
+           data.get('mtime_ns') != st.st_mtime_ns:
+            return None
+
+        mappings = [{int(k): v for k, v in m.items()}
+                    for m in data['mappings']]
+        return cls(data['size'], data['mtime_ns'], data['chunks'], mappings,
+                   data['names'], data['events'])
+
+    def save(self, path):
+        """Write the index to path, replacing any previous index atomically."""
+        data = {'version': self.version,
+                'size': self.size,
+                'mtime_ns': self.mtime_ns,
+                'chunks': self.chunks,
+                'mappings': [{str(k): v for k, v in m.items()}
+                             for m in self.mappings],
+                'names': self.names,
+                'events': self.events}
+        tmp = path + '.tmp'
+        with open(tmp, 'w') as f:
+            json.dump(data, f, separators=(',', ':'))
+        os.replace(tmp, path)
+
+    def select(self, start_ns=None, end_ns=None, names=None):
+        """Yield (start, stop, mapping) for each chunk that may hold records
+        with start_ns <= timestamp < end_ns whose event name is in names.
+
+        `stop` is None for the last chunk, and self.mappings[mapping] is the
+        mapping state at the start of the chunk.
+        """
+        if names is not None:
+            wanted = set(i for i, name in enumerate(self.names)
+                         if name in names)
+        for i, (offset, min_ns, max_ns, mapping, ids) in \
+                enumerate(self.chunks):
+            if start_ns is not None and max_ns < start_ns:
+                continue
+            if end_ns is not None and min_ns >= end_ns:
+                continue
+            if names is not None and wanted.isdisjoint(ids):
+                continue
+            if i + 1 < len(self.chunks):
+                stop = self.chunks[i + 1][0]
+            else:
+                stop = None
+            yield offset, stop, mapping
+
+def record_filter(start_ns=None, end_ns=None, names=None):
+    """Return a function of (name, timestamp) that is true for records with
+    start_ns <= timestamp < end_ns whose event name is in names."""
+    def wanted(name, timestamp):
+        return (start_ns is None or timestamp >= start_ns) and \
+               (end_ns is None or timestamp < end_ns) and \
+               (names is None or name in names)
+    return wanted
+
+def get_trace_index(trace, idtoname, fobj, index_path=None):
+    """Load the TraceIndex of a MappedTrace from index_path.
+
+    The index is built and saved first if it is missing or out of date.  If
+    index_path is None the index is built but not saved.
+    """
+    if index_path is not None:
+        index = TraceIndex.load(index_path, fobj)
+        if index is not None:
+            if trace.schema is not None:
+                # The chunks may start after the mapping records
+                for name, (layout, args) in index.events.items():
+                    args = [tuple(arg) for arg in args]
+                    trace.schema[name] = LoggedEvent(name, layout, args)
+            return index
+
+    index = TraceIndex.build(trace, dict(idtoname), fobj)
+    if index_path is not None:
+        try:
+            index.save(index_path)
+        except OSError:
+            pass  # e.g. read-only directory, rebuild it next time
+    return index
 
-def read_trace_records(edict, idtoname, fobj):
+def read_chunk_records(edict, trace, chunks, wanted):
+    """Deserialize the records in chunks of a MappedTrace for which
+    wanted(name, timestamp) is true, yielding record tuples
+    (event_num, timestamp, pid, arg1, ..., arg6).
+
+    Each chunk is a (start, stop, idtoname) tuple, where idtoname is the
+    mapping state at `start` and is modified by mapping records in the chunk.
+    """
+    buf = trace.buf
+    for start, stop, idtoname in chunks:
+        for off, rechdr in trace.walk(idtoname, start, stop):
+            if wanted(idtoname[rechdr[0]], rechdr[1]):
+                yield unpack_record(edict, idtoname, rechdr, buf, off + 24,
+                                    trace.schema)
+
+def read_filtered_records(edict, idtoname, fobj, start_ns=None, end_ns=None,
+                          names=None, index_path=None, schema=None):
+    """Deserialize the trace records with start_ns <= timestamp < end_ns
+    whose event name is in names, yielding record tuples
+    (event_num, timestamp, pid, arg1, ..., arg6).
+
+    If index_path is given, the TraceIndex stored there is used to skip to
+    the relevant parts of the log.  It is built and saved first if it is
+    missing or out of date.  Logs that cannot be memory-mapped are filtered
+    while reading them sequentially.
+
+    See read_trace_records() for the other arguments.
+    """
+    wanted = record_filter(start_ns, end_ns, names)
+    try:
+        trace = MappedTrace(fobj, schema=schema)
+    except (AttributeError, io.UnsupportedOperation, ValueError, OSError):
+        for rec in read_trace_records_stream(edict, idtoname, fobj, schema):
+            if wanted(rec[0], rec[1]):
+                yield rec
+        return
+
+    with trace:
+        if index_path is None:
+            chunks = [(None, None, idtoname)]
+        else:
+            index = get_trace_index(trace, idtoname, fobj, index_path)
+            chunks = ((start, stop, dict(index.mappings[mapping]))
+                      for start, stop, mapping
+                      in index.select(start_ns, end_ns, names))
+        yield from read_chunk_records(edict, trace, chunks, wanted)
+
+def read_trace_records(edict, idtoname, fobj, schema=None):
     """Deserialize trace records from a file, yielding record tuples (event_num, timestamp, pid, arg1, ..., arg6).
 
     Note that `idtoname` is modified if the file contains mapping records.
 
+    The file is memory-mapped when possible, otherwise it is read as a
+    stream.  In both cases fobj is left positioned after the last complete
+    record.
+
     Args:
         edict (str -> Event): events dict, indexed by name
         idtoname (int -> str): event names dict, indexed by event ID
         fobj (file): input file
+        schema (str -> Event): dict receiving the events described by a
+            v5 log, normally edict (see TraceBuffer), or None for a v4 log
+
+    """
+    try:
+        trace = MappedTrace(fobj, schema=schema)
+    except (AttributeError, io.UnsupportedOperation, ValueError, OSError):
+        # Pipes, in-memory files and empty files cannot be mapped
+        yield from read_trace_records_stream(edict, idtoname, fobj, schema)
+        return
 
+    with trace:
+        yield from trace.records(edict, idtoname)
+        fobj.seek(trace.end)
+
+def read_trace_records_stream(edict, idtoname, fobj, schema=None):
+    """Deserialize trace records from a file with read() calls only.
+
+    See read_trace_records() for the arguments.
     """
     while True:
         t = fobj.read(8)
@@ -114,13 +895,61 @@ def read_trace_records(edict, idtoname, fobj):
 
         (rectype, ) = struct.unpack('=Q', t)
         if rectype == record_type_mapping:
-            event_id, name = get_mapping(fobj)
+            event_id, name = get_mapping(fobj, schema)
             idtoname[event_id] = name
         else:
-            rec = read_record(edict, idtoname, fobj)
+            rec = read_record(edict, idtoname, fobj, schema)
 
             yield rec
 
+def follow_trace_records(edict, idtoname, fobj, read_header=False,
+                         poll_interval=0.5, bufsize=1 << 20):
+    """Deserialize trace records from a file that is still being written,
+    yielding record tuples (event_num, timestamp, pid, arg1, ..., arg6).
+
+    Unlike read_trace_records(), reaching the end of the file does not end
+    iteration.  The file is polled for new data, backing off to at most
+    poll_interval seconds between polls while it is idle, and a partially
+    written record is kept until the rest of it arrives.  At most bufsize
+    bytes are read at a time, so memory use stays bounded however fast the
+    file grows.  If read_header is true the log header is verified first,
+    waiting for it to be written if necessary.  When a regular file is
+    truncated, e.g. because QEMU restarted tracing into it, reading starts
+    over from its new header.
+
+    Note that `idtoname` is modified if the file contains mapping records.
+    """
+    header_size = struct.calcsize(log_header_fmt)
+    buf = b''
+    delay = 0
+    schema = None
+    while True:
+        data = fobj.read(bufsize)
+        if not data:
+            st = os.fstat(fobj.fileno())
+            if stat.S_ISREG(st.st_mode) and st.st_size < fobj.tell():
+                fobj.seek(0)
+                buf = b''
+                read_header = True
+                continue
+            time.sleep(delay)
+            delay = min(max(delay * 2, 0.001), poll_interval)
+            continue
+        delay = 0
+
+        buf += data
+        if read_header:
+            if len(buf) < header_size:
+                continue
+            log_version = read_trace_header(io.BytesIO(buf[:header_size]))
+            schema = edict if log_version >= 5 else None
+            buf = buf[header_size:]
+            read_header = False
+
+        trace = TraceBuffer(buf, schema=schema)
+        yield from trace.records(edict, idtoname)
+        buf = buf[trace.end:]
+
 class Analyzer(object):
     """A trace file analyzer which processes trace records.
 
@@ -164,58 +993,282 @@ def end(self):
         """Called at the end of the trace."""
         pass
 
-def process(events, log, analyzer, read_header=True):
-    """Invoke an analyzer on each event in a log."""
-    if isinstance(events, str):
-        events = read_events(open(events, 'r'), events)
-    if isinstance(log, str):
-        log = open(log, 'rb')
+    def merge(self, other):
+        """Combine the results of another analyzer into this one.
 
-    if read_header:
-        read_trace_header(log)
+        In parallel mode, process() splits the trace into chunks and each
+        chunk is processed by a copy of this analyzer in a worker process.
+        The copies are pickled after begin() has been called, and neither
+        begin() nor end() is called on them.  merge() is then invoked with
+        each copy in trace order, and finally end() is invoked.
 
-    frameinfo = inspect.getframeinfo(inspect.currentframe())
-    dropped_event = Event.build("Dropped_Event(uint64_t num_events_dropped)",
-                                frameinfo.lineno + 1, frameinfo.filename)
-    edict = {"dropped": dropped_event}
-    idtoname = {dropped_event_id: "dropped"}
+        Analyzers must override this method to support parallel mode.
+        """
+        raise NotImplementedError('%s does not support parallel processing'
+                                  % type(self).__name__)
 
-    for event in events:
-        edict[event.name] = event
+def get_handler(analyzer, event):
+    """Return (fn, extra) for the analyzer method that handles an event.
 
-    # If there is no header assume event ID mapping matches events list
-    if not read_header:
-        for event_id, event in enumerate(events):
-            idtoname[event_id] = event.name
+    `extra` is the number of leading timestamp and pid arguments taken by
+    fn.  (None, None) is returned if the event is handled by catchall().
+    """
+    fn = getattr(analyzer, event.name, None)
+    if fn is None:
+        return None, None
 
-    def build_fn(analyzer, event):
-        if isinstance(event, str):
-            return analyzer.catchall
+    event_argcount = len(event.args)
+    fn_argcount = len(inspect.getfullargspec(fn).args) - 1
+    if fn_argcount == event_argcount + 1:
+        # Include timestamp as first argument
+        return fn, 1
+    elif fn_argcount == event_argcount + 2:
+        # Include timestamp and pid
+        return fn, 2
+    else:
+        # Just arguments, no timestamp or pid
+        return fn, 0
 
-        fn = getattr(analyzer, event.name, None)
+def analyze_records(edict, records, analyzer):
+    """Invoke the analyzer's methods on each record tuple."""
+    def build_fn(analyzer, event):
+        fn, extra = get_handler(analyzer, event)
         if fn is None:
             return analyzer.catchall
 
         event_argcount = len(event.args)
-        fn_argcount = len(inspect.getargspec(fn)[0]) - 1
-        if fn_argcount == event_argcount + 1:
-            # Include timestamp as first argument
+        if extra == 1:
             return lambda _, rec: fn(*(rec[1:2] + rec[3:3 + event_argcount]))
-        elif fn_argcount == event_argcount + 2:
-            # Include timestamp and pid
+        elif extra == 2:
             return lambda _, rec: fn(*rec[1:3 + event_argcount])
         else:
-            # Just arguments, no timestamp or pid
             return lambda _, rec: fn(*rec[3:3 + event_argcount])
 
-    analyzer.begin()
     fn_cache = {}
-    for rec in read_trace_records(edict, idtoname, log):
+    for rec in records:
         event_num = rec[0]
         event = edict[event_num]
         if event_num not in fn_cache:
             fn_cache[event_num] = build_fn(analyzer, event)
         fn_cache[event_num](event, rec)
+
+def analyze_trace(edict, trace, chunks, analyzer, wanted=None):
+    """Invoke the analyzer's methods on the records in chunks of a
+    TraceBuffer for which wanted(name, timestamp) is true.
+
+    Each chunk is a (start, stop, idtoname) tuple as for read_chunk_records().
+    Unlike analyze_records(), no record tuples are built: each event gets a
+    handler that decodes its arguments straight into the call of the
+    analyzer method.  trace.end is left pointing after the last record.
+    """
+    def build_handler(name, event):
+        # Handlers take the record type and header as unpacked by rec_struct
+        # and the offset of the arguments
+        decode = get_decoder(event, get_layout(trace.schema, event))
+        fn, extra = get_handler(analyzer, event)
+        if fn is None:
+            catchall = analyzer.catchall
+            return lambda rec, off: catchall(
+                event, (name, rec[2], rec[4]) + decode(buf, off))
+        elif extra == 1:
+            return lambda rec, off: fn(rec[2], *decode(buf, off))
+        elif extra == 2:
+            return lambda rec, off: fn(rec[2], rec[4], *decode(buf, off))
+        else:
+            return lambda rec, off: fn(*decode(buf, off))
+
+    # This is the hot loop of process(), so rather than going through
+    # TraceBuffer.walk() it reads the record type and header with a single
+    # unpack_from() call and caches the handler of each event ID
+    buf = trace.buf
+    size = len(buf)
+    unpack_from = rec_struct.unpack_from
+    handlers = {}
+    for start, stop, idtoname in chunks:
+        off = trace.start if start is None else start
+        if stop is None:
+            stop = size
+        id_handlers = {}
+        while off < stop and off + 32 <= size:
+            rec = unpack_from(buf, off)
+            if rec[0] == record_type_mapping:
+                next_off = trace.read_mapping(off, idtoname)
+                if next_off is None:
+                    break
+                off = next_off
+                id_handlers.clear()
+                continue
+            if off + 8 + rec[3] > size:
+                break
+            try:
+                handler = id_handlers[rec[1]]
+            except KeyError:
+                name = idtoname[rec[1]]
+                handler = handlers.get(name)
+                if handler is None:
+                    handler = build_handler(name, get_event(edict, name))
+                    handlers[name] = handler
+                id_handlers[rec[1]] = handler
+            if wanted is None or wanted(idtoname[rec[1]], rec[2]):
+                handler(rec, off + 32)
+            off += 8 + rec[3]
+        if off < stop and off + 32 > size and off + 8 <= size and \
+           u64_struct.unpack_from(buf, off)[0] == record_type_mapping:
+            # A short mapping record can end the log
+            off = trace.read_mapping(off, idtoname) or off
+        trace.end = off
+
+# State shared with the worker processes of process_parallel(), which
+# inherit it when they are forked
+parallel_state = None
+
+def process_chunks(task):
+    """Worker side of process_parallel()."""
+    analyzer, chunks = task
+    edict, trace, mappings, wanted = parallel_state
+    chunks = [(start, stop, dict(mappings[mapping]))
+              for start, stop, mapping in chunks]
+    analyze_trace(edict, trace, chunks, analyzer, wanted)
+    return analyzer
+
+def process_parallel(edict, idtoname, fobj, analyzer, jobs, start_ns=None,
+                     end_ns=None, names=None, index_path=None, schema=None):
+    """Process a log with copies of an analyzer in `jobs` worker processes.
+
+    The log is split into chunks at the checkpoints of its TraceIndex, so
+    that each chunk starts at a record boundary with a known event ID
+    mapping.  Partial results are combined with Analyzer.merge().
+    """
+    global parallel_state
+    import multiprocessing
+
+    with MappedTrace(fobj, schema=schema) as trace:
+        index = get_trace_index(trace, idtoname, fobj, index_path)
+        chunks = list(index.select(start_ns, end_ns, names))
+        if not chunks:
+            return
+
+        # A few work units per worker even out chunks of different cost
+        nunits = min(len(chunks), jobs * 4)
+        units = [chunks[i * len(chunks) // nunits:
+                        (i + 1) * len(chunks) // nunits]
+                 for i in range(nunits)]
+
+        parallel_state = (edict, trace, index.mappings,
+                          record_filter(start_ns, end_ns, names))
+        try:
+            # Events cannot be pickled, so workers must be forked
+            ctx = multiprocessing.get_context('fork')
+            with ctx.Pool(jobs) as pool:
+                tasks = ((analyzer, unit) for unit in units)
+                for partial in pool.imap(process_chunks, tasks):
+                    analyzer.merge(partial)
+        finally:
+            parallel_state = None
+
+def process_log(edict, idtoname, fobj, analyzer, start_ns=None, end_ns=None,
+                names=None, index_path=None, schema=None):
+    """Process a log in this process, see process()."""
+    try:
+        trace = MappedTrace(fobj, schema=schema)
+    except (AttributeError, io.UnsupportedOperation, ValueError, OSError):
+        records = read_trace_records_stream(edict, idtoname, fobj, schema)
+        if start_ns is not None or end_ns is not None or names is not None:
+            wanted = record_filter(start_ns, end_ns, names)
+            records = (rec for rec in records if wanted(rec[0], rec[1]))
+        analyze_records(edict, records, analyzer)
+        return
+
+    with trace:
+        if start_ns is None and end_ns is None and names is None:
+            analyze_trace(edict, trace, [(None, None, idtoname)], analyzer)
+            fobj.seek(trace.end)
+        elif index_path is None:
+            analyze_trace(edict, trace, [(None, None, idtoname)], analyzer,
+                          record_filter(start_ns, end_ns, names))
+        else:
+            index = get_trace_index(trace, idtoname, fobj, index_path)
+            chunks = ((start, stop, dict(index.mappings[mapping]))
+                      for start, stop, mapping
+                      in index.select(start_ns, end_ns, names))
+            analyze_trace(edict, trace, chunks, analyzer,
+                          record_filter(start_ns, end_ns, names))
+
+def process(events, log, analyzer, read_header=True, start_ns=None,
+            end_ns=None, names=None, index=None, jobs=1, follow=False):
+    """Invoke an analyzer on each event in a log.
+
+    If start_ns, end_ns or names are given, only records with
+    start_ns <= timestamp < end_ns whose event name is in names are passed
+    to the analyzer.  Filtering uses a sidecar TraceIndex to seek straight to
+    the relevant parts of the log.  It is stored at `index`, by default the
+    log file name with ".idx" appended, and built on first use.  Pass
+    index=False to filter without an index.
+
+    If jobs is greater than 1, the log is processed in parallel by that many
+    worker processes, see Analyzer.merge().  The log must be a regular file.
+
+    If follow is true, the log is assumed to still be written to and new
+    records are processed as they are appended, see follow_trace_records().
+    Processing then only ends, invoking the analyzer's end() method, when
+    it is interrupted with KeyboardInterrupt.
+
+    events may be None for v5 logs, which describe the events that they
+    contain.  Otherwise, the events described by the log take precedence
+    over those of the trace events file.
+    """
+    if events is None:
+        events = []
+    elif isinstance(events, str):
+        events = read_events(open(events, 'r'), events)
+    if isinstance(log, str):
+        log = open(log, 'rb')
+    if index is None and isinstance(getattr(log, 'name', None), str):
+        index = log.name + '.idx'
+    if names is not None:
+        names = set(names)
+
+    if jobs > 1 and follow:
+        raise ValueError('parallel processing cannot follow a trace')
+    log_version = None
+    if read_header and not follow:
+        log_version = read_trace_header(log)
+
+    frameinfo = inspect.getframeinfo(inspect.currentframe())
+    dropped_event = Event.build("Dropped_Event(uint64_t num_events_dropped)",
+                                frameinfo.lineno + 1, frameinfo.filename)
+    edict = {"dropped": dropped_event}
+    idtoname = {dropped_event_id: "dropped"}
+
+    for event in events:
+        edict[event.name] = event
+    schema = edict if log_version is not None and log_version >= 5 else None
+
+    # If there is no header assume event ID mapping matches events list
+    if not read_header:
+        for event_id, event in enumerate(events):
+            idtoname[event_id] = event.name
+
+    if jobs > 1 and type(analyzer).merge is Analyzer.merge:
+        raise ValueError('%s does not support parallel processing'
+                         % type(analyzer).__name__)
+
+    analyzer.begin()
+    if jobs > 1:
+        process_parallel(edict, idtoname, log, analyzer, jobs, start_ns,
+                         end_ns, names, index or None, schema)
+    elif follow:
+        records = follow_trace_records(edict, idtoname, log, read_header)
+        if start_ns is not None or end_ns is not None or names is not None:
+            wanted = record_filter(start_ns, end_ns, names)
+            records = (rec for rec in records if wanted(rec[0], rec[1]))
+        try:
+            analyze_records(edict, records, analyzer)
+        except KeyboardInterrupt:
+            pass
+    else:
+        process_log(edict, idtoname, log, analyzer, start_ns, end_ns, names,
+                    index or None, schema)
     analyzer.end()
 
 def run(analyzer):
@@ -223,19 +1276,37 @@ def run(analyzer):
 
     This function is useful as a driver for simple analysis scripts.  More
     advanced scripts will want to call process() instead."""
-    import sys
-
-    read_header = True
-    if len(sys.argv) == 4 and sys.argv[1] == '--no-header':
-        read_header = False
-        del sys.argv[1]
-    elif len(sys.argv) != 3:
-        sys.stderr.write('usage: %s [--no-header] <trace-events> ' \
-                         '<trace-file>\n' % sys.argv[0])
-        sys.exit(1)
+    import argparse
+
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--no-header', action='store_true',
+                        help='the trace file has no header, assume that '
+                             'event IDs follow the trace events file')
+    parser.add_argument('--jobs', '-j', type=int, default=1,
+                        help='number of worker processes (default: 1)')
+    parser.add_argument('--follow', '-f', action='store_true',
+                        help='keep processing records as they are appended '
+                             'to the trace file, until interrupted')
+    parser.add_argument('events', nargs='?',
+                        help='trace events file, not needed if the trace '
+                             'file describes its events')
+    parser.add_argument('tracefile', help='binary trace file')
+    args = parser.parse_args()
+
+    if args.jobs > 1 and args.follow:
+        parser.error('--jobs cannot be used with --follow')
+    if args.jobs > 1 and type(analyzer).merge is Analyzer.merge:
+        parser.error('%s does not support parallel processing'
+                     % type(analyzer).__name__)
+    if args.no_header and args.events is None:
+        parser.error('--no-header needs a trace events file')
 
-    events = read_events(open(sys.argv[1], 'r'), sys.argv[1])
-    process(events, sys.argv[2], analyzer, read_header=read_header)
+    events = None
+    if args.events is not None:
+        events = read_events(open(args.events, 'r'), args.events)
+    process(events, args.tracefile, analyzer,
+            read_header=not args.no_header, jobs=args.jobs,
+            follow=args.follow)
 
 if __name__ == '__main__':
     class Formatter(Analyzer):
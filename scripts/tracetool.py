@@ -16,7 +16,7 @@
 import sys
 import getopt
 
-from tracetool import error_write, out, out_open
+from tracetool import error_write, out
 import tracetool.backend
 import tracetool.format
 
@@ -33,6 +33,7 @@ def error_opt(msg = None):
                                for n,d in tracetool.format.get_list() ])
     error_write("""\
 Usage: %(script)s --format=<format> --backends=<backends> [<options>] <trace-events> ... <output>
+       %(script)s --manifest=<manifest> --backends=<backends> [<options>]
 
 Backends:
 %(backends)s
@@ -49,7 +50,13 @@ def error_opt(msg = None):
     --target-name <name>     QEMU emulator target name.
     --group <name>           Name of the event group
     --probe-prefix <prefix>  Prefix for dtrace probe names
-                             (default: qemu-<target-type>-<target-name>).\
+                             (default: qemu-<target-type>-<target-name>).
+    --manifest <path>        Generate all the outputs listed in a manifest,
+                             one per line as "<group> <format> <output>
+                             <trace-events> ...".  Each trace-events file is
+                             parsed once, and outputs are only written if
+                             their contents changed.
+    --jobs <n>               Number of processes for --manifest (default: 1).\
 """ % {
             "script" : _SCRIPT,
             "backends" : backend_descr,
@@ -66,7 +73,7 @@ def main(args):
     _SCRIPT = args[0]
 
     long_opts = ["backends=", "format=", "help", "list-backends",
-                 "check-backends", "group="]
+                 "check-backends", "group=", "manifest=", "jobs="]
     long_opts += ["binary=", "target-type=", "target-name=", "probe-prefix="]
 
     try:
@@ -82,6 +89,8 @@ def main(args):
     target_type = None
     target_name = None
     probe_prefix = None
+    manifest = None
+    jobs = 1
     for opt, arg in opts:
         if opt == "--help":
             error_opt()
@@ -109,6 +118,16 @@ def main(args):
         elif opt == '--probe-prefix':
             probe_prefix = arg
 
+        elif opt == '--manifest':
+            manifest = arg
+        elif opt == '--jobs':
+            try:
+                jobs = int(arg)
+            except ValueError:
+                jobs = 0
+            if jobs < 1:
+                error_opt("invalid number of jobs: %s" % arg)
+
         else:
             error_opt("unhandled option: %s" % opt)
 
@@ -121,6 +140,19 @@ def main(args):
                 sys.exit(1)
         sys.exit(0)
 
+    if manifest is not None:
+        if args:
+            error_opt("unexpected arguments with --manifest")
+        try:
+            with open(manifest, "r") as fh:
+                batch = tracetool.read_manifest(fh, manifest)
+            tracetool.generate_batch(batch, arg_backends, binary=binary,
+                                     probe_prefix=probe_prefix,
+                                     processes=jobs)
+        except tracetool.TracetoolError as e:
+            error_opt(str(e))
+        sys.exit(0)
+
     if arg_group is None:
         error_opt("group name is required")
 
@@ -142,11 +174,10 @@ def main(args):
         with open(arg, "r") as fh:
             events.extend(tracetool.read_events(fh, arg))
 
-    out_open(args[-1])
-
     try:
-        tracetool.generate(events, arg_group, arg_format, arg_backends,
-                           binary=binary, probe_prefix=probe_prefix)
+        tracetool.generate_file(events, arg_group, arg_format, arg_backends,
+                                args[-1], binary=binary,
+                                probe_prefix=probe_prefix)
     except tracetool.TracetoolError as e:
         error_opt(str(e))
 
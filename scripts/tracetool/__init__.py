@@ -12,6 +12,8 @@
 __email__      = "stefanha@redhat.com"
 
 
+import io
+import os
 import re
 import sys
 import weakref
@@ -35,10 +37,42 @@ def error(*lines):
 out_filename = '<none>'
 out_fobj = sys.stdout
 
-def out_open(filename):
-    global out_filename, out_fobj
+def out_open(filename, fobj=None):
+    """Send the output to a file.
+
+    If fobj is given, the output is written to it instead of opening filename.
+    """
+    global out_lineno, out_filename, out_fobj
+    out_lineno = 1
     out_filename = filename
-    out_fobj = open(filename, 'wt')
+    if fobj is None:
+        fobj = open(filename, 'wt')
+    out_fobj = fobj
+
+def write_if_changed(filename, text):
+    """Write text to a file, unless the file already holds it.
+
+    Leaving an up-to-date file alone preserves its timestamp, so that the
+    build system does not rebuild everything that depends on it.
+
+    Returns whether the file was written.
+    """
+    if os.path.exists(filename) and not os.path.isfile(filename):
+        # A device or a pipe, such as /dev/stdout
+        with open(filename, 'wt') as fh:
+            fh.write(text)
+        return True
+    try:
+        with open(filename, 'rt') as fh:
+            if fh.read() == text:
+                return False
+    except (OSError, UnicodeDecodeError):
+        pass
+    tmpname = filename + '.tmp'
+    with open(tmpname, 'wt') as fh:
+        fh.write(text)
+    os.replace(tmpname, filename)
+    return True
 
 def out(*lines, **kwargs):
     """Write a set of output lines.
@@ -60,7 +94,7 @@ def out(*lines, **kwargs):
         output.append(l % kwargs)
         out_lineno += 1
 
-    out_fobj.writelines("\n".join(output) + "\n")
+    out_fobj.write("\n".join(output) + "\n")
 
 # We only want to allow standard C types or fixed sized
 # integer types. We don't want QEMU specific types
@@ -511,3 +545,139 @@ def generate(events, group, format, backends,
     tracetool.backend.dtrace.PROBEPREFIX = probe_prefix
 
     tracetool.format.generate(events, format, backend, group)
+
+
+def generate_file(events, group, format, backends, filename,
+                  binary=None, probe_prefix=None):
+    """Generate the output for the given (format, backends) pair into a file.
+
+    The file is only written if its contents changed.  See generate() for the
+    other parameters.
+
+    Parameters
+    ----------
+    filename : str
+        Path to the output file.
+
+    Returns whether the file was written.
+    """
+    fobj = io.StringIO()
+    out_open(filename, fobj)
+    try:
+        generate(events, group, format, backends,
+                 binary=binary, probe_prefix=probe_prefix)
+    finally:
+        out_open('<none>', sys.stdout)
+    return write_if_changed(filename, fobj.getvalue())
+
+
+class BatchJob:
+    """An output file to generate in batch mode.
+
+    Attributes
+    ----------
+    group : str
+        Name of the tracing group.
+    format : str
+        Output format name.
+    output : str
+        Path to the output file.
+    inputs : tuple of str
+        Paths to the event description files.
+    """
+
+    def __init__(self, group, format, output, inputs):
+        self.group = group
+        self.format = format
+        self.output = output
+        self.inputs = tuple(inputs)
+
+
+def read_manifest(fobj, fname):
+    """Read the list of jobs for batch mode.
+
+    Each line of the manifest describes a job as whitespace-separated fields:
+    the group name, the format, the output file and one or more event
+    description files.  Empty lines and lines starting with '#' are ignored.
+
+    Parameters
+    ----------
+    fobj : file
+        Manifest file.
+    fname : str
+        Name of the manifest file.
+
+    Returns a list of BatchJob objects
+    """
+    jobs = []
+    for lineno, line in enumerate(fobj, 1):
+        fields = line.split()
+        if not fields or fields[0].startswith('#'):
+            continue
+        if len(fields) < 4:
+            raise TracetoolError("Error at %s:%d: expected a group, a format, "
+                                 "an output and inputs" % (fname, lineno))
+        jobs.append(BatchJob(fields[0], fields[1], fields[2], fields[3:]))
+    return jobs
+
+
+# Events of each event description file, parsed once per process
+_batch_events = {}
+
+def _generate_batch_jobs(jobs, backends, binary, probe_prefix):
+    """Generate a list of jobs that share their inputs."""
+    events = []
+    for fname in jobs[0].inputs:
+        if fname not in _batch_events:
+            with open(fname, "r") as fh:
+                _batch_events[fname] = read_events(fh, fname)
+        events.extend(_batch_events[fname])
+
+    written = []
+    for job in jobs:
+        try:
+            if generate_file(events, job.group, job.format, backends,
+                             job.output, binary=binary,
+                             probe_prefix=probe_prefix):
+                written.append(job.output)
+        except TracetoolError as e:
+            raise TracetoolError("%s: %s" % (job.output, e))
+    return written
+
+
+def generate_batch(jobs, backends, binary=None, probe_prefix=None,
+                   processes=1):
+    """Generate the output of many (group, format) pairs.
+
+    Each event description file is parsed only once, and outputs are only
+    written if their contents changed.
+
+    Parameters
+    ----------
+    jobs : list
+        List of BatchJob objects.
+    backends : list
+        Output backend names.
+    binary : str or None
+        See tracetool.backend.dtrace.BINARY.
+    probe_prefix : str or None
+        See tracetool.backend.dtrace.PROBEPREFIX.
+    processes : int
+        Number of worker processes; jobs that use the same inputs are
+        processed by the same worker.
+
+    Returns the list of files that were written.
+    """
+    by_inputs = {}
+    for job in jobs:
+        by_inputs.setdefault(job.inputs, []).append(job)
+    args = [(group, backends, binary, probe_prefix)
+            for group in by_inputs.values()]
+
+    if processes > 1 and len(args) > 1:
+        import multiprocessing
+        with multiprocessing.Pool(processes) as pool:
+            results = pool.starmap(_generate_batch_jobs, args)
+    else:
+        results = [_generate_batch_jobs(*a) for a in args]
+    return [output for written in results for output in written]
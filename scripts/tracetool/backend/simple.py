@@ -12,12 +12,56 @@
 __email__      = "stefanha@redhat.com"
 
 
+import struct
+
 from tracetool import out
 
 
 PUBLIC = True
 
 
+# Layout of the arguments of the C types with a fixed width, as struct
+# module format characters.  Arguments of other types (long, size_t,
+# pointers...) are written as varints, as the width of their type depends
+# on the host.
+FIXED_WIDTH_TYPES = {
+    'bool': 'B',
+    'int8_t': 'b',
+    'uint8_t': 'B',
+    'signed char': 'b',
+    'unsigned char': 'B',
+    'int16_t': 'h',
+    'uint16_t': 'H',
+    'short': 'h',
+    'short int': 'h',
+    'signed short': 'h',
+    'unsigned short': 'H',
+    'unsigned short int': 'H',
+    'int32_t': 'i',
+    'uint32_t': 'I',
+    'int': 'i',
+    'signed': 'i',
+    'signed int': 'i',
+    'unsigned': 'I',
+    'unsigned int': 'I',
+    'int64_t': 'q',
+    'uint64_t': 'Q',
+    'long long': 'q',
+    'long long int': 'q',
+    'signed long long': 'q',
+    'unsigned long long': 'Q',
+    'unsigned long long int': 'Q',
+}
+
+# C writers of the arguments of each width
+WRITE_FUNCTIONS = {
+    1: ('trace_record_write_u8', 'uint8_t'),
+    2: ('trace_record_write_u16', 'uint16_t'),
+    4: ('trace_record_write_u32', 'uint32_t'),
+    8: ('trace_record_write_u64', 'uint64_t'),
+}
+
+
 def is_string(arg):
     strtype = ('const char*', 'char*', 'const char *', 'char *')
     arg_strip = arg.lstrip()
@@ -27,6 +71,39 @@ def is_string(arg):
         return False
 
 
+def arg_layout(type_):
+    """Layout of an argument of the given C type in trace records.
+
+    This is a struct module format character for arguments written at their
+    declared width, 's' for strings (a 32-bit length followed by the
+    characters) and 'v' for other arguments, which are cast to uint64_t and
+    written as unsigned LEB128 varints.
+    """
+    if is_string(type_):
+        return 's'
+    if type_.endswith('*'):
+        return 'v'
+    type_ = ' '.join(word for word in type_.split() if word != 'const')
+    return FIXED_WIDTH_TYPES.get(type_, 'v')
+
+
+def event_layout(event):
+    """Layout of the arguments of an event in trace records, see
+    arg_layout()."""
+    return ''.join(arg_layout(type_) for type_, _ in event.args)
+
+
+def event_schema(event):
+    """Types and names of the arguments of an event, as written in the
+    mapping records of trace files.  Each type and each name is a length
+    byte followed by its characters."""
+    schema = b''
+    for type_, name in event.args:
+        for field in (type_.encode(), name.encode()):
+            schema += bytes([len(field)]) + field
+    return schema
+
+
 def generate_h_begin(events, group):
     for event in events:
         out('void _simple_%(api)s(%(args)s);',
@@ -61,13 +138,24 @@ def generate_c(event, group):
         args=event.args)
     sizes = []
     for type_, name in event.args:
-        if is_string(type_):
+        layout = arg_layout(type_)
+        if layout == 's':
             out('    size_t arg%(name)s_len = %(name)s ? MIN(strlen(%(name)s), MAX_TRACE_STRLEN) : 0;',
                 name=name)
             strsizeinfo = "4 + arg%s_len" % name
             sizes.append(strsizeinfo)
+        elif layout == 'v':
+            # pointer var (not string)
+            if type_.endswith('*'):
+                value = '(uintptr_t)(uint64_t *)%s' % name
+            # other data type
+            else:
+                value = '(uint64_t)%s' % name
+            out('    uint64_t arg%(name)s_val = %(value)s;',
+                name=name, value=value)
+            sizes.append("trace_varint_len(arg%s_val)" % name)
         else:
-            sizes.append("8")
+            sizes.append(str(struct.calcsize(layout)))
     sizestr = " + ".join(sizes)
     if len(event.args) == 0:
         sizestr = '0'
@@ -93,18 +181,20 @@ def generate_c(event, group):
 
     if len(event.args) > 0:
         for type_, name in event.args:
+            layout = arg_layout(type_)
             # string
-            if is_string(type_):
+            if layout == 's':
                 out('    trace_record_write_str(&rec, %(name)s, arg%(name)s_len);',
                     name=name)
-            # pointer var (not string)
-            elif type_.endswith('*'):
-                out('    trace_record_write_u64(&rec, (uintptr_t)(uint64_t *)%(name)s);',
+            # varint
+            elif layout == 'v':
+                out('    trace_record_write_varint(&rec, arg%(name)s_val);',
                     name=name)
-            # primitive data type
+            # fixed-width data type
             else:
-                out('    trace_record_write_u64(&rec, (uint64_t)%(name)s);',
-                   name=name)
+                func, ctype = WRITE_FUNCTIONS[struct.calcsize(layout)]
+                out('    %(func)s(&rec, (%(ctype)s)%(name)s);',
+                    func=func, ctype=ctype, name=name)
 
     out('    trace_record_finish(&rec);',
         '}',
@@ -13,6 +13,14 @@
 
 
 from tracetool import out
+from tracetool.backend.simple import event_layout, event_schema
+
+
+def c_bytes(data):
+    """C string literal holding data, which does not contain NUL bytes."""
+    return '"%s"' % ''.join(chr(byte) if 0x20 <= byte < 0x7f and
+                            chr(byte) not in '"\\?' else '\\%03o' % byte
+                            for byte in data)
 
 
 def generate(events, backend, group):
@@ -41,13 +49,17 @@ def generate(events, backend, group):
             '    .vcpu_id = %(vcpu_id)s,',
             '    .name = \"%(name)s\",',
             '    .sstate = %(sstate)s,',
-            '    .dstate = &%(dstate)s ',
+            '    .dstate = &%(dstate)s,',
+            '    .layout = "%(layout)s",',
+            '    .schema = %(schema)s,',
             '};',
             event = e.api(e.QEMU_EVENT),
             vcpu_id = vcpu_id,
             name = e.name,
             sstate = "TRACE_%s_ENABLED" % e.name.upper(),
-            dstate = e.api(e.QEMU_DSTATE))
+            dstate = e.api(e.QEMU_DSTATE),
+            layout = event_layout(e),
+            schema = c_bytes(event_schema(e)))
 
     out('TraceEvent *%(group)s_trace_events[] = {',
         group = group.lower())
@@ -128,81 +128,62 @@ def _migrate(self, hardware, scenario, src, dst, connect_uri):
 
         if self._verbose:
             print("Starting migration")
+        # Send the setup commands of each side in a single batch
+        src_cmds = []
+        dst_cmds = []
+
+        def enable(cmds, capability):
+            cmds.append(("migrate-set-capabilities",
+                         { "capabilities": [
+                             { "capability": capability,
+                               "state": True }
+                         ] }))
+
+        def set_parameter(cmds, name, value):
+            cmds.append(("migrate-set-parameters", { name: value }))
+
         if scenario._auto_converge:
-            resp = src.command("migrate-set-capabilities",
-                               capabilities = [
-                                   { "capability": "auto-converge",
-                                     "state": True }
-                               ])
-            resp = src.command("migrate-set-parameters",
-                               cpu_throttle_increment=scenario._auto_converge_step)
+            enable(src_cmds, "auto-converge")
+            set_parameter(src_cmds, "cpu_throttle_increment",
+                          scenario._auto_converge_step)
 
         if scenario._post_copy:
-            resp = src.command("migrate-set-capabilities",
-                               capabilities = [
-                                   { "capability": "postcopy-ram",
-                                     "state": True }
-                               ])
-            resp = dst.command("migrate-set-capabilities",
-                               capabilities = [
-                                   { "capability": "postcopy-ram",
-                                     "state": True }
-                               ])
-
-        resp = src.command("migrate-set-parameters",
-                           max_bandwidth=scenario._bandwidth * 1024 * 1024)
-
-        resp = src.command("migrate-set-parameters",
-                           downtime_limit=scenario._downtime)
+            enable(src_cmds, "postcopy-ram")
+            enable(dst_cmds, "postcopy-ram")
+
+        set_parameter(src_cmds, "max_bandwidth",
+                      scenario._bandwidth * 1024 * 1024)
+
+        set_parameter(src_cmds, "downtime_limit", scenario._downtime)
 
         if scenario._compression_mt:
-            resp = src.command("migrate-set-capabilities",
-                               capabilities = [
-                                   { "capability": "compress",
-                                     "state": True }
-                               ])
-            resp = src.command("migrate-set-parameters",
-                               compress_threads=scenario._compression_mt_threads)
-            resp = dst.command("migrate-set-capabilities",
-                               capabilities = [
-                                   { "capability": "compress",
-                                     "state": True }
-                               ])
-            resp = dst.command("migrate-set-parameters",
-                               decompress_threads=scenario._compression_mt_threads)
+            enable(src_cmds, "compress")
+            set_parameter(src_cmds, "compress_threads",
+                          scenario._compression_mt_threads)
+            enable(dst_cmds, "compress")
+            set_parameter(dst_cmds, "decompress_threads",
+                          scenario._compression_mt_threads)
 
         if scenario._compression_xbzrle:
-            resp = src.command("migrate-set-capabilities",
-                               capabilities = [
-                                   { "capability": "xbzrle",
-                                     "state": True }
-                               ])
-            resp = dst.command("migrate-set-capabilities",
-                               capabilities = [
-                                   { "capability": "xbzrle",
-                                     "state": True }
-                               ])
-            resp = src.command("migrate-set-parameters",
-                               xbzrle_cache_size=(
-                                   hardware._mem *
-                                   1024 * 1024 * 1024 / 100 *
-                                   scenario._compression_xbzrle_cache))
+            enable(src_cmds, "xbzrle")
+            enable(dst_cmds, "xbzrle")
+            set_parameter(src_cmds, "xbzrle_cache_size",
+                          (hardware._mem *
+                           1024 * 1024 * 1024 / 100 *
+                           scenario._compression_xbzrle_cache))
 
         if scenario._multifd:
-            resp = src.command("migrate-set-capabilities",
-                               capabilities = [
-                                   { "capability": "multifd",
-                                     "state": True }
-                               ])
-            resp = src.command("migrate-set-parameters",
-                               multifd_channels=scenario._multifd_channels)
-            resp = dst.command("migrate-set-capabilities",
-                               capabilities = [
-                                   { "capability": "multifd",
-                                     "state": True }
-                               ])
-            resp = dst.command("migrate-set-parameters",
-                               multifd_channels=scenario._multifd_channels)
+            enable(src_cmds, "multifd")
+            set_parameter(src_cmds, "multifd_channels",
+                          scenario._multifd_channels)
+            enable(dst_cmds, "multifd")
+            set_parameter(dst_cmds, "multifd_channels",
+                          scenario._multifd_channels)
+
+        if src_cmds:
+            src.command_batch(src_cmds)
+        if dst_cmds:
+            dst.command_batch(dst_cmds)
 
         resp = src.command("migrate", uri=connect_uri)
 
@@ -0,0 +1,163 @@
+#!/usr/bin/env python3
+#
+# QAPI generator test harness: schema cache and incremental generation
+#
+# This work is licensed under the terms of the GNU GPL, version 2 or later.
+# See the COPYING file in the top-level directory.
+#
+
+"""
+Run qapi-gen on a copy of qapi-schema-test.json and its sub-modules,
+with --cache-dir and incremental generation, through a series of edits
+of the schema.  After each run, the output must match that of a full
+generation from scratch.
+"""
+
+import argparse
+import filecmp
+import os
+import shutil
+import subprocess
+import sys
+import tempfile
+
+import qapi
+
+
+QAPI_GEN = os.path.join(os.path.dirname(os.path.dirname(qapi.__file__)),
+                        'qapi-gen.py')
+SCHEMA_FILES = ['qapi-schema-test.json', 'include/sub-module.json',
+                'sub-sub-module.json']
+
+
+def qapi_gen(schema_dir, output_dir, *args):
+    subprocess.run([sys.executable, QAPI_GEN, '-b', '-p', 'test-',
+                    '-o', output_dir, *args,
+                    os.path.join(schema_dir, 'qapi-schema-test.json')],
+                   check=True)
+
+
+def generated_files(output_dir):
+    return sorted(os.path.relpath(os.path.join(dirpath, name), output_dir)
+                  for dirpath, _, names in os.walk(output_dir)
+                  for name in names if not name.startswith('.'))
+
+
+def compare_dirs(expected, actual):
+    """Return the names of the generated files that differ."""
+    names = generated_files(expected)
+    if generated_files(actual) != names:
+        return ['<file list>']
+    _, mismatch, errors = filecmp.cmpfiles(expected, actual, names,
+                                           shallow=False)
+    return mismatch + errors
+
+
+def edit(schema_dir, fname, old, new):
+    path = os.path.join(schema_dir, fname)
+    with open(path, 'r', encoding='utf-8') as fp:
+        text = fp.read()
+    if old is None:
+        text += new
+    else:
+        assert old in text
+        text = text.replace(old, new)
+    with open(path, 'w', encoding='utf-8') as fp:
+        fp.write(text)
+
+
+# (description, file, text to replace or None to append, new text)
+EDITS = [
+    ("no change", None, None, None),
+    # The main module is not generated again, but its TestStruct must
+    # not be emitted again along with SubModuleUnion
+    ("new types in the included module",
+     'include/sub-module.json', None,
+     "\n{ 'struct': 'SubModuleExtra', 'data': { 'status': 'Status' } }\n"
+     "{ 'union': 'SubModuleUnion',\n"
+     "  'base': { 'status': 'Status' },\n"
+     "  'discriminator': 'status',\n"
+     "  'data': { 'good': 'SecondArrayRef', 'bad': 'TestStruct' } }\n"),
+    # Adds a branch to the visitor of SubModuleUnion
+    ("enum used by other modules",
+     'sub-sub-module.json', "'ugly' ]", "'ugly', 'worse' ]"),
+    ("new command and event in the main module",
+     'qapi-schema-test.json', None,
+     "\n{ 'command': 'test-extra', 'data': { 'arg': 'SubModuleExtra' } }\n"
+     "{ 'event': 'TEST_EXTRA', 'data': { 's': 'SecondArrayRef' } }\n"),
+    ("enum change reverted",
+     'sub-sub-module.json', "'ugly', 'worse' ]", "'ugly' ]"),
+]
+
+
+def run_tests(src_dir, jobs):
+    status = 0
+    with tempfile.TemporaryDirectory() as tmp:
+        schema_dir = os.path.join(tmp, 'schema')
+        for fname in SCHEMA_FILES:
+            os.makedirs(os.path.dirname(os.path.join(schema_dir, fname)),
+                        exist_ok=True)
+            shutil.copy(os.path.join(src_dir, fname),
+                        os.path.join(schema_dir, fname))
+        cache_dir = os.path.join(tmp, 'cache')
+        output_dir = os.path.join(tmp, 'incremental')
+
+        def check(what):
+            expected_dir = os.path.join(tmp, 'expected')
+            shutil.rmtree(expected_dir, ignore_errors=True)
+            qapi_gen(schema_dir, expected_dir, '--no-incremental')
+            bad = compare_dirs(expected_dir, output_dir)
+            if bad:
+                print(f"{what} (-j {jobs}): FAIL, differences in "
+                      f"{', '.join(bad)}", file=sys.stderr)
+            return 1 if bad else 0
+
+        # Cold cache, then warm cache
+        qapi_gen(schema_dir, output_dir, '--cache-dir', cache_dir,
+                 '-j', str(jobs))
+        status |= check("cold cache")
+        for what, fname, old, new in EDITS:
+            if fname:
+                edit(schema_dir, fname, old, new)
+            qapi_gen(schema_dir, output_dir, '--cache-dir', cache_dir,
+                     '-j', str(jobs))
+            status |= check(what)
+
+        # Generated files that went missing are generated again
+        os.remove(os.path.join(output_dir, 'include',
+                               'test-qapi-visit-sub-module.c'))
+        qapi_gen(schema_dir, output_dir, '--cache-dir', cache_dir,
+                 '-j', str(jobs))
+        status |= check("removed output file")
+
+        # A full generation records fingerprints for the next incremental
+        # run
+        edit(schema_dir, 'sub-sub-module.json',
+             "'ugly' ]", "'ugly', 'worse' ]")
+        qapi_gen(schema_dir, output_dir, '--cache-dir', cache_dir,
+                 '-j', str(jobs), '--no-incremental')
+        status |= check("full generation")
+        edit(schema_dir, 'sub-sub-module.json',
+             "'ugly', 'worse' ]", "'ugly' ]")
+        qapi_gen(schema_dir, output_dir, '--cache-dir', cache_dir,
+                 '-j', str(jobs))
+        status |= check("incremental after full generation")
+    return status
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description='QAPI generator cache and incremental generation tester')
+    parser.add_argument('-d', '--dir', action='store',
+                        default=os.path.dirname(os.path.abspath(__file__)),
+                        help="directory containing qapi-schema-test.json")
+    args = parser.parse_args()
+
+    status = 0
+    for jobs in (1, 2):
+        status |= run_tests(args.dir, jobs)
+    sys.exit(status)
+
+
+if __name__ == '__main__':
+    main()
@@ -23,6 +23,12 @@
  * @name: Event name.
  * @sstate: Static tracing state.
  * @dstate: Dynamic tracing state
+ * @layout: Layout of the arguments in the records of the simple backend, one
+ *          character per argument: a struct module format character of
+ *          Python for arguments written at their declared width, 's' for
+ *          strings and 'v' for varints.
+ * @schema: Types and names of the arguments, for trace readers.  Each type
+ *          and each name is a length byte followed by its characters.
  *
  * Interpretation of @dstate depends on whether the event has the 'vcpu'
  *  property:
@@ -37,6 +43,8 @@ typedef struct TraceEvent {
     const char * name;
     const bool sstate;
     uint16_t *dstate;
+    const char *layout;
+    const char *schema;
 } TraceEvent;
 
 void trace_event_set_state_dynamic_init(TraceEvent *ev, bool state);
@@ -25,7 +25,7 @@
 #define HEADER_MAGIC 0xf2b177cb0aa429b4ULL
 
 /** Trace file version number, bump if format changes */
-#define HEADER_VERSION 4
+#define HEADER_VERSION 5
 
 /** Records were dropped event ID */
 #define DROPPED_EVENT_ID (~(uint64_t)0 - 1)
@@ -196,11 +196,39 @@ static gpointer writeout_thread(gpointer opaque)
     return NULL;
 }
 
+void trace_record_write_u8(TraceBufferRecord *rec, uint8_t val)
+{
+    rec->rec_off = write_to_buffer(rec->rec_off, &val, sizeof(uint8_t));
+}
+
+void trace_record_write_u16(TraceBufferRecord *rec, uint16_t val)
+{
+    rec->rec_off = write_to_buffer(rec->rec_off, &val, sizeof(uint16_t));
+}
+
+void trace_record_write_u32(TraceBufferRecord *rec, uint32_t val)
+{
+    rec->rec_off = write_to_buffer(rec->rec_off, &val, sizeof(uint32_t));
+}
+
 void trace_record_write_u64(TraceBufferRecord *rec, uint64_t val)
 {
     rec->rec_off = write_to_buffer(rec->rec_off, &val, sizeof(uint64_t));
 }
 
+void trace_record_write_varint(TraceBufferRecord *rec, uint64_t val)
+{
+    uint8_t buf[10];
+    unsigned int len = 0;
+
+    while (val >= 0x80) {
+        buf[len++] = (val & 0x7f) | 0x80;
+        val >>= 7;
+    }
+    buf[len++] = val;
+    rec->rec_off = write_to_buffer(rec->rec_off, buf, len);
+}
+
 void trace_record_write_str(TraceBufferRecord *rec, const char *s, uint32_t slen)
 {
     /* Write string length first */
@@ -280,6 +308,12 @@ void trace_record_finish(TraceBufferRecord *rec)
     }
 }
 
+/*
+ * Mapping records give the ID and the name of an event, followed by the
+ * layout of its arguments in the event records (one character per argument)
+ * and by their types and names, see TraceEvent.  This makes trace files
+ * self-describing.
+ */
 static int st_write_event_mapping(TraceEventIter *iter)
 {
     uint64_t type = TRACE_RECORD_TYPE_MAPPING;
@@ -289,10 +323,18 @@ static int st_write_event_mapping(TraceEventIter *iter)
         uint64_t id = trace_event_get_id(ev);
         const char *name = trace_event_get_name(ev);
         uint32_t len = strlen(name);
+        uint32_t layout_len = strlen(ev->layout);
+        uint32_t schema_len = strlen(ev->schema);
         if (fwrite(&type, sizeof(type), 1, trace_fp) != 1 ||
             fwrite(&id, sizeof(id), 1, trace_fp) != 1 ||
             fwrite(&len, sizeof(len), 1, trace_fp) != 1 ||
-            fwrite(name, len, 1, trace_fp) != 1) {
+            fwrite(name, len, 1, trace_fp) != 1 ||
+            fwrite(&layout_len, sizeof(layout_len), 1, trace_fp) != 1 ||
+            (layout_len &&
+             fwrite(ev->layout, layout_len, 1, trace_fp) != 1) ||
+            fwrite(&schema_len, sizeof(schema_len), 1, trace_fp) != 1 ||
+            (schema_len &&
+             fwrite(ev->schema, schema_len, 1, trace_fp) != 1)) {
             return -1;
         }
     }
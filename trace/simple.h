@@ -11,6 +11,8 @@
 #ifndef TRACE_SIMPLE_H
 #define TRACE_SIMPLE_H
 
+#include "qemu/host-utils.h"
+
 void st_print_trace_file_status(void);
 bool st_set_trace_file_enabled(bool enable);
 void st_set_trace_file(const char *file);
@@ -32,11 +34,40 @@ typedef struct {
  */
 int trace_record_start(TraceBufferRecord *rec, uint32_t id, size_t arglen);
 
+/**
+ * Append an 8-bit argument to a trace record
+ */
+void trace_record_write_u8(TraceBufferRecord *rec, uint8_t val);
+
+/**
+ * Append a 16-bit argument to a trace record
+ */
+void trace_record_write_u16(TraceBufferRecord *rec, uint16_t val);
+
+/**
+ * Append a 32-bit argument to a trace record
+ */
+void trace_record_write_u32(TraceBufferRecord *rec, uint32_t val);
+
 /**
  * Append a 64-bit argument to a trace record
  */
 void trace_record_write_u64(TraceBufferRecord *rec, uint64_t val);
 
+/**
+ * Number of bytes taken by a varint argument in a trace record
+ */
+static inline size_t trace_varint_len(uint64_t val)
+{
+    return DIV_ROUND_UP(64 - clz64(val | 1), 7);
+}
+
+/**
+ * Append a 64-bit argument to a trace record as an unsigned LEB128 varint,
+ * see trace_varint_len()
+ */
+void trace_record_write_varint(TraceBufferRecord *rec, uint64_t val);
+
 /**
  * Append a string argument to a trace record
  */